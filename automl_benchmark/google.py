@@ -1,12 +1,16 @@
-import csv
-import json
 import os
-import time
 
 import fire
 import numpy as np
 import requests
-from tqdm import tqdm
+from requests.adapters import HTTPAdapter
+
+from nyckel_utils.batching import sweep_batch_sizes
+from nyckel_utils.concurrency import retry_after_seconds
+from nyckel_utils.evaluation import Provider, evaluate_provider
+from nyckel_utils.load import ramp_load
+from nyckel_utils.retry import RetryableError, RetryPolicy, ThrottledError, is_retryable_status
+from nyckel_utils.sample import csv_to_samples
 
 assert os.getenv("GCP_BEARER_TOKEN"), "GCP_BEARER_TOKEN env variable not set; can't setup connection."
 assert os.getenv("GCP_INVOKE_ENDPOINT"), "GCP_INVOKE_ENDPOINT env variable not set; can't setup connection."
@@ -14,42 +18,116 @@ assert os.getenv("GCP_INVOKE_ENDPOINT"), "GCP_INVOKE_ENDPOINT env variable not s
 gcp_bearer_token = os.environ["GCP_BEARER_TOKEN"]
 gcp_invoke_endpoint = os.environ["GCP_INVOKE_ENDPOINT"]
 
+retry_policy = RetryPolicy()
+
+
+class GoogleProvider(Provider):
+    # The endpoint takes a list of instances; larger batches risk the request size limit.
+    max_batch_size = 32
+    name = "google"
+    model_id = gcp_invoke_endpoint
+
+    def __init__(self, max_nbr_concurrent_requests):
+        self.session = requests.Session()
+        self.session.mount("https://", HTTPAdapter(pool_maxsize=max_nbr_concurrent_requests))
+
+    def invoke(self, sample):
+        return self.invoke_batch([sample])[0]
+
+    def invoke_batch(self, samples):
+        data = {"instances": [{"mimeType": "text/plain", "content": sample.data} for sample in samples]}
+        response = retry_policy.call(lambda: _invoke(self.session, data), description="Invoking the endpoint").json()
+        # Split into one response per sample, shaped as if each had been sent alone.
+        return [{**response, "predictions": [prediction]} for prediction in response["predictions"]]
+
+    def label_name(self, prediction):
+        scores = prediction["predictions"][0]["confidences"]
+        pred_names = prediction["predictions"][0]["displayNames"]
+        return pred_names[np.argmax(scores)]
+
+
+def evaluate(
+    test_file, max_nbr_concurrent_requests=16, sequential=False, max_batch_size=1, cache_file=None, bypass_cache=False
+):
+    """
+    max_nbr_concurrent_requests: How many test samples are invoked at once.
+    sequential: If set, test samples are invoked one at a time, for invoke times unaffected by concurrency.
+    max_batch_size: If above 1, test samples are sent up to this many per request.
+    cache_file: If set, predictions are cached in this SQLite file, and test samples predicted before are not
+        invoked again.
+    bypass_cache: If set, every test sample is invoked even if cached, for fresh invoke times.
+    """
+
+    result = evaluate_provider(
+        GoogleProvider(max_nbr_concurrent_requests),
+        csv_to_samples(test_file),
+        f"{test_file}_google_preds.json",
+        f"{test_file}_google_invoke_times.json",
+        max_nbr_concurrent_requests=max_nbr_concurrent_requests,
+        sequential=sequential,
+        max_batch_size=max_batch_size,
+        cache_file=cache_file,
+        bypass_cache=bypass_cache,
+    )
+    print(f"Project: {test_file}. Accuracy: {result.accuracy}")
+
+
+def batch_sweep(
+    test_file, batch_sizes=(1, 4, 16, 32), max_linger_ms=5, nbr_samples=256, max_nbr_concurrent_requests=16
+):
+    """
+    Prints the throughput and latency of invoking the first nbr_samples test samples at each batch size.
+    """
+
+    sweep_batch_sizes(
+        GoogleProvider(max_nbr_concurrent_requests),
+        csv_to_samples(test_file)[:nbr_samples],
+        batch_sizes=batch_sizes,
+        max_linger_sec=max_linger_ms / 1000,
+        max_nbr_concurrent_calls=max_nbr_concurrent_requests,
+    )
+
+
+def load_test(
+    test_file,
+    qps_steps=(1, 2, 5, 10, 20, 50),
+    step_duration_sec=30,
+    arrivals="poisson",
+    max_nbr_concurrent_requests=64,
+    p99_slo_ms=None,
+):
+    """
+    Sends test samples at each rate in qps_steps, open loop, and reports latency percentiles and the saturation point.
+
+    arrivals: "poisson" or "constant".
+    p99_slo_ms: If set, a rate whose p99 latency exceeds this counts as saturated.
+    """
+
+    ramp_load(
+        GoogleProvider(max_nbr_concurrent_requests),
+        csv_to_samples(test_file),
+        qps_steps=qps_steps,
+        step_duration_sec=step_duration_sec,
+        arrivals=arrivals,
+        max_nbr_concurrent_requests=max_nbr_concurrent_requests,
+        p99_slo_sec=p99_slo_ms / 1000 if p99_slo_ms else None,
+        report_file=f"{test_file}_google_load.json",
+    )
+
 
-def evaluate(test_file):
-
-    predictions = []
-    invoke_times = []
-    n_correct = 0
-    with open(test_file, "r") as csvfile:
-        csvreader = csv.reader(csvfile, delimiter=",", quotechar='"')
-        next(csvreader)
-        for _, text, gt_label_name in tqdm(csvreader, total=1000):
-            t0 = time.time()
-            data = {"instances": [{"mimeType": "text/plain", "content": text}]}
-            resp = requests.post(
-                gcp_invoke_endpoint,
-                json=data,
-                headers={"authorization": "Bearer " + gcp_bearer_token},
-            )
-            prediction = resp.json()
-
-            invoke_times.append(time.time() - t0)
-            predictions.append(prediction)
-
-            scores = prediction["predictions"][0]["confidences"]
-            pred_names = prediction["predictions"][0]["displayNames"]
-            ind = np.argmax(scores)
-            pred_label_name = pred_names[ind]
-            if pred_label_name == gt_label_name:
-                n_correct += 1
-
-    print(f"Project: {test_file}. Accuracy: {n_correct/len(predictions)}")
-
-    with open(f"{test_file}_google_preds.json", "w") as f:
-        json.dump(predictions, f, indent=2)
-
-    with open(f"{test_file}_google_invoke_times.json", "w") as f:
-        json.dump(invoke_times, f, indent=2)
+def _invoke(session, data):
+    resp = session.post(
+        gcp_invoke_endpoint,
+        json=data,
+        headers={"authorization": "Bearer " + gcp_bearer_token},
+    )
+    if resp.status_code == 429:
+        raise ThrottledError(f"Call failed with {resp.status_code}: {resp.text}", retry_after_seconds(resp))
+    if is_retryable_status(resp.status_code):
+        raise RetryableError(f"Call failed with {resp.status_code}: {resp.text}", retry_after_seconds(resp))
+    if resp.status_code != 200:
+        raise RuntimeError(f"Call failed with {resp.status_code}: {resp.text}")
+    return resp
 
 
 if __name__ == "__main__":
@@ -1,17 +1,27 @@
 import fire
 import os
-import csv
-import json
-import tqdm
-import time
 import numpy as np
 from autonlp import AutoNLP
 
+from nyckel_utils.evaluation import Provider, evaluate_provider
+from nyckel_utils.load import ramp_load
+from nyckel_utils.retry import CircuitBreaker, RetryableError, RetryPolicy
+from nyckel_utils.sample import csv_to_samples
+
 assert os.getenv("HF_API_KEY"), "HF_API_KEY env variable not set; can't setup connection."
 
 client = AutoNLP()
 client.login(token=os.environ["HF_API_KEY"])
 
+# Inference API models answer with an error while they load, so give them a while, and only open the circuit
+# after at least a whole call's worth of failed attempts.
+retry_policy = RetryPolicy(
+    max_attempts=10,
+    base_delay_sec=2,
+    max_delay_sec=60,
+    circuit_breaker=CircuitBreaker(failure_threshold=10, reset_timeout_sec=60),
+)
+
 
 def train(dataset_name, n_train):
     project_name = f"{dataset_name}_{n_train}"
@@ -46,46 +56,94 @@ def monitor(project_name):
     print(models)
 
 
-def evaluate(project_name, model_id, test_file):
-
-    invoke_times = []
-    predictions = []
-    n_correct = 0
-    with open(test_file, "r") as csvfile:
-        csvreader = csv.reader(csvfile, delimiter=",", quotechar='"')
-        next(csvreader)  # Skip header
-        for _, input_text, gt_label_name in tqdm.tqdm(csvreader, total=1000):
-            n_words = input_text.split(" ")
-            shortened_input = " ".join(n_words[:250])
-            t0 = time.time()
-            return_ok = False
-            while not return_ok:
-                prediction = client.predict(project=project_name, model_id=model_id, input_text=shortened_input)
-                if (
-                    isinstance(prediction, list)
-                    and len(prediction) == 1
-                    and isinstance(prediction[0], list)
-                    and "score" in prediction[0][0]
-                ):
-                    return_ok = True
-                else:
-                    print("Call failed, trying again.")
-                    time.sleep(2)
-            invoke_times.append(time.time() - t0)
-            predictions.append(prediction)
-            scores = [entry["score"] for entry in prediction[0]]
-            ind = np.argmax(scores)
-            pred_name = prediction[0][ind]["label"]
-            if gt_label_name == pred_name:
-                n_correct += 1
-
-    print(f"Project: {project_name}. Accuracy: {n_correct/len(predictions)}")
-
-    with open(f"{project_name}_{model_id}_hf_preds.json", "w") as f:
-        json.dump(predictions, f, indent=2)
-
-    with open(f"{project_name}_{model_id}_invoke_times.json", "w") as f:
-        json.dump(invoke_times, f, indent=2)
+class HuggingfaceProvider(Provider):
+    name = "huggingface"
+
+    def __init__(self, project_name, model_id):
+        self.project_name = project_name
+        self.model_id = model_id
+
+    def invoke(self, sample):
+        shortened_input = " ".join(sample.data.split(" ")[:250])
+        return retry_policy.call(
+            lambda: _predict(self.project_name, self.model_id, shortened_input),
+            description=f"Predicting with {self.model_id}",
+        )
+
+    def label_name(self, prediction):
+        scores = [entry["score"] for entry in prediction[0]]
+        return prediction[0][np.argmax(scores)]["label"]
+
+
+def evaluate(
+    project_name,
+    model_id,
+    test_file,
+    max_nbr_concurrent_requests=4,
+    sequential=False,
+    cache_file=None,
+    bypass_cache=False,
+):
+    """
+    max_nbr_concurrent_requests: How many test samples are invoked at once.
+    sequential: If set, test samples are invoked one at a time, for invoke times unaffected by concurrency.
+    cache_file: If set, predictions are cached in this SQLite file, and test samples predicted before are not
+        invoked again.
+    bypass_cache: If set, every test sample is invoked even if cached, for fresh invoke times.
+    """
+
+    result = evaluate_provider(
+        HuggingfaceProvider(project_name, model_id),
+        csv_to_samples(test_file),
+        f"{project_name}_{model_id}_hf_preds.json",
+        f"{project_name}_{model_id}_invoke_times.json",
+        max_nbr_concurrent_requests=max_nbr_concurrent_requests,
+        sequential=sequential,
+        cache_file=cache_file,
+        bypass_cache=bypass_cache,
+    )
+    print(f"Project: {project_name}. Accuracy: {result.accuracy}")
+
+
+def load_test(
+    project_name,
+    model_id,
+    test_file,
+    qps_steps=(1, 2, 5, 10, 20, 50),
+    step_duration_sec=30,
+    arrivals="poisson",
+    max_nbr_concurrent_requests=64,
+    p99_slo_ms=None,
+):
+    """
+    Sends test samples at each rate in qps_steps, open loop, and reports latency percentiles and the saturation point.
+
+    arrivals: "poisson" or "constant".
+    p99_slo_ms: If set, a rate whose p99 latency exceeds this counts as saturated.
+    """
+
+    ramp_load(
+        HuggingfaceProvider(project_name, model_id),
+        csv_to_samples(test_file),
+        qps_steps=qps_steps,
+        step_duration_sec=step_duration_sec,
+        arrivals=arrivals,
+        max_nbr_concurrent_requests=max_nbr_concurrent_requests,
+        p99_slo_sec=p99_slo_ms / 1000 if p99_slo_ms else None,
+        report_file=f"{project_name}_{model_id}_hf_load.json",
+    )
+
+
+def _predict(project_name, model_id, input_text):
+    prediction = client.predict(project=project_name, model_id=model_id, input_text=input_text)
+    if (
+        isinstance(prediction, list)
+        and len(prediction) == 1
+        and isinstance(prediction[0], list)
+        and "score" in prediction[0][0]
+    ):
+        return prediction
+    raise RetryableError(f"Unexpected prediction: {prediction}")
 
 
 if __name__ == "__main__":
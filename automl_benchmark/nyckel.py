@@ -1,15 +1,17 @@
-import csv
+import concurrent.futures
 import json
 import os
 import time
 
 import fire
-import requests
-from tqdm import tqdm
 
+from nyckel_utils.evaluation import Provider, evaluate_provider
 from nyckel_utils.function import FunctionBuilder
+from nyckel_utils.journal import UploadJournal
+from nyckel_utils.load import ramp_load
+from nyckel_utils.poller import TrainingPoller
 from nyckel_utils.requester import requester_factory
-from nyckel_utils.sample import Modality, Sample
+from nyckel_utils.sample import Modality, csv_to_samples
 
 assert os.getenv("NYCKEL_CLIENT_ID"), "NYCKEL_CLIENT_ID env variable not set; can't setup connection."
 assert os.getenv("NYCKEL_CLIENT_SECRET"), "NYCKEL_CLIENT_SECRET env variable not set; can't setup connection."
@@ -17,77 +19,193 @@ assert os.getenv("NYCKEL_CLIENT_SECRET"), "NYCKEL_CLIENT_SECRET env variable not
 requester = requester_factory()
 
 
-def csv_to_samples(file_path):
-    with open(file_path, "r") as csvfile:
-        csvreader = csv.reader(csvfile, delimiter=",", quotechar='"')
-        next(csvreader)
-        samples = []
-        for cnt, row in enumerate(csvreader):
-            samples.append(
-                Sample(
-                    modality=Modality.Text,
-                    id=f"{os.path.basename(file_path)}-{cnt}",
-                    label_name=row[2],
-                    data=row[1],
-                )
-            )
-    return samples
-
-
-def train(dataset_name, n_train, with_val=True):
+def train(dataset_name, n_train, with_val=True, journal_file=None):
+    """
+    journal_file: If set, uploads are recorded in this file, so that an interrupted upload can be finished with
+        resume_train.
+    """
 
     function_name = f"{dataset_name}_{n_train}"
-    train_samples = csv_to_samples(f"{dataset_name}_train_{n_train}.csv")
-
-    builder = FunctionBuilder(name=function_name, input_modality=Modality.Text, requester=requester)
-    for label_name in list(set([sample.label_name for sample in train_samples])):
-        builder.add_label(label_name)
-
-    t0 = time.time()
-    print("Uploading train data...")
-    builder.add_samples(train_samples)
-    builder.add_annotations(train_samples)
+    samples = _train_samples(dataset_name, n_train, with_val)
+    journal = UploadJournal(journal_file) if journal_file else None
+    builder = FunctionBuilder(name=function_name, input_modality=Modality.Text, requester=requester, journal=journal)
+    builder.add_labels(sample.label_name for sample in samples)
+    _upload_and_train(builder, samples)
+
+
+def resume_train(function_id, dataset_name, n_train, journal_file, with_val=True):
+    """
+    Finishes an interrupted train run, uploading only what the journal does not show as uploaded.
+    """
+
+    samples = _train_samples(dataset_name, n_train, with_val)
+    builder = FunctionBuilder.resume(function_id, UploadJournal(journal_file), requester)
+    _upload_and_train(builder, samples)
+
+
+def train_grid(
+    dataset_names=("imdb", "ag_news"),
+    train_sizes=(500,),
+    with_val=True,
+    max_nbr_concurrent_uploads=4,
+    timeout_sec=4 * 3600,
+    manifest_file="train_grid_manifest.jsonl",
+):
+    """
+    Trains a function for every dataset and train size, uploading several at once and waiting for all of them to
+    train. All uploads share the requester, and with it its limit on concurrent requests. Each finished or failed
+    run is appended to manifest_file as a JSON line with its function ID and the seconds spent in each phase.
+
+    dataset_names: The datasets, prepared with prepare_data.py for every train size.
+    train_sizes: The train sizes.
+    with_val: Whether to upload the validation data too.
+    max_nbr_concurrent_uploads: How many functions are created and uploaded to at once.
+    timeout_sec: How long a function may take to train after its upload.
+    manifest_file: The JSON lines file that results are appended to.
+    """
+
+    # Fire passes a single --dataset_names imdb or --train_sizes 500 as a scalar.
+    dataset_names = [dataset_names] if isinstance(dataset_names, str) else list(dataset_names)
+    train_sizes = [train_sizes] if isinstance(train_sizes, int) else list(train_sizes)
+    grid = [(dataset_name, n_train) for dataset_name in dataset_names for n_train in train_sizes]
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_nbr_concurrent_uploads) as executor, TrainingPoller(
+        requester, timeout_sec=timeout_sec
+    ) as poller:
+        upload_futures = {
+            executor.submit(_upload_run, dataset_name, n_train, with_val): (dataset_name, n_train)
+            for dataset_name, n_train in grid
+        }
+        record_by_training_future = {}
+        for future in concurrent.futures.as_completed(upload_futures):
+            dataset_name, n_train = upload_futures[future]
+            try:
+                record = future.result()
+            except Exception as err:
+                _write_manifest_record(
+                    manifest_file,
+                    {"dataset_name": dataset_name, "n_train": n_train, "status": "failed", "error": str(err)},
+                )
+                continue
+            record_by_training_future[poller.watch(record["function_id"])] = record
+        for future in concurrent.futures.as_completed(record_by_training_future):
+            record = record_by_training_future[future]
+            try:
+                record["train_sec"] = future.result()
+                record["status"] = "trained"
+            except TimeoutError as err:
+                record["status"] = "timed_out"
+                record["error"] = str(err)
+            _write_manifest_record(manifest_file, record)
+
+
+def _upload_run(dataset_name, n_train, with_val):
+    t0 = time.perf_counter()
+    samples = _train_samples(dataset_name, n_train, with_val)
+    t1 = time.perf_counter()
+    builder = FunctionBuilder(name=f"{dataset_name}_{n_train}", input_modality=Modality.Text, requester=requester)
+    builder.add_labels(sample.label_name for sample in samples)
+    t2 = time.perf_counter()
+    report = builder.upload(samples)
+    return {
+        "dataset_name": dataset_name,
+        "n_train": n_train,
+        "function_id": builder.function_id,
+        "nbr_samples": report.nbr_samples,
+        "read_sec": t1 - t0,
+        "create_sec": t2 - t1,
+        "upload_sec": time.perf_counter() - t2,
+    }
+
+
+def _write_manifest_record(manifest_file, record):
+    print(f"{record['dataset_name']}_{record['n_train']}: {record['status']}, function {record.get('function_id')}.")
+    with open(manifest_file, "a") as f:
+        f.write(json.dumps({"timestamp": time.time(), **record}) + "\n")
+
+
+def _train_samples(dataset_name, n_train, with_val):
+    samples = csv_to_samples(f"{dataset_name}_train_{n_train}.csv")
     if with_val:
-        print("Uploading validation data...")
-        val_samples = csv_to_samples(f"{dataset_name}_val_{n_train}.csv")
-        builder.add_samples(val_samples)
-        builder.add_annotations(val_samples)
+        samples += csv_to_samples(f"{dataset_name}_val_{n_train}.csv")
     else:
         print("Skipping val data.")
+    return samples
+
+
+def _upload_and_train(builder, samples):
+    t0 = time.time()
+    print("Uploading data...")
+    print(builder.upload(samples))
     print("Training...")
     builder.sleep_until_has_at_least_one_model()
 
     print(f"Training of function {builder.function_id} complete in {time.time()-t0:.1f} seconds.")
 
 
-def evaluate(function_id, test_file):
-
-    test_samples = csv_to_samples(test_file)
-
-    t0 = time.time()
-    invoke_times = []
-    predictions = []
-    n_correct = 0
-    for sample in tqdm(test_samples):
-        t0 = time.time()
-        resp = requester(
-            requests.post,
-            f"functions/{function_id}/invoke",
-            json={"data": f"[{sample.data}]"},
-        )
-        invoke_times.append(time.time() - t0)
-        prediction = resp.json()
-        predictions.append(prediction)
-        if prediction["name"] == sample.label_name:
-            n_correct += 1
-
-    print(f"Project: {test_file} {function_id}. Accuracy: {n_correct/len(predictions):.2f}")
-
-    with open(f"{test_file}_{function_id}_nyckel_preds.json", "w") as f:
-        json.dump(predictions, f, indent=2)
-
-    with open(f"{test_file}_{function_id}_nyckel_invoke_times.json", "w") as f:
-        json.dump(invoke_times, f, indent=2)
+class NyckelProvider(Provider):
+    name = "nyckel"
+
+    def __init__(self, function_id):
+        self.function_id = function_id
+        self.model_id = function_id
+
+    def invoke(self, sample):
+        return requester("post", f"functions/{self.function_id}/invoke", json={"data": f"[{sample.data}]"}).json()
+
+    def label_name(self, prediction):
+        return prediction["name"]
+
+
+def evaluate(
+    function_id, test_file, max_nbr_concurrent_requests=16, sequential=False, cache_file=None, bypass_cache=False
+):
+    """
+    max_nbr_concurrent_requests: How many test samples are invoked at once.
+    sequential: If set, test samples are invoked one at a time, for invoke times unaffected by concurrency.
+    cache_file: If set, predictions are cached in this SQLite file, and test samples predicted before are not
+        invoked again.
+    bypass_cache: If set, every test sample is invoked even if cached, for fresh invoke times.
+    """
+
+    result = evaluate_provider(
+        NyckelProvider(function_id),
+        csv_to_samples(test_file),
+        f"{test_file}_{function_id}_nyckel_preds.json",
+        f"{test_file}_{function_id}_nyckel_invoke_times.json",
+        max_nbr_concurrent_requests=max_nbr_concurrent_requests,
+        sequential=sequential,
+        cache_file=cache_file,
+        bypass_cache=bypass_cache,
+    )
+    print(f"Project: {test_file} {function_id}. Accuracy: {result.accuracy:.2f}")
+
+
+def load_test(
+    function_id,
+    test_file,
+    qps_steps=(1, 2, 5, 10, 20, 50),
+    step_duration_sec=30,
+    arrivals="poisson",
+    max_nbr_concurrent_requests=64,
+    p99_slo_ms=None,
+):
+    """
+    Sends test samples at each rate in qps_steps, open loop, and reports latency percentiles and the saturation point.
+
+    arrivals: "poisson" or "constant".
+    p99_slo_ms: If set, a rate whose p99 latency exceeds this counts as saturated.
+    """
+
+    ramp_load(
+        NyckelProvider(function_id),
+        csv_to_samples(test_file),
+        qps_steps=qps_steps,
+        step_duration_sec=step_duration_sec,
+        arrivals=arrivals,
+        max_nbr_concurrent_requests=max_nbr_concurrent_requests,
+        p99_slo_sec=p99_slo_ms / 1000 if p99_slo_ms else None,
+        report_file=f"{test_file}_{function_id}_nyckel_load.json",
+    )
 
 
 if __name__ == "__main__":
@@ -0,0 +1,174 @@
+import concurrent.futures
+import queue
+import threading
+import time
+from dataclasses import dataclass
+from typing import Any, List, Sequence
+
+import numpy as np
+
+from .sample import Sample
+
+
+class BatchingInvoker:
+    """Groups single invokes into batched calls to providers that support them.
+
+    submit queues a sample and returns a future for its prediction. A collector thread takes queued samples into a
+    batch until it holds max_batch_size samples or max_linger_sec has passed since the first one, then sends the
+    batch with provider.invoke_batch from a thread pool and splits the predictions back to the samples' futures.
+    For providers whose max_batch_size is 1, every sample is sent on its own without lingering, so calls are simply
+    pipelined.
+
+    Usage:
+        with BatchingInvoker(provider, max_batch_size=16) as invoker:
+            futures = [invoker.submit(sample) for sample in samples]
+            predictions = [future.result() for future in futures]
+    """
+
+    def __init__(
+        self,
+        provider,
+        max_batch_size: int = None,
+        max_linger_sec: float = 0.005,
+        max_nbr_concurrent_calls: int = 16,
+    ):
+        """
+        provider: The evaluation.Provider to invoke.
+        max_batch_size: The most samples per call. Defaults to, and is capped at, provider.max_batch_size.
+        max_linger_sec: The longest a sample waits for others to join its batch.
+        max_nbr_concurrent_calls: How many calls are in flight at once.
+        """
+        self._provider = provider
+        self.max_batch_size = min(max_batch_size or provider.max_batch_size, provider.max_batch_size)
+        self._max_linger_sec = max_linger_sec
+        self._queue = queue.Queue()
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_nbr_concurrent_calls)
+        self._thread = threading.Thread(target=self._collect, daemon=True)
+        self._thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def submit(self, sample: Sample) -> concurrent.futures.Future:
+        """Queues a sample. Returns a future for its raw prediction."""
+        future = concurrent.futures.Future()
+        self._queue.put((sample, future))
+        return future
+
+    def close(self):
+        """Sends what is queued and waits for all calls to finish."""
+        self._queue.put(None)
+        self._thread.join()
+        self._executor.shutdown(wait=True)
+
+    def _collect(self):
+        closing = False
+        while not closing:
+            item = self._queue.get()
+            if item is None:
+                return
+            batch = [item]
+            deadline = time.monotonic() + self._max_linger_sec
+            while len(batch) < self.max_batch_size:
+                try:
+                    item = self._queue.get(timeout=max(0.0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+                if item is None:
+                    closing = True
+                    break
+                batch.append(item)
+            self._executor.submit(self._call, batch)
+
+    def _call(self, batch):
+        samples = [sample for sample, _ in batch]
+        try:
+            if len(samples) == 1:
+                predictions = [self._provider.invoke(samples[0])]
+            else:
+                predictions = self._provider.invoke_batch(samples)
+            if len(predictions) != len(samples):
+                raise RuntimeError(f"Got {len(predictions)} predictions for a batch of {len(samples)} samples.")
+        except Exception as err:
+            for _, future in batch:
+                future.set_exception(err)
+            return
+        for (_, future), prediction in zip(batch, predictions):
+            future.set_result(prediction)
+
+
+@dataclass
+class BatchSizeReport:
+
+    batch_size: int
+    samples_per_sec: float
+    p50_latency_sec: float  # From submit to prediction, linger included.
+    p95_latency_sec: float
+
+    def __str__(self):
+        return (
+            f"Batch size {self.batch_size:>4}: {self.samples_per_sec:8.1f} samples/s, "
+            f"p50 {self.p50_latency_sec * 1000:7.1f} ms, p95 {self.p95_latency_sec * 1000:7.1f} ms"
+        )
+
+
+def sweep_batch_sizes(
+    provider,
+    samples: List[Sample],
+    batch_sizes: Sequence[int] = (1, 4, 16, 32),
+    max_linger_sec: float = 0.005,
+    max_nbr_concurrent_calls: int = 16,
+) -> List[BatchSizeReport]:
+    """Measures the throughput and latency of invoking samples at several batch sizes.
+
+    Each batch size runs closed loop, with enough samples outstanding to fill max_nbr_concurrent_calls calls of
+    that size, so the numbers show what a bulk scoring job would see.
+
+    provider: The evaluation.Provider to invoke.
+    samples: The samples to invoke at each batch size.
+    batch_sizes: The batch sizes to try. Sizes above provider.max_batch_size are skipped.
+    max_linger_sec: Passed on to BatchingInvoker.
+    max_nbr_concurrent_calls: Passed on to BatchingInvoker.
+
+    Returns a report per batch size tried.
+    """
+    # Fire passes a single --batch_sizes 16 as an int.
+    batch_sizes = (batch_sizes,) if isinstance(batch_sizes, int) else batch_sizes
+    reports = []
+    for batch_size in batch_sizes:
+        if batch_size > provider.max_batch_size:
+            print(f"Skipping batch size {batch_size}; the provider takes at most {provider.max_batch_size}.")
+            continue
+        outstanding = threading.Semaphore(batch_size * max_nbr_concurrent_calls)
+        latencies: List[Any] = [None] * len(samples)
+
+        def _done(index, t0):
+            def _record(future):
+                latencies[index] = time.perf_counter() - t0
+                outstanding.release()
+
+            return _record
+
+        t_start = time.perf_counter()
+        with BatchingInvoker(provider, batch_size, max_linger_sec, max_nbr_concurrent_calls) as invoker:
+            futures = []
+            for index, sample in enumerate(samples):
+                outstanding.acquire()
+                future = invoker.submit(sample)
+                future.add_done_callback(_done(index, time.perf_counter()))
+                futures.append(future)
+        wall_sec = time.perf_counter() - t_start
+        for future in futures:
+            future.result()
+        report = BatchSizeReport(
+            batch_size=batch_size,
+            samples_per_sec=len(samples) / wall_sec,
+            p50_latency_sec=float(np.percentile(latencies, 50)),
+            p95_latency_sec=float(np.percentile(latencies, 95)),
+        )
+        print(report)
+        reports.append(report)
+    return reports
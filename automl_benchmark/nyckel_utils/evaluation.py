@@ -0,0 +1,250 @@
+import concurrent.futures
+import itertools
+import json
+import os
+import time
+from dataclasses import dataclass
+from typing import Any, Dict, List
+
+from tqdm import tqdm
+
+from .batching import BatchingInvoker
+from .prediction_cache import PredictionCache
+from .sample import Sample
+
+
+class Provider:
+    """Adapts a model behind some API to the evaluation engine. Subclasses implement invoke and label_name.
+
+    invoke is called from several threads at once, unless the evaluation runs sequentially. Providers whose API
+    takes several samples per call also set max_batch_size and implement invoke_batch. Predictions are only cached
+    for providers that set name and model_id.
+    """
+
+    max_batch_size = 1  # The most samples invoke_batch takes in one call.
+    name: str = None  # The provider, such as "nyckel".
+    model_id: str = None  # The model invoked, unique within the provider.
+
+    def invoke(self, sample: Sample) -> Any:
+        """Sends the sample to the model and returns its raw, JSON-serializable prediction."""
+        raise NotImplementedError
+
+    def invoke_batch(self, samples: List[Sample]) -> List[Any]:
+        """Sends the samples to the model in one call and returns their raw predictions, in the same order."""
+        return [self.invoke(sample) for sample in samples]
+
+    def label_name(self, prediction: Any) -> str:
+        """Reads the predicted label name from a raw prediction."""
+        raise NotImplementedError
+
+
+@dataclass
+class EvaluationResult:
+
+    predictions: List[Any]  # Raw predictions, in test set order.
+    invoke_times: List[float]  # Seconds per invoke, retries included, in test set order.
+    accuracy: float
+
+
+def evaluate_provider(
+    provider: Provider,
+    samples: List[Sample],
+    preds_file: str,
+    invoke_times_file: str,
+    max_nbr_concurrent_requests: int = 16,
+    sequential: bool = False,
+    max_batch_size: int = 1,
+    max_linger_sec: float = 0.005,
+    cache_file: str = None,
+    bypass_cache: bool = False,
+) -> EvaluationResult:
+    """Invokes a model on every test sample and scores its predictions.
+
+    Invokes run in a thread pool, and their results are appended in test set order to a JSON lines checkpoint next
+    to preds_file as they complete, so an interrupted evaluation resumes where it stopped when run again. When all
+    samples are done, the predictions and the invoke times are written to preds_file and invoke_times_file as JSON
+    lists, and the checkpoint is renamed to end in .done.jsonl, so the next run starts over with its own options.
+    Invoke times are measured with a monotonic clock.
+
+    With max_batch_size above 1, samples are grouped into batched calls by a BatchingInvoker. Invoke times then run
+    from when a sample was queued to when its batch returned, so they include the time spent lingering.
+
+    With a cache_file, samples the model has predicted before are not invoked again; their prediction and original
+    invoke time are taken from the cache, and their checkpoint records are marked as cached. New predictions are
+    added to the cache.
+
+    provider: The model to evaluate.
+    samples: The test samples. label_name is the ground truth.
+    preds_file: Where to write the predictions.
+    invoke_times_file: Where to write the invoke times.
+    max_nbr_concurrent_requests: How many invokes are in flight at once.
+    sequential: If set, invokes are sent one at a time, so their times are not affected by each other.
+    max_batch_size: The most samples per call. Capped at provider.max_batch_size.
+    max_linger_sec: The longest a sample waits for others to join its batch.
+    cache_file: The PredictionCache file to look up and store predictions in.
+    bypass_cache: If set, every sample is invoked, as when measuring latency, and the cache is only written to.
+
+    Returns the predictions, the invoke times and the accuracy.
+    """
+    checkpoint_file = os.path.splitext(preds_file)[0] + ".jsonl"
+    records = _read_checkpoint(checkpoint_file, samples)
+    if records:
+        print(f"Resuming from {checkpoint_file} with {len(records)} of {len(samples)} samples done.")
+    remaining = list(enumerate(samples))[len(records) :]
+    if cache_file and provider.model_id is None:
+        raise ValueError(f"{type(provider).__name__} has no model_id, so its predictions can not be cached.")
+    cache = PredictionCache(cache_file) if cache_file else None
+    cached_records = {} if cache is None or bypass_cache else _cached_records(cache, provider, remaining)
+    if cached_records:
+        print(f"Found {len(cached_records)} of {len(remaining)} remaining predictions in the cache.")
+    with open(checkpoint_file, "a") as checkpoint, tqdm(total=len(samples), initial=len(records)) as progress:
+
+        def _write(record):
+            checkpoint.write(json.dumps(record) + "\n")
+            checkpoint.flush()
+            records.append(record)
+            progress.update()
+            if cache is not None and not record.get("cached"):
+                sample = samples[record["index"]]
+                cache.put(provider.name, provider.model_id, sample.data, record["prediction"], record["invoke_sec"])
+
+        try:
+            if sequential or max_nbr_concurrent_requests <= 1:
+                for index, sample in remaining:
+                    _write(cached_records.get(index) or _invoke(provider, index, sample))
+            elif min(max_batch_size, provider.max_batch_size) > 1:
+                with BatchingInvoker(provider, max_batch_size, max_linger_sec, max_nbr_concurrent_requests) as invoker:
+                    window = invoker.max_batch_size * max_nbr_concurrent_requests
+                    _invoke_concurrently(
+                        lambda index, sample: _completed(cached_records.get(index))
+                        or _submit_batched(invoker, provider, index, sample),
+                        remaining,
+                        window,
+                        _write,
+                    )
+            else:
+                with concurrent.futures.ThreadPoolExecutor(max_workers=max_nbr_concurrent_requests) as executor:
+                    _invoke_concurrently(
+                        lambda index, sample: _completed(cached_records.get(index))
+                        or executor.submit(_invoke, provider, index, sample),
+                        remaining,
+                        max_nbr_concurrent_requests,
+                        _write,
+                    )
+        finally:
+            if cache is not None:
+                cache.close()
+
+    predictions = [record["prediction"] for record in records]
+    invoke_times = [record["invoke_sec"] for record in records]
+    with open(preds_file, "w") as f:
+        json.dump(predictions, f, indent=2)
+    with open(invoke_times_file, "w") as f:
+        json.dump(invoke_times, f, indent=2)
+    os.replace(checkpoint_file, os.path.splitext(preds_file)[0] + ".done.jsonl")
+    n_correct = sum(record["label_name"] == sample.label_name for record, sample in zip(records, samples))
+    return EvaluationResult(predictions, invoke_times, n_correct / max(len(records), 1))
+
+
+def _invoke(provider: Provider, index: int, sample: Sample) -> Dict[str, Any]:
+    t0 = time.perf_counter()
+    prediction = provider.invoke(sample)
+    invoke_sec = time.perf_counter() - t0
+    return _record(provider, index, sample, prediction, invoke_sec)
+
+
+def _record(provider: Provider, index: int, sample: Sample, prediction: Any, invoke_sec: float) -> Dict[str, Any]:
+    return {
+        "index": index,
+        "id": sample.id,
+        "prediction": prediction,
+        "label_name": provider.label_name(prediction),
+        "invoke_sec": invoke_sec,
+    }
+
+
+def _cached_records(cache: PredictionCache, provider: Provider, indexed_samples) -> Dict[int, Dict[str, Any]]:
+    cached_records = {}
+    for index, sample in indexed_samples:
+        cached = cache.get(provider.name, provider.model_id, sample.data)
+        if cached is not None:
+            record = _record(provider, index, sample, cached.prediction, cached.invoke_sec)
+            cached_records[index] = {**record, "cached": True}
+    return cached_records
+
+
+def _completed(record: Dict[str, Any]) -> concurrent.futures.Future:
+    """Wraps a record that needs no invoke in a resolved future, or returns None if there is no record."""
+    if record is None:
+        return None
+    future = concurrent.futures.Future()
+    future.set_result(record)
+    return future
+
+
+def _submit_batched(invoker, provider, index, sample) -> concurrent.futures.Future:
+    """Queues a sample on the invoker. Returns a future for its checkpoint record."""
+    record_future = concurrent.futures.Future()
+    t0 = time.perf_counter()
+
+    def _done(prediction_future):
+        invoke_sec = time.perf_counter() - t0
+        try:
+            record_future.set_result(_record(provider, index, sample, prediction_future.result(), invoke_sec))
+        except Exception as err:
+            record_future.set_exception(err)
+
+    invoker.submit(sample).add_done_callback(_done)
+    return record_future
+
+
+def _invoke_concurrently(submit, indexed_samples, max_nbr_in_flight, write):
+    """
+    Keeps max_nbr_in_flight invokes in flight and writes their results in order. Results that complete ahead of an
+    earlier one wait in a buffer, which the bounded look-ahead keeps small. submit(index, sample) starts an invoke
+    and returns a future for its record.
+    """
+    indexed_samples = iter(indexed_samples)
+    buffered = {}
+    next_index = None
+    pending = set()
+    for index, sample in itertools.islice(indexed_samples, 2 * max_nbr_in_flight):
+        next_index = index if next_index is None else next_index
+        pending.add(submit(index, sample))
+    while pending:
+        done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+        for future in done:
+            record = future.result()
+            buffered[record["index"]] = record
+        while next_index in buffered:
+            write(buffered.pop(next_index))
+            next_index += 1
+        for index, sample in itertools.islice(indexed_samples, len(done)):
+            pending.add(submit(index, sample))
+
+
+def _read_checkpoint(checkpoint_file: str, samples: List[Sample]) -> List[Dict[str, Any]]:
+    """
+    Reads the results of an earlier, interrupted run. A partly written last line is cut off the file, so appending
+    continues on a clean line.
+    """
+    records = []
+    if not os.path.exists(checkpoint_file):
+        return records
+    valid_bytes = 0
+    with open(checkpoint_file, "rb") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                break
+            if not line.endswith(b"\n"):
+                break
+            index = len(records)
+            if index >= len(samples) or record["id"] != samples[index].id:
+                raise RuntimeError(f"{checkpoint_file} was written for other test samples; move it away to start over.")
+            records.append(record)
+            valid_bytes += len(line)
+    with open(checkpoint_file, "rb+") as f:
+        f.truncate(valid_bytes)
+    return records
@@ -1,14 +1,45 @@
-import multiprocessing
+import concurrent.futures
+import itertools
+import threading
 import time
-from typing import List
+from dataclasses import dataclass
+from typing import Iterable, List
 
-import requests
+import numpy as np
 from joblib import Parallel, delayed
+from tqdm import tqdm
 
+from .journal import UploadJournal
 from .sample import Modality, Sample
 from .requester import Requester
 
 
+@dataclass
+class UploadReport:
+    nbr_samples: int  # Samples posted, each with its annotation.
+    wall_sec: float  # Time from the first post to the last.
+    p50_sample_sec: float  # Median time to post one sample and its annotation.
+    p95_sample_sec: float
+    nbr_skipped: int = 0  # Samples skipped because they were uploaded before.
+
+    def __str__(self):
+        return (
+            f"Uploaded {self.nbr_samples} samples in {self.wall_sec:.1f} seconds "
+            f"({self.nbr_samples / max(self.wall_sec, 1e-9):.1f} samples/s, "
+            f"p50 {self.p50_sample_sec:.2f} s, p95 {self.p95_sample_sec:.2f} s per sample). "
+            f"Skipped {self.nbr_skipped} samples uploaded before."
+        )
+
+
+def has_trained_model(requester: Requester, function_id: str) -> bool:
+    """Tells whether a function has at least one fully trained model."""
+    resp = requester("get", f"functions/{function_id}/models")
+    for model_dict in resp.json():
+        if model_dict["trainingPercentage"] == 100:
+            return True
+    return False
+
+
 class FunctionBuilder:
     def __init__(
         self,
@@ -18,12 +49,12 @@ class FunctionBuilder:
         project_id: str = None,
         description: str = "",
         is_public: bool = False,
+        journal: UploadJournal = None,
     ):
-
         self.requester = requester
 
         if not project_id:
-            resp = self.requester(requests.get, "projects").json()
+            resp = self.requester("get", "projects").json()
             if len(resp) < 1:
                 project_id = self._post_project()
                 print(f"No project found for this account. Project id {project_id} created.")
@@ -33,22 +64,126 @@ class FunctionBuilder:
                 project_id = resp[0]["id"]
                 print(f"Found more than 1 project associated with the credentials. Using {project_id}.")
 
-        self.function_id = self._post_function(name, input_modality, description, is_public, project_id)
+        function_id = self._post_function(name, input_modality, description, is_public, project_id)
+        self._init_state(requester, function_id, journal)
+        print(f"Initialized {self.requester.host}console/functions/{self.function_id}/train")
+        if journal:
+            print(f"Recording uploads in {journal.path}. Resume with FunctionBuilder.resume({function_id!r}, ...).")
+
+    @classmethod
+    def resume(cls, function_id: str, journal: UploadJournal, requester: Requester) -> "FunctionBuilder":
+        """Picks up an upload to an existing function where it stopped.
+
+        Samples and annotations the journal records as posted are not posted again by upload. Samples whose post
+        started but was never recorded as done are looked up in one listing of the function's samples, so those
+        that did reach the server are not posted twice. Labels are read from the server.
+
+        function_id: The function the upload was going to.
+        journal: The journal the upload was recorded in. Further uploads are recorded in it too.
+        requester: The requester to talk to the server with.
+
+        Returns the builder, ready for upload.
+        """
+        builder = cls.__new__(cls)
+        builder._init_state(requester, function_id, journal)
+        state = journal.load(function_id)
+        if state.uncertain_external_ids:
+            print(f"Checking {len(state.uncertain_external_ids)} samples whose upload was interrupted...")
+            for server_sample in builder._list_samples():
+                if server_sample.get("externalId") in state.uncertain_external_ids:
+                    state.sample_id_by_external_id[server_sample["externalId"]] = server_sample["id"]
+        for external_id, server_sample_id in state.sample_id_by_external_id.items():
+            builder.local_id_to_server_id[external_id] = server_sample_id
+            builder.server_id_to_local_id[server_sample_id] = external_id
+        builder.annotated_sample_ids = state.annotated_external_ids
+        for label in requester("get", f"functions/{function_id}/labels").json():
+            builder.label_name_to_id[label["name"]] = label["id"]
+        print(
+            f"Resuming {requester.host}console/functions/{function_id}/train with {builder.nbr_samples} samples "
+            f"and {builder.nbr_annotations} annotations uploaded."
+        )
+        return builder
+
+    def _init_state(self, requester, function_id, journal):
+        self.requester = requester
+        self.function_id = function_id
+        self.journal = journal
         self.local_id_to_server_id = dict()
         self.server_id_to_local_id = dict()
         self.annotated_sample_ids = set()
         self.label_name_to_id = dict()
-        print(f"Initialized {self.requester.host}console/functions/{self.function_id}/train")
+        self._label_lock = threading.Lock()
 
     def add_label(self, name: str, description: str = ""):
         label_id = self.requester(
-            requests.post, f"functions/{self.function_id}/labels", json={"name": name, "description": description}
+            "post", f"functions/{self.function_id}/labels", json={"name": name, "description": description}
         ).json()["id"]
         self.label_name_to_id[name] = label_id
 
+    def add_labels(self, names: Iterable[str]):
+        """Creates labels concurrently. Labels that exist already are skipped."""
+        names = [name for name in set(names) if name not in self.label_name_to_id]
+        Parallel(n_jobs=self.requester.concurrency_limiter.max_limit, prefer="threads")(
+            delayed(self.add_label)(name) for name in names
+        )
+
+    def upload(self, samples: Iterable[Sample], max_nbr_queued_samples: int = None) -> UploadReport:
+        """Posts samples and their annotations in one pipeline.
+
+        Each sample's annotation is posted as soon as its sample ID comes back, while other samples are still being
+        posted, so there is no barrier between samples and annotations, or between splits passed in one iterable.
+        Labels that do not exist yet are created on first use. Samples that are annotated already, such as those
+        of an earlier upload that is being resumed, are skipped.
+
+        samples: The samples to post, read lazily.
+        max_nbr_queued_samples: The most samples read ahead of the ones posted. Defaults to twice the maximum number
+            of concurrent requests.
+
+        Returns a report of the upload.
+        """
+        max_nbr_workers = self.requester.concurrency_limiter.max_limit
+        max_nbr_queued_samples = max_nbr_queued_samples or 2 * max_nbr_workers
+        nbr_skipped = 0
+
+        def _not_annotated(samples):
+            nonlocal nbr_skipped
+            for sample in samples:
+                if sample.id in self.annotated_sample_ids:
+                    nbr_skipped += 1
+                else:
+                    yield sample
+
+        samples = _not_annotated(samples)
+        sample_seconds = []
+        t0 = time.perf_counter()
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_nbr_workers) as executor, tqdm(
+            desc="Uploading", unit="sample"
+        ) as progress:
+            pending = {
+                executor.submit(self._post_sample_and_annotation, sample)
+                for sample in itertools.islice(samples, max_nbr_queued_samples)
+            }
+            while pending:
+                done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    sample, server_sample_id, seconds = future.result()
+                    self.local_id_to_server_id[sample.id] = server_sample_id
+                    self.server_id_to_local_id[server_sample_id] = sample.id
+                    self.annotated_sample_ids.add(sample.id)
+                    sample_seconds.append(seconds)
+                progress.update(len(done))
+                for sample in itertools.islice(samples, len(done)):
+                    pending.add(executor.submit(self._post_sample_and_annotation, sample))
+        return UploadReport(
+            nbr_samples=len(sample_seconds),
+            wall_sec=time.perf_counter() - t0,
+            p50_sample_sec=float(np.percentile(sample_seconds, 50)) if sample_seconds else 0.0,
+            p95_sample_sec=float(np.percentile(sample_seconds, 95)) if sample_seconds else 0.0,
+            nbr_skipped=nbr_skipped,
+        )
+
     def add_samples(self, samples: List[Sample]):
-        cpu_count = multiprocessing.cpu_count()
-        sample_ids = Parallel(n_jobs=cpu_count, prefer="threads")(
+        sample_ids = Parallel(n_jobs=self.requester.concurrency_limiter.max_limit, prefer="threads")(
             delayed(self._post_sample)(sample) for sample in samples
         )
         for sample, server_sample_id in zip(samples, sample_ids):
@@ -56,8 +191,9 @@ class FunctionBuilder:
             self.server_id_to_local_id[server_sample_id] = sample.id
 
     def add_annotations(self, samples: List[Sample]):
-        cpu_count = multiprocessing.cpu_count()
-        Parallel(n_jobs=cpu_count, prefer="threads")(delayed(self._post_annotation)(sample) for sample in samples)
+        Parallel(n_jobs=self.requester.concurrency_limiter.max_limit, prefer="threads")(
+            delayed(self._post_annotation)(sample) for sample in samples
+        )
         self.annotated_sample_ids |= set([sample.id for sample in samples])
 
     @property
@@ -69,15 +205,19 @@ class FunctionBuilder:
         return len(self.annotated_sample_ids)
 
     def has_model(self):
-        resp = self.requester(requests.get, f"functions/{self.function_id}/models")
-        for model_dict in resp.json():
-            if model_dict["trainingPercentage"] == 100:
-                return True
-        return False
+        return has_trained_model(self.requester, self.function_id)
+
+    def sleep_until_has_at_least_one_model(self, poll_interval_sec=1, max_poll_interval_sec=30, timeout_sec=None):
+        """Polls until the function has a trained model, doubling the interval up to max_poll_interval_sec.
 
-    def sleep_until_has_at_least_one_model(self, poll_interval_sec=1):
+        Raises TimeoutError if there is no model after timeout_sec.
+        """
+        t0 = time.monotonic()
         while not self.has_model():
+            if timeout_sec is not None and time.monotonic() - t0 > timeout_sec:
+                raise TimeoutError(f"Function {self.function_id} has no trained model after {timeout_sec} seconds.")
             time.sleep(poll_interval_sec)
+            poll_interval_sec = min(max_poll_interval_sec, poll_interval_sec * 2)
 
     def _post_sample(self, sample):
         if sample.modality.name == "Text":
@@ -87,30 +227,64 @@ class FunctionBuilder:
         else:
             raise ValueError(f"Unknown modality: {sample.modality}")
 
-        return self.requester(
-            requests.post,
+        if self.journal:
+            self.journal.record(self.function_id, "posting_sample", sample.id)
+        server_sample_id = self.requester(
+            "post",
             f"functions/{self.function_id}/samples",
             json={
                 "externalId": sample.id,
                 "input": {"modality": sample.modality.name, "inlineData": inline_data, "referenceUrl": ""},
             },
         ).json()["id"]
+        if self.journal:
+            self.journal.record(self.function_id, "posted_sample", sample.id, server_sample_id)
+        return server_sample_id
 
     def _post_annotation(self, sample):
         assert sample.id in self.local_id_to_server_id, f"Need to post sample first for id {sample.id}"
+        self._post_annotation_for(sample, self.local_id_to_server_id[sample.id])
+
+    def _post_annotation_for(self, sample, server_sample_id):
         self.requester(
-            requests.post,
+            "post",
             f"functions/{self.function_id}/annotations",
-            json={
-                "sampleId": self.local_id_to_server_id[sample.id],
-                "labelId": self.label_name_to_id[sample.label_name],
-                "source": "User",
-            },
+            json={"sampleId": server_sample_id, "labelId": self._label_id(sample.label_name), "source": "User"},
         )
+        if self.journal:
+            self.journal.record(self.function_id, "posted_annotation", sample.id, server_sample_id)
+
+    def _post_sample_and_annotation(self, sample):
+        t0 = time.perf_counter()
+        server_sample_id = self.local_id_to_server_id.get(sample.id)
+        if server_sample_id is None:
+            server_sample_id = self._post_sample(sample)
+        self._post_annotation_for(sample, server_sample_id)
+        return sample, server_sample_id, time.perf_counter() - t0
+
+    def _label_id(self, name):
+        if name not in self.label_name_to_id:
+            with self._label_lock:
+                if name not in self.label_name_to_id:
+                    self.add_label(name)
+        return self.label_name_to_id[name]
+
+    def _list_samples(self, batch_size=1000):
+        """Yields every sample of the function, as the server lists them, a batch at a time."""
+        end = None
+        while True:
+            params = {"batchSize": batch_size}
+            if end:
+                params["end"] = end
+            batch = self.requester("get", f"functions/{self.function_id}/samples", params=params).json()
+            yield from batch
+            if len(batch) < batch_size:
+                return
+            end = batch[-1]["id"]
 
     def _post_function(self, name, input_modality, description, is_public, project_id):
         function_id = self.requester(
-            requests.post,
+            "post",
             "functions",
             json={
                 "projectId": project_id,
@@ -123,7 +297,5 @@ class FunctionBuilder:
         return function_id
 
     def _post_project(self):
-        project_id = self.requester(requests.post, "projects", json={"name": "Auto-generated", "admins": []}).json()[
-            "id"
-        ]
+        project_id = self.requester("post", "projects", json={"name": "Auto-generated", "admins": []}).json()["id"]
         return project_id
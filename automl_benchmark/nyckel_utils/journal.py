@@ -0,0 +1,69 @@
+import json
+import os
+import threading
+from dataclasses import dataclass, field
+from typing import Dict, Set
+
+
+@dataclass
+class JournalState:
+
+    sample_id_by_external_id: Dict[str, str] = field(default_factory=dict)  # Samples known to be posted.
+    annotated_external_ids: Set[str] = field(default_factory=set)  # Samples known to be annotated.
+    uncertain_external_ids: Set[str] = field(default_factory=set)  # Samples whose post started but never finished.
+
+
+class UploadJournal:
+    """Append-only record of the samples and annotations posted to functions, one JSON object per line.
+
+    Every sample post is recorded before it is sent and after it succeeds, and every annotation after it succeeds,
+    keyed by function ID and the sample's externalId. A crashed upload can then be resumed with
+    FunctionBuilder.resume, which skips what the journal shows as done. A post that started but was never recorded
+    as done may or may not have reached the server; those are checked against the server before resuming.
+
+    Writes from several threads are serialized, and each line is flushed as it is written, so at most the line
+    being written when the process dies is lost. Set fsync to also survive a machine crash, at the cost of a disk
+    sync per line.
+    """
+
+    def __init__(self, path: str, fsync: bool = False):
+        self.path = path
+        self._fsync = fsync
+        self._lock = threading.Lock()
+        self._file = open(path, "a")
+
+    def record(self, function_id: str, event: str, external_id: str, sample_id: str = None):
+        """Appends an event: "posting_sample", "posted_sample" with the sample_id, or "posted_annotation"."""
+        line = json.dumps({"functionId": function_id, "event": event, "externalId": external_id, "sampleId": sample_id})
+        with self._lock:
+            self._file.write(line + "\n")
+            self._file.flush()
+            if self._fsync:
+                os.fsync(self._file.fileno())
+
+    def load(self, function_id: str) -> JournalState:
+        """Reads back what was recorded for a function. A truncated last line, from a crash mid-write, is skipped."""
+        state = JournalState()
+        started = set()
+        with self._lock:
+            self._file.flush()
+            with open(self.path) as lines:
+                for line in lines:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue
+                    if entry["functionId"] != function_id:
+                        continue
+                    if entry["event"] == "posting_sample":
+                        started.add(entry["externalId"])
+                    elif entry["event"] == "posted_sample":
+                        state.sample_id_by_external_id[entry["externalId"]] = entry["sampleId"]
+                    elif entry["event"] == "posted_annotation":
+                        state.annotated_external_ids.add(entry["externalId"])
+        state.uncertain_external_ids = started - set(state.sample_id_by_external_id)
+        return state
+
+    def close(self):
+        with self._lock:
+            self._file.close()
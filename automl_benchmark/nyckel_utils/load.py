@@ -0,0 +1,286 @@
+import concurrent.futures
+import itertools
+import json
+import math
+import random
+import threading
+import time
+from dataclasses import asdict, dataclass
+from typing import Dict, List, Sequence, Tuple
+
+from .sample import Sample
+
+
+class LatencyHistogram:
+    """Counts latencies in log-linear buckets, HDR histogram style.
+
+    Latencies are kept in microseconds. Below 128 us every value has its own bucket; above, every power of two is
+    split into 64 buckets, so any recorded value is known to within 1/64 (about 1.6%) whatever its magnitude, and
+    the histogram stays a few hundred buckets large however many values it holds. Recording is thread safe.
+    """
+
+    _SUB_BUCKET_BITS = 7  # 128 sub-buckets, the upper 64 of which are used above the first power of two.
+
+    def __init__(self):
+        self._counts: Dict[int, int] = {}
+        self._lock = threading.Lock()
+        self.count = 0
+        self.max_sec = 0.0
+        self._total_sec = 0.0
+
+    def record(self, latency_sec: float):
+        index = self._index(max(0, int(latency_sec * 1e6)))
+        with self._lock:
+            self._counts[index] = self._counts.get(index, 0) + 1
+            self.count += 1
+            self.max_sec = max(self.max_sec, latency_sec)
+            self._total_sec += latency_sec
+
+    def mean_sec(self) -> float:
+        return self._total_sec / self.count if self.count else 0.0
+
+    def percentile_sec(self, percentile: float) -> float:
+        """The latency below which percentile percent of the values fall, rounded up to the bucket's upper bound."""
+        with self._lock:
+            if not self.count:
+                return 0.0
+            rank = max(1, math.ceil(percentile / 100 * self.count))
+            seen = 0
+            for index in sorted(self._counts):
+                seen += self._counts[index]
+                if seen >= rank:
+                    return min(self._upper_bound_us(index) / 1e6, self.max_sec)
+        return self.max_sec
+
+    def buckets(self) -> Dict[float, int]:
+        """Maps the upper bound of every non-empty bucket, in seconds, to its count."""
+        with self._lock:
+            return {self._upper_bound_us(index) / 1e6: count for index, count in sorted(self._counts.items())}
+
+    @classmethod
+    def _index(cls, value_us: int) -> int:
+        sub_bucket_count = 1 << cls._SUB_BUCKET_BITS
+        if value_us < sub_bucket_count:
+            return value_us
+        shift = value_us.bit_length() - cls._SUB_BUCKET_BITS
+        return sub_bucket_count + (shift - 1) * (sub_bucket_count // 2) + (value_us >> shift) - sub_bucket_count // 2
+
+    @classmethod
+    def _upper_bound_us(cls, index: int) -> int:
+        sub_bucket_count = 1 << cls._SUB_BUCKET_BITS
+        if index < sub_bucket_count:
+            return index
+        shift, sub_index = divmod(index - sub_bucket_count, sub_bucket_count // 2)
+        shift += 1
+        return ((sub_index + sub_bucket_count // 2 + 1) << shift) - 1
+
+
+@dataclass
+class LoadStepReport:
+
+    target_qps: float
+    offered_qps: float  # The rate requests were actually scheduled at, which varies around the target for Poisson.
+    achieved_qps: float  # Successful invokes per second, over the time from the first send to the last response.
+    nbr_sent: int
+    nbr_errors: int
+    nbr_dropped: int  # Scheduled but never sent, because the step was stopped for falling too far behind.
+    mean_sec: float  # Latencies run from the scheduled send time, so time spent waiting to be sent counts.
+    p50_sec: float
+    p90_sec: float
+    p99_sec: float
+    p999_sec: float
+    max_sec: float
+    saturated: bool
+
+    def __str__(self):
+        ms = [f"{1000 * sec:8.1f}" for sec in (self.p50_sec, self.p90_sec, self.p99_sec, self.p999_sec, self.max_sec)]
+        return (
+            f"{self.target_qps:8.1f} {self.offered_qps:8.1f} {self.achieved_qps:8.1f} "
+            f"{self.nbr_sent:7} {self.nbr_errors:6} {self.nbr_dropped:7} {' '.join(ms)}"
+            f"  {'SATURATED' if self.saturated else ''}"
+        )
+
+
+_HEADER = (
+    f"{'target':>8} {'offered':>8} {'achieved':>8} {'sent':>7} {'errors':>6} {'dropped':>7} "
+    f"{'p50 ms':>8} {'p90 ms':>8} {'p99 ms':>8} {'p99.9 ms':>8} {'max ms':>8}"
+)
+
+
+def run_load_step(
+    provider,
+    samples: List[Sample],
+    qps: float,
+    duration_sec: float,
+    arrivals: str = "poisson",
+    max_nbr_concurrent_requests: int = 64,
+    max_backlog: int = None,
+    rng: random.Random = None,
+) -> Tuple[LoadStepReport, LatencyHistogram]:
+    """Invokes samples at a fixed request rate, open loop, and measures the latencies.
+
+    Send times are scheduled up front, independently of how fast responses come back: evenly spaced for constant
+    arrivals, or with exponentially distributed gaps for Poisson arrivals. Latency is measured from the scheduled
+    send time, not from when the request actually went out, so a slow response that holds up later requests is
+    charged to them too instead of hiding them (coordinated omission). When more than max_backlog requests are
+    waiting for a free connection, the step is stopped and the rest of its requests are counted as dropped.
+
+    provider: The evaluation.Provider to invoke.
+    samples: The samples to send, cycled through as many times as needed.
+    qps: The target request rate.
+    duration_sec: How long to schedule requests for.
+    arrivals: "poisson" or "constant".
+    max_nbr_concurrent_requests: How many requests may be in flight at once.
+    max_backlog: How many requests may wait to be sent before the step is stopped. Defaults to
+        4 * max_nbr_concurrent_requests.
+    rng: The random generator for Poisson gaps.
+
+    Returns the step's report and latency histogram.
+    """
+    if arrivals not in ("poisson", "constant"):
+        raise ValueError(f"Unknown arrivals {arrivals}; use poisson or constant.")
+    max_backlog = max_backlog or 4 * max_nbr_concurrent_requests
+    rng = rng or random.Random()
+    histogram = LatencyHistogram()
+    lock = threading.Lock()
+    counts = {"in_flight": 0, "errors": 0, "dropped": 0}
+    last_response = [0.0]
+    stopped = threading.Event()
+
+    def _send(sample, scheduled):
+        try:
+            if stopped.is_set():
+                with lock:
+                    counts["dropped"] += 1
+                return
+            try:
+                provider.invoke(sample)
+            except Exception as err:
+                print(f"Invoke failed. Err: {err}")
+                with lock:
+                    counts["errors"] += 1
+                return
+            now = time.perf_counter()
+            histogram.record(now - scheduled)
+            with lock:
+                last_response[0] = max(last_response[0], now)
+        finally:
+            with lock:
+                counts["in_flight"] -= 1
+
+    nbr_scheduled = 0
+    start = time.perf_counter()
+    scheduled = start
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_nbr_concurrent_requests) as executor:
+        for sample in itertools.cycle(samples):
+            scheduled += rng.expovariate(qps) if arrivals == "poisson" else 1 / qps
+            if scheduled - start >= duration_sec:
+                break
+            delay_sec = scheduled - time.perf_counter()
+            if delay_sec > 0:
+                time.sleep(delay_sec)
+            with lock:
+                backlog = counts["in_flight"] - max_nbr_concurrent_requests
+            if backlog > max_backlog:
+                print(f"More than {max_backlog} requests are waiting to be sent at {qps} QPS; stopping the step.")
+                stopped.set()
+                break
+            with lock:
+                counts["in_flight"] += 1
+            executor.submit(_send, sample, scheduled)
+            nbr_scheduled += 1
+    nbr_unscheduled = int(qps * duration_sec) - nbr_scheduled if stopped.is_set() else 0
+
+    nbr_dropped = counts["dropped"] + max(0, nbr_unscheduled)
+    elapsed_sec = max(last_response[0] - start, 1e-9)
+    report = LoadStepReport(
+        target_qps=qps,
+        offered_qps=(nbr_scheduled + max(0, nbr_unscheduled)) / duration_sec,
+        achieved_qps=histogram.count / elapsed_sec,
+        nbr_sent=nbr_scheduled - counts["dropped"],
+        nbr_errors=counts["errors"],
+        nbr_dropped=nbr_dropped,
+        mean_sec=histogram.mean_sec(),
+        p50_sec=histogram.percentile_sec(50),
+        p90_sec=histogram.percentile_sec(90),
+        p99_sec=histogram.percentile_sec(99),
+        p999_sec=histogram.percentile_sec(99.9),
+        max_sec=histogram.max_sec,
+        saturated=False,
+    )
+    return report, histogram
+
+
+def ramp_load(
+    provider,
+    samples: List[Sample],
+    qps_steps: Sequence[float] = (1, 2, 5, 10, 20, 50),
+    step_duration_sec: float = 30.0,
+    arrivals: str = "poisson",
+    max_nbr_concurrent_requests: int = 64,
+    p99_slo_sec: float = None,
+    nbr_warmup_requests: int = 10,
+    report_file: str = None,
+    seed: int = None,
+) -> List[LoadStepReport]:
+    """Runs open-loop load steps at increasing request rates and reports where the provider saturates.
+
+    A step counts as saturated when it delivers less than 90% of the rate it was offered, more than 1% of its
+    requests fail or are dropped, or, if p99_slo_sec is set, its p99 latency exceeds it. The ramp stops after the
+    first saturated step, and the highest unsaturated rate is reported as the saturation point.
+
+    provider: The evaluation.Provider to invoke.
+    samples: The samples to send.
+    qps_steps: The request rates to run, in increasing order.
+    step_duration_sec: How long each step schedules requests for.
+    arrivals: "poisson" or "constant".
+    max_nbr_concurrent_requests: How many requests may be in flight at once.
+    p99_slo_sec: The p99 latency above which a step counts as saturated.
+    nbr_warmup_requests: Requests sent one at a time before the first step, so connection setup is not measured.
+    report_file: If set, the step reports and their latency histograms are written here as JSON.
+    seed: Seeds the Poisson arrivals, for repeatable schedules.
+
+    Returns a report per step run.
+    """
+    # Fire passes a single --qps_steps 10 as a number.
+    qps_steps = (qps_steps,) if isinstance(qps_steps, (int, float)) else tuple(qps_steps)
+    if not qps_steps:
+        raise ValueError("qps_steps is empty; give at least one request rate to run.")
+    rng = random.Random(seed)
+    for sample in samples[:nbr_warmup_requests]:
+        provider.invoke(sample)
+
+    print(_HEADER)
+    reports, histograms = [], []
+    for qps in qps_steps:
+        report, histogram = run_load_step(
+            provider, samples, qps, step_duration_sec, arrivals, max_nbr_concurrent_requests, rng=rng
+        )
+        nbr_scheduled = report.nbr_sent + report.nbr_dropped
+        report.saturated = (
+            report.achieved_qps < 0.9 * report.offered_qps
+            or report.nbr_errors + report.nbr_dropped > 0.01 * max(nbr_scheduled, 1)
+            or (p99_slo_sec is not None and report.p99_sec > p99_slo_sec)
+        )
+        print(report)
+        reports.append(report)
+        histograms.append(histogram)
+        if report.saturated:
+            break
+
+    unsaturated = [report.target_qps for report in reports if not report.saturated]
+    if not reports[-1].saturated:
+        print(f"Not saturated at {reports[-1].target_qps} QPS; add higher steps to find the saturation point.")
+    elif unsaturated:
+        print(f"Saturation point: {max(unsaturated)} QPS. Saturated at {reports[-1].target_qps} QPS.")
+    else:
+        print(f"Saturated already at {reports[-1].target_qps} QPS; add lower steps to find the saturation point.")
+
+    if report_file:
+        with open(report_file, "w") as f:
+            steps = [
+                {**asdict(report), "histogram": [[upper, count] for upper, count in histogram.buckets().items()]}
+                for report, histogram in zip(reports, histograms)
+            ]
+            json.dump({"arrivals": arrivals, "step_duration_sec": step_duration_sec, "steps": steps}, f, indent=2)
+    return reports
@@ -0,0 +1,104 @@
+import concurrent.futures
+import heapq
+import itertools
+import random
+import threading
+import time
+
+from .function import has_trained_model
+from .requester import Requester
+
+
+class TrainingPoller:
+    """Waits for many functions to finish training, polling them all from one thread.
+
+    Each function is polled at an interval that starts at initial_interval_sec and doubles after every poll up to
+    max_interval_sec, with a little jitter, so a sweep of many functions costs a handful of calls per minute rather
+    than one per function per second.
+
+    Usage:
+        with TrainingPoller(requester) as poller:
+            future = poller.watch(function_id)
+            training_sec = future.result()  # Raises TimeoutError if training did not finish in time.
+    """
+
+    def __init__(
+        self,
+        requester: Requester,
+        initial_interval_sec: float = 5.0,
+        max_interval_sec: float = 60.0,
+        timeout_sec: float = 4 * 3600,
+    ):
+        """
+        requester: The requester to poll with.
+        initial_interval_sec: The wait before the first poll of a function.
+        max_interval_sec: The longest wait between polls of a function.
+        timeout_sec: How long after watch a function may take to train before its future fails with TimeoutError.
+        """
+        self._requester = requester
+        self._initial_interval_sec = initial_interval_sec
+        self._max_interval_sec = max_interval_sec
+        self._timeout_sec = timeout_sec
+        self._queue = []  # Heap of (next poll time, sequence number, function ID, interval, start time, future).
+        self._sequence = itertools.count()
+        self._closed = False
+        self._condition = threading.Condition()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def watch(self, function_id: str) -> concurrent.futures.Future:
+        """Starts polling a function.
+
+        Returns a future that resolves to the number of seconds from the call until the model was found trained.
+        """
+        future = concurrent.futures.Future()
+        now = time.monotonic()
+        with self._condition:
+            self._push(now + self._initial_interval_sec, function_id, self._initial_interval_sec, now, future)
+        return future
+
+    def close(self):
+        """Stops polling. Futures that have not resolved yet are cancelled."""
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+        self._thread.join()
+        for *_, future in self._queue:
+            future.cancel()
+
+    def _push(self, poll_at, function_id, interval_sec, started, future):
+        heapq.heappush(self._queue, (poll_at, next(self._sequence), function_id, interval_sec, started, future))
+        self._condition.notify_all()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._closed and (not self._queue or self._queue[0][0] > time.monotonic()):
+                    self._condition.wait(timeout=self._queue[0][0] - time.monotonic() if self._queue else None)
+                if self._closed:
+                    return
+                _, _, function_id, interval_sec, started, future = heapq.heappop(self._queue)
+            try:
+                trained = has_trained_model(self._requester, function_id)
+            except Exception as err:
+                print(f"Polling function {function_id} failed; polling it again later. Err: {err}")
+                trained = False
+            now = time.monotonic()
+            if trained:
+                future.set_result(now - started)
+            elif now - started > self._timeout_sec:
+                future.set_exception(
+                    TimeoutError(f"Function {function_id} has no trained model after {self._timeout_sec} seconds.")
+                )
+            else:
+                interval_sec = min(self._max_interval_sec, interval_sec * 2)
+                with self._condition:
+                    self._push(
+                        now + interval_sec * random.uniform(0.9, 1.1), function_id, interval_sec, started, future
+                    )
@@ -0,0 +1,117 @@
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from typing import Any, NamedTuple, Optional
+
+
+class CachedPrediction(NamedTuple):
+    prediction: Any  # The raw prediction, as the provider returned it.
+    invoke_sec: float  # How long the invoke took when it was made.
+
+
+class PredictionCache:
+    """
+    On-disk record of the predictions of earlier evaluations, so that evaluating the same model on the same test set
+    again costs no API calls.
+
+    Entries live in a SQLite file and are keyed by the provider name, the model ID and the SHA-256 of the input text,
+    so a re-exported test CSV with the same texts still hits. Entries older than max_age_sec are treated as misses
+    and evicted, as are the least recently used entries beyond max_entries. One cache may be shared by the
+    evaluator's threads.
+    """
+
+    def __init__(self, path: str, max_entries: int = 1_000_000, max_age_sec: float = 30 * 24 * 3600):
+        """
+        path: The SQLite file. Created if missing.
+        max_entries: The maximum number of predictions to remember.
+        max_age_sec: How long a prediction stays valid.
+        """
+        self._max_entries = max_entries
+        self._max_age_sec = max_age_sec
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._connection.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS predictions (
+                provider TEXT NOT NULL,
+                model_id TEXT NOT NULL,
+                content_hash TEXT NOT NULL,
+                prediction TEXT NOT NULL,
+                invoke_sec REAL NOT NULL,
+                created REAL NOT NULL,
+                last_used REAL NOT NULL,
+                PRIMARY KEY (provider, model_id, content_hash)
+            );
+            CREATE INDEX IF NOT EXISTS predictions_by_last_used ON predictions (last_used);
+            CREATE INDEX IF NOT EXISTS predictions_by_created ON predictions (created);
+            """
+        )
+        self._connection.commit()
+        self.evict()
+
+    def close(self):
+        self.evict()
+        with self._lock:
+            self._connection.close()
+
+    def get(self, provider: str, model_id: str, text: str) -> Optional[CachedPrediction]:
+        """
+        Looks up the prediction of a model for a text and marks it as used.
+
+        Returns the cached prediction, or None if there is none or it has expired.
+        """
+        key = (provider, model_id, _content_hash(text))
+        now = time.time()
+        with self._lock, self._connection:
+            row = self._connection.execute(
+                "SELECT prediction, invoke_sec FROM predictions "
+                "WHERE provider = ? AND model_id = ? AND content_hash = ? AND created >= ?",
+                (*key, now - self._max_age_sec),
+            ).fetchone()
+            if row is None:
+                return None
+            self._connection.execute(
+                "UPDATE predictions SET last_used = ? WHERE provider = ? AND model_id = ? AND content_hash = ?",
+                (now, *key),
+            )
+        return CachedPrediction(json.loads(row[0]), row[1])
+
+    def put(self, provider: str, model_id: str, text: str, prediction: Any, invoke_sec: float):
+        """
+        Records the prediction of a model for a text, replacing any earlier one.
+        """
+        now = time.time()
+        with self._lock, self._connection:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO predictions "
+                "(provider, model_id, content_hash, prediction, invoke_sec, created, last_used) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (provider, model_id, _content_hash(text), json.dumps(prediction), invoke_sec, now, now),
+            )
+
+    def evict(self) -> int:
+        """
+        Removes expired predictions and the least recently used ones beyond max_entries.
+
+        Returns the number of predictions removed.
+        """
+        with self._lock, self._connection:
+            expired = self._connection.execute(
+                "DELETE FROM predictions WHERE created < ?", (time.time() - self._max_age_sec,)
+            ).rowcount
+            (count,) = self._connection.execute("SELECT COUNT(*) FROM predictions").fetchone()
+            if count <= self._max_entries:
+                return expired
+            self._connection.execute(
+                "DELETE FROM predictions WHERE rowid IN (SELECT rowid FROM predictions ORDER BY last_used LIMIT ?)",
+                (count - self._max_entries,),
+            )
+        return expired + count - self._max_entries
+
+
+def _content_hash(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
@@ -1,10 +1,35 @@
-import requests
-import time
+import gzip
+import json
 import os
 
+import requests
+from requests.adapters import HTTPAdapter
+
+from .concurrency import AdaptiveConcurrencyLimiter, retry_after_seconds
+from .retry import RETRYABLE_EXCEPTIONS, RetryableError, RetryPolicy, ThrottledError, is_retryable_status
+from .token_manager import AccessTokenManager
+
 
 class Requester:
-    """Class to talk to the Server. Manages the OAuth flow and retries in case connection is down."""
+    """Class to talk to the Server. Manages the OAuth flow and retries in case connection is down or throttled.
+
+    Calls that fail with a connection error or a retryable status are retried by a RetryPolicy, with jittered
+    exponential backoff, within the process-wide retry budget. While its circuit breaker has the server marked as
+    down, calls fail at once with CircuitOpenError, without being sent. Throttling (429) does not count towards
+    the breaker. Other failures, such as a 400, raise at once.
+
+    The access token is shared by all threads. It is renewed in the background before it expires, and a token the
+    server rejects is renewed once, however many calls were rejected with it.
+
+    All calls, from any number of threads, share an adaptive concurrency limiter that grows the number of calls in
+    flight while the server keeps up and backs off when it throttles. Size thread pools to max_nbr_concurrent_requests
+    and let the limiter decide how many of them actually send at once.
+
+    Calls go through one session whose keep-alive connection pool holds max_nbr_concurrent_requests connections, so
+    TCP and TLS handshakes are paid once per connection rather than once per call. Callers name the HTTP method:
+
+        requester("post", f"functions/{function_id}/samples", json={...})
+    """
 
     def __init__(
         self,
@@ -13,65 +38,122 @@ class Requester:
         host: str,
         api_version: str,
         nbr_max_attempts=5,
-        attempt_wait_sec=5,
+        retry_policy: RetryPolicy = None,
+        max_nbr_concurrent_requests=64,
+        concurrency_limiter: AdaptiveConcurrencyLimiter = None,
+        http2=False,
+        gzip_request_bodies=False,
+        timeout_sec=60,
     ):
+        """Sets up the connection pool and the concurrency limiter.
+
+        retry_policy: The policy to retry calls with. Defaults to one with nbr_max_attempts attempts.
+        http2: Whether to talk HTTP/2, multiplexing calls over few connections. Needs httpx with the http2 extra.
+        gzip_request_bodies: Whether to gzip JSON request bodies, which mostly pays off for large text or base64
+            image payloads on slow uplinks.
+        timeout_sec: How long to wait for the server to connect or to send data before a call is retried.
+        """
 
         self.client_id = client_id
         self.client_secret = client_secret
         self.host = host
         self.api_version = api_version
-        self._access_token = "Placeholder"
-        self.nbr_max_attempts = nbr_max_attempts
-        self.attempt_wait_sec = attempt_wait_sec
-
-    def __call__(self, request, endpoint: str, **kwargs):
-
+        self.concurrency_limiter = concurrency_limiter or AdaptiveConcurrencyLimiter(
+            initial_limit=min(8, max_nbr_concurrent_requests), max_limit=max_nbr_concurrent_requests
+        )
+        self.gzip_request_bodies = gzip_request_bodies
+        self.timeout_sec = timeout_sec
+        pool_size = self.concurrency_limiter.max_limit
+        if http2:
+            import httpx
+
+            self._session = httpx.Client(
+                http2=True, limits=httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size)
+            )
+            self._body_kwarg = "content"
+            retryable_exceptions = RETRYABLE_EXCEPTIONS + (httpx.TransportError,)
+        else:
+            self._session = requests.Session()
+            self._session.mount("https://", HTTPAdapter(pool_maxsize=pool_size))
+            self._session.mount("http://", HTTPAdapter(pool_maxsize=pool_size))
+            self._body_kwarg = "data"
+            retryable_exceptions = RETRYABLE_EXCEPTIONS
+        self.retry_policy = retry_policy or RetryPolicy(
+            max_attempts=nbr_max_attempts, retryable_exceptions=retryable_exceptions
+        )
+        self._access_tokens = AccessTokenManager(
+            self.host.rstrip("/") + "/connect/token",
+            client_id,
+            client_secret,
+            session=self._session,
+            timeout_sec=timeout_sec,
+        )
+
+    def __call__(self, method: str, endpoint: str, **kwargs):
+        """Sends a call, retrying on connection errors and throttling.
+
+        method: The HTTP method, such as "get" or "post".
+        endpoint: The API endpoint, relative to the API version, such as "functions".
+        kwargs: Passed on to the session, such as json or params.
+
+        Returns the response. Raises the last error if all attempts failed, RuntimeError for a response that is not
+        worth retrying, and CircuitOpenError while the server is marked as down.
+        """
+
+        method = method.upper()
         url = self._get_full_url(endpoint)
-        attempt_counter = 0
-        resp = None
-        while not resp and attempt_counter < self.nbr_max_attempts:
-            try:
-                resp = self._request_with_renewal(request, url, **kwargs)
-            except requests.exceptions.RequestException as err:
-                print(f"Can not access {url} with {request.__name__.upper()} {kwargs}. Err: {err}.")
-                time.sleep(self.attempt_wait_sec)
-            attempt_counter += 1
-        return resp
-
-    def _request_with_renewal(self, request, url, **kwargs):
-
-        kwargs["headers"] = {"authorization": "Bearer " + self._access_token}
-        resp = request(url, **kwargs)
-        if resp.status_code == 401:
-            self._renew_access_token()
-            kwargs["headers"] = {"authorization": "Bearer " + self._access_token}
-            resp = request(url, **kwargs)
+        if self.gzip_request_bodies and "json" in kwargs:
+            kwargs = self._gzipped(kwargs)
+        return self.retry_policy.call(
+            lambda: self._request_with_renewal(method, url, **kwargs), description=f"{method} {url}"
+        )
+
+    def close(self):
+        """Closes the pooled connections and stops renewing the access token."""
+        self._access_tokens.close()
+        self._session.close()
+
+    def _gzipped(self, kwargs):
+        kwargs = dict(kwargs)
+        body = json.dumps(kwargs.pop("json")).encode("utf-8")
+        kwargs[self._body_kwarg] = gzip.compress(body, compresslevel=5)
+        kwargs["headers"] = {
+            **kwargs.get("headers", {}),
+            "Content-Type": "application/json",
+            "Content-Encoding": "gzip",
+        }
+        return kwargs
 
+    def _request_with_renewal(self, method, url, headers=None, **kwargs):
+        kwargs["timeout"] = self.timeout_sec
+        access_token = self._access_tokens.get()
+        kwargs["headers"] = {**(headers or {}), "authorization": "Bearer " + access_token}
+        resp = self.concurrency_limiter.call(self._session.request, method, url, **kwargs)
+        if resp.status_code == 401:
+            # Only the first call to see the stale token renews it; the others wait for that renewal.
+            self._access_tokens.invalidate(access_token)
+            kwargs["headers"] = {**(headers or {}), "authorization": "Bearer " + self._access_tokens.get()}
+            resp = self.concurrency_limiter.call(self._session.request, method, url, **kwargs)
+
+        if resp.status_code == 429:
+            raise ThrottledError(f"Call failed with {resp.status_code}: {resp.text}", retry_after_seconds(resp))
+        if is_retryable_status(resp.status_code):
+            raise RetryableError(f"Call failed with {resp.status_code}: {resp.text}", retry_after_seconds(resp))
         if resp.status_code == 200:
             return resp
         else:
             raise RuntimeError(f"Call failed with {resp.status_code}: {resp.text}")
 
-    def _renew_access_token(self):
-        payload = {
-            "client_id": self.client_id,
-            "client_secret": self.client_secret,
-            "grant_type": "client_credentials",
-        }
-        token_url = self.host.rstrip("/") + "/connect/token"
-        resp = requests.post(token_url, data=payload)
-        if "access_token" not in resp.json():
-            raise RuntimeError(f"Renewing access token failed with {resp.status_code}: {resp.text}")
-        self._access_token = resp.json()["access_token"]
-
     def _get_full_url(self, endpoint):
         return self.host.rstrip("/") + "/v" + self.api_version.lstrip("v").rstrip("/") + "/" + endpoint.lstrip("/")
 
 
-def requester_factory():
+def requester_factory(**kwargs):
 
     assert os.getenv("NYCKEL_CLIENT_ID"), "NYCKEL_CLIENT_ID env variable not set; can't setup connection."
 
     assert os.getenv("NYCKEL_CLIENT_SECRET"), "NYCKEL_CLIENT_SECRET env variable not set; can't setup connection."
 
-    return Requester(os.getenv("NYCKEL_CLIENT_ID"), os.getenv("NYCKEL_CLIENT_SECRET"), "https://www.nyckel.com/", "1")
+    return Requester(
+        os.getenv("NYCKEL_CLIENT_ID"), os.getenv("NYCKEL_CLIENT_SECRET"), "https://www.nyckel.com/", "1", **kwargs
+    )
@@ -0,0 +1,214 @@
+import random
+import threading
+import time
+from typing import Callable, Optional, Tuple, Type, TypeVar
+
+import requests
+
+T = TypeVar("T")
+
+
+class RetryableError(RuntimeError):
+    """Raised for failures that may go away if the call is sent again, such as throttling or a 503."""
+
+    def __init__(self, message: str, retry_after_sec: float = None):
+        super().__init__(message)
+        self.retry_after_sec = retry_after_sec
+
+
+class ThrottledError(RetryableError):
+    """Raised when the server answers with 429. The endpoint is up, so throttling does not trip a circuit breaker."""
+
+
+class CircuitOpenError(RuntimeError):
+    """Raised instead of sending a call while the circuit breaker considers the endpoint down."""
+
+    def __init__(self, message: str, retry_after_sec: float):
+        super().__init__(message)
+        self.retry_after_sec = retry_after_sec
+
+
+# Connection problems that may go away on their own. Other request exceptions, such as an invalid URL, are fatal.
+RETRYABLE_EXCEPTIONS = (
+    RetryableError,
+    requests.exceptions.ConnectionError,
+    requests.exceptions.Timeout,
+    requests.exceptions.ChunkedEncodingError,
+)
+
+
+def is_retryable_status(status_code: int) -> bool:
+    """Tells whether a response status may succeed when sent again: timeouts, throttling and most 5xx."""
+    return status_code in (408, 425, 429) or (status_code >= 500 and status_code not in (501, 505))
+
+
+class RetryBudget:
+    """Caps retries at a fraction of the calls sent, across all threads and policies that share the budget.
+
+    Every first attempt deposits retry_ratio into the budget, and every retry withdraws 1. The budget also refills
+    at min_retries_per_sec, so a process that sends few calls can still retry now and then. When the endpoint is
+    failing, retries stop once the budget is spent instead of multiplying the load on it.
+    """
+
+    def __init__(self, retry_ratio: float = 0.2, min_retries_per_sec: float = 1.0, max_balance: float = 100.0):
+        self._retry_ratio = retry_ratio
+        self._min_retries_per_sec = min_retries_per_sec
+        self._max_balance = max_balance
+        self._balance = max_balance
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def record_call(self):
+        with self._lock:
+            self._balance = min(self._max_balance, self._balance + self._retry_ratio)
+
+    def try_spend(self) -> bool:
+        """Withdraws one retry, if the budget has one."""
+        with self._lock:
+            now = time.monotonic()
+            self._balance = min(self._max_balance, self._balance + (now - self._updated) * self._min_retries_per_sec)
+            self._updated = now
+            if self._balance < 1:
+                return False
+            self._balance -= 1
+            return True
+
+
+# Shared by every RetryPolicy that is not given a budget of its own.
+DEFAULT_RETRY_BUDGET = RetryBudget()
+
+
+class CircuitBreaker:
+    """Fails calls fast while an endpoint is down.
+
+    After failure_threshold retryable failures in a row, counted across all threads, the circuit opens and calls
+    are held back. After reset_timeout_sec, one trial call is let through. Its success closes the circuit, its
+    failure opens it again. Throttling (ThrottledError) is not a failure: the endpoint is up and asking for less
+    load, which the concurrency limiter and the retry backoff already give it.
+    """
+
+    # The retry_after_sec given to calls held back while another thread's trial call is in flight.
+    _TRIAL_POLL_SEC = 1.0
+
+    def __init__(self, failure_threshold: int = 5, reset_timeout_sec: float = 30.0):
+        self._failure_threshold = failure_threshold
+        self._reset_timeout_sec = reset_timeout_sec
+        self._nbr_failures = 0
+        self._opened_at: Optional[float] = None
+        self._trial_in_flight = False
+        self._lock = threading.Lock()
+
+    def before_call(self) -> bool:
+        """Raises CircuitOpenError if the call should not be sent. Returns whether the call is the trial call."""
+        with self._lock:
+            if self._opened_at is None:
+                return False
+            remaining_sec = self._opened_at + self._reset_timeout_sec - time.monotonic()
+            if self._trial_in_flight or remaining_sec > 0:
+                raise CircuitOpenError(
+                    f"Endpoint is down after {self._nbr_failures} failures in a row; not sending the call.",
+                    remaining_sec if remaining_sec > 0 else self._TRIAL_POLL_SEC,
+                )
+            self._trial_in_flight = True
+            return True
+
+    def record_success(self):
+        with self._lock:
+            self._nbr_failures = 0
+            self._opened_at = None
+            self._trial_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self._nbr_failures += 1
+            if self._trial_in_flight or self._nbr_failures >= self._failure_threshold:
+                self._opened_at = time.monotonic()
+            self._trial_in_flight = False
+
+    def end_trial(self):
+        """Lets another trial call through after the trial call ended without a success or failure being recorded."""
+        with self._lock:
+            self._trial_in_flight = False
+
+
+class RetryPolicy:
+    """Sends calls again on retryable errors, with decorrelated-jitter exponential backoff.
+
+    Each wait is drawn uniformly between base_delay_sec and three times the previous wait, capped at max_delay_sec,
+    so threads that failed together spread out instead of retrying in lockstep. A Retry-After from the server
+    replaces the drawn wait. Errors that are not retryable, such as a 400, are raised at once. When the attempts
+    or the retry budget run out, the last error is raised. While the circuit breaker is open, CircuitOpenError is
+    raised without sending the call, even between attempts.
+
+    Usage:
+        policy = RetryPolicy(max_attempts=5)
+        response = policy.call(send_request, description="POST functions")
+    """
+
+    def __init__(
+        self,
+        max_attempts: int = 5,
+        base_delay_sec: float = 0.5,
+        max_delay_sec: float = 30.0,
+        retryable_exceptions: Tuple[Type[BaseException], ...] = RETRYABLE_EXCEPTIONS,
+        budget: RetryBudget = None,
+        circuit_breaker: CircuitBreaker = None,
+    ):
+        """
+        max_attempts: The number of times a call is sent before giving up.
+        base_delay_sec: The shortest wait between attempts.
+        max_delay_sec: The longest wait between attempts, unless the server asks for longer with Retry-After.
+        retryable_exceptions: The exceptions that are worth another attempt.
+        budget: The retry budget to draw from. Defaults to the process-wide DEFAULT_RETRY_BUDGET.
+        circuit_breaker: The breaker of the endpoint. Defaults to a new one for this policy, which opens after
+            max_attempts failures in a row.
+        """
+        self.max_attempts = max_attempts
+        self._base_delay_sec = base_delay_sec
+        self._max_delay_sec = max_delay_sec
+        self._retryable_exceptions = retryable_exceptions
+        self._budget = budget or DEFAULT_RETRY_BUDGET
+        self.circuit_breaker = circuit_breaker or CircuitBreaker(failure_threshold=max(5, max_attempts))
+
+    def call(self, fn: Callable[[], T], description: str = "call") -> T:
+        """Calls fn until it returns, retrying retryable errors.
+
+        fn: The call to make, without arguments.
+        description: What to call the call in log messages.
+
+        Returns what fn returns. Raises CircuitOpenError while the circuit breaker is open.
+        """
+        self._budget.record_call()
+        delay_sec = self._base_delay_sec
+        for attempt in range(1, self.max_attempts + 1):
+            is_trial = self.circuit_breaker.before_call()
+            try:
+                result = fn()
+            except self._retryable_exceptions as err:
+                if isinstance(err, ThrottledError):
+                    # Throttled means up; only the other retryable errors suggest the endpoint is down.
+                    self.circuit_breaker.record_success()
+                else:
+                    self.circuit_breaker.record_failure()
+                if attempt == self.max_attempts:
+                    raise
+                if not self._budget.try_spend():
+                    print(f"{description} failed and the retry budget is spent. Err: {err}.")
+                    raise
+                delay_sec = min(self._max_delay_sec, random.uniform(self._base_delay_sec, delay_sec * 3))
+                retry_after_sec = getattr(err, "retry_after_sec", None)
+                wait_sec = delay_sec if retry_after_sec is None else retry_after_sec
+                print(f"{description} failed on attempt {attempt}, retrying in {wait_sec:.1f}s. Err: {err}.")
+                time.sleep(wait_sec)
+            except Exception:
+                # The endpoint answered, so it is up, even if the call itself was bad.
+                self.circuit_breaker.record_success()
+                raise
+            except BaseException:
+                # A KeyboardInterrupt or the like says nothing about the endpoint, but must not leave the trial open.
+                if is_trial:
+                    self.circuit_breaker.end_trial()
+                raise
+            else:
+                self.circuit_breaker.record_success()
+                return result
@@ -1,5 +1,6 @@
+import csv
+import os
 from enum import Enum
-from typing import List, Optional
 from dataclasses import dataclass
 
 
@@ -15,3 +16,21 @@ class Sample:
     id: str  # Unique string token for this sample.
     data: str  # The actual data.
     label_name: str  # Label name.
+
+
+def csv_to_samples(file_path):
+    """Reads text samples from a .csv file written by prepare_data.py."""
+    with open(file_path, "r") as csvfile:
+        csvreader = csv.reader(csvfile, delimiter=",", quotechar='"')
+        next(csvreader)
+        samples = []
+        for cnt, row in enumerate(csvreader):
+            samples.append(
+                Sample(
+                    modality=Modality.Text,
+                    id=f"{os.path.basename(file_path)}-{cnt}",
+                    label_name=row[2],
+                    data=row[1],
+                )
+            )
+    return samples
@@ -1,29 +1,251 @@
 import csv
+import itertools
 import json
+import os
+import re
+from typing import Any, Dict, Iterator, List, Optional, Tuple
 
 import fire
 import numpy as np
 
+_SEPARATOR = re.compile(r"[\s,]*")
+
 
 def accuracy(test_file, pred_file):
+    """
+    Prints the accuracy of the predictions in pred_file, from any provider, against the labels in test_file.
+    """
+
+    gts = _read_ground_truth(test_file)
+    metrics = _label_metrics(gts, _iter_predictions(pred_file))
+    print(metrics["accuracy"])
+
+
+def report(test_file, *pred_files, warmup=10, nbr_resamples=1000, confidence=0.95, out_file=None, seed=0):
+    """
+    Prints a table comparing the accuracy, macro F1 and invoke latencies of several benchmark runs on one test set.
+
+    pred_files: Predictions written by the evaluate commands, as .json lists or as .jsonl or .done.jsonl
+        checkpoints. The invoke times are read from the matching *_invoke_times.json file, or from the checkpoint
+        itself. To name the invoke times file explicitly, pass preds.json:invoke_times.json.
+    warmup: The number of first invokes left out of the latency percentiles, as they include connection setup.
+    nbr_resamples: The number of bootstrap resamples behind the latency confidence intervals.
+    confidence: The coverage of the latency confidence intervals.
+    out_file: If set, the table is also written to this .csv file.
+    seed: Seeds the bootstrap, so reports are repeatable.
+    """
+
+    gts = _read_ground_truth(test_file)
+    rng = np.random.default_rng(seed)
+    rows = []
+    for spec in pred_files:
+        pred_file, _, invoke_times_file = spec.partition(":")
+        metrics = _label_metrics(gts, _iter_predictions(pred_file))
+        invoke_times = _read_invoke_times(pred_file, invoke_times_file or None)
+        latency = _latency_metrics(invoke_times, warmup, nbr_resamples, confidence, rng)
+        rows.append({"run": _run_name(pred_file), **metrics, **latency})
+
+    columns = [
+        ("run", "{}"),
+        ("format", "{}"),
+        ("n", "{}"),
+        ("accuracy", "{:.4f}"),
+        ("macro_f1", "{:.4f}"),
+        ("n_timed", "{}"),
+        ("p50_ms", "{}"),
+        ("p90_ms", "{}"),
+        ("p99_ms", "{}"),
+    ]
+    table = [[fmt.format(row[name]) if row.get(name) is not None else "-" for name, fmt in columns] for row in rows]
+    widths = [max(len(name), *(len(cells[i]) for cells in table)) for i, (name, _) in enumerate(columns)]
+    print("  ".join(name.ljust(width) for (name, _), width in zip(columns, widths)).rstrip())
+    for cells in table:
+        print("  ".join(cell.ljust(width) for cell, width in zip(cells, widths)).rstrip())
+    print(f"Latencies in ms as estimate [{confidence:.0%} bootstrap interval], after {warmup} warm-up invokes.")
 
+    if out_file:
+        with open(out_file, "w", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow([name for name, _ in columns])
+            writer.writerows(table)
+
+
+def _read_ground_truth(test_file) -> List[str]:
     with open(test_file, "r") as csvfile:
         csvreader = csv.reader(csvfile, delimiter=",", quotechar='"')
         next(csvreader)
-        gts = [row[2] for row in csvreader]
+        return [row[2] for row in csvreader]
+
+
+def _iter_json_list(path, chunk_size=1 << 20) -> Iterator[Any]:
+    """Yields the elements of a JSON list one by one, reading the file in chunks rather than all at once."""
+    decoder = json.JSONDecoder()
+    with open(path, "r") as f:
+        buffer = f.read(chunk_size).lstrip()
+        if not buffer.startswith("["):
+            raise ValueError(f"{path} does not hold a JSON list.")
+        pos = 1
+        eof = False
+        while True:
+            pos = _SEPARATOR.match(buffer, pos).end()
+            if pos < len(buffer) and buffer[pos] == "]":
+                return
+            try:
+                element, end = decoder.raw_decode(buffer, pos)
+                # A number cut off by the end of the chunk parses, but is only complete if a delimiter follows.
+                complete = eof or (end < len(buffer) and buffer[end] in ",] \t\r\n")
+            except ValueError:
+                if eof:
+                    raise ValueError(f"{path} is not valid JSON near character {pos} of the last chunk.")
+                complete = False
+            if complete:
+                yield element
+                pos = end
+                continue
+            chunk = f.read(chunk_size)
+            eof = not chunk
+            buffer = buffer[pos:] + chunk
+            pos = 0
+
+
+def _iter_records(path) -> Iterator[Dict[str, Any]]:
+    """Yields the records of an evaluation checkpoint. A partly written last line is skipped."""
+    with open(path, "r") as f:
+        for line in f:
+            try:
+                yield json.loads(line)
+            except ValueError:
+                return
+
+
+def _iter_predictions(pred_file) -> Iterator[Any]:
+    if pred_file.endswith(".jsonl"):
+        return (record["prediction"] for record in _iter_records(pred_file))
+    return _iter_json_list(pred_file)
+
+
+def _detect_format(prediction) -> str:
+    """Tells which provider wrote a raw prediction, from its shape."""
+    if isinstance(prediction, dict) and "name" in prediction:
+        return "nyckel"
+    if isinstance(prediction, dict) and "predictions" in prediction:
+        return "google"
+    if isinstance(prediction, list) and prediction and isinstance(prediction[0], list):
+        return "huggingface"
+    raise ValueError(f"Unknown prediction format: {str(prediction)[:200]}")
+
+
+def _label_indices(predictions: List[Any], fmt: str, vocabulary: Dict[str, int]) -> np.ndarray:
+    """
+    Returns the index in vocabulary of the predicted label of each prediction, adding unseen labels to it. Label
+    scores are scattered into one matrix for the whole chunk, so picking the top label is a single argmax.
+    """
+    if fmt == "nyckel":
+        return np.array([vocabulary.setdefault(p["name"], len(vocabulary)) for p in predictions], dtype=np.int64)
+    rows, labels, scores = [], [], []
+    for row, prediction in enumerate(predictions):
+        if fmt == "google":
+            names = prediction["predictions"][0]["displayNames"]
+            confidences = prediction["predictions"][0]["confidences"]
+        else:
+            names = [entry["label"] for entry in prediction[0]]
+            confidences = [entry["score"] for entry in prediction[0]]
+        rows.extend(itertools.repeat(row, len(names)))
+        labels.extend(vocabulary.setdefault(name, len(vocabulary)) for name in names)
+        scores.extend(confidences)
+    matrix = np.full((len(predictions), len(vocabulary)), -np.inf)
+    matrix[np.array(rows, dtype=np.int64), np.array(labels, dtype=np.int64)] = scores
+    return np.argmax(matrix, axis=1)
+
+
+def _label_metrics(gts: List[str], predictions: Iterator[Any], chunk_size: int = 10000) -> Dict[str, Any]:
+    """Scores predictions against the ground truth, in chunks, so only the predicted label indices are kept."""
+    vocabulary: Dict[str, int] = {}
+    gt_indices = np.array([vocabulary.setdefault(gt, len(vocabulary)) for gt in gts], dtype=np.int64)
+    predictions = iter(predictions)
+    first = next(predictions, None)
+    if first is None:
+        return {"format": None, "n": 0, "accuracy": None, "macro_f1": None}
+    fmt = _detect_format(first)
+    predictions = itertools.chain([first], predictions)
+    chunks = []
+    while True:
+        chunk = list(itertools.islice(predictions, chunk_size))
+        if not chunk:
+            break
+        chunks.append(_label_indices(chunk, fmt, vocabulary))
+    pred_indices = np.concatenate(chunks)
+    if len(pred_indices) > len(gt_indices):
+        raise ValueError(f"Got {len(pred_indices)} predictions for {len(gt_indices)} test samples.")
+
+    gt_indices = gt_indices[: len(pred_indices)]
+    n_labels = len(vocabulary)
+    confusion = np.bincount(gt_indices * n_labels + pred_indices, minlength=n_labels * n_labels)
+    confusion = confusion.reshape(n_labels, n_labels)  # Rows are ground truth, columns predictions.
+    true_positives = np.diag(confusion).astype(float)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        precision = np.nan_to_num(true_positives / confusion.sum(axis=0))
+        recall = np.nan_to_num(true_positives / confusion.sum(axis=1))
+        f1 = np.nan_to_num(2 * precision * recall / (precision + recall))
+    present = confusion.sum(axis=1) > 0
+    return {
+        "format": fmt,
+        "n": len(pred_indices),
+        "accuracy": float(true_positives.sum() / len(pred_indices)),
+        "macro_f1": float(f1[present].mean()),
+    }
+
+
+def _read_invoke_times(pred_file: str, invoke_times_file: Optional[str]) -> Optional[np.ndarray]:
+    if invoke_times_file is None and pred_file.endswith(".jsonl"):
+        return np.fromiter((record["invoke_sec"] for record in _iter_records(pred_file)), dtype=float)
+    if invoke_times_file is None:
+        # nyckel.py and google.py write X_preds.json and X_invoke_times.json; huggingface.py X_hf_preds.json.
+        stem = pred_file[: -len("_preds.json")] if pred_file.endswith("_preds.json") else None
+        candidates = [stem + "_invoke_times.json", re.sub(r"_hf$", "", stem) + "_invoke_times.json"] if stem else []
+        invoke_times_file = next((path for path in candidates if os.path.exists(path)), None)
+    if invoke_times_file is None:
+        print(f"No invoke times found for {pred_file}.")
+        return None
+    return np.fromiter(_iter_json_list(invoke_times_file), dtype=float)
+
+
+def _latency_metrics(
+    invoke_times: Optional[np.ndarray],
+    warmup: int,
+    nbr_resamples: int,
+    confidence: float,
+    rng: np.random.Generator,
+    percentiles: Tuple[float, ...] = (50, 90, 99),
+) -> Dict[str, Any]:
+    """
+    Returns each latency percentile in ms as "estimate [low, high]", where low and high bound a percentile
+    bootstrap confidence interval. Resamples are drawn in batches of about ten million values to bound memory.
+    """
+    names = [f"p{percentile:g}_ms" for percentile in percentiles]
+    if invoke_times is None or len(invoke_times) <= warmup:
+        return {"n_timed": 0, **{name: None for name in names}}
+    times_ms = 1000 * invoke_times[warmup:]
+    estimates = np.percentile(times_ms, percentiles)
+    batch_size = max(1, 10_000_000 // len(times_ms))
+    resampled = []
+    for start in range(0, nbr_resamples, batch_size):
+        indices = rng.integers(0, len(times_ms), size=(min(batch_size, nbr_resamples - start), len(times_ms)))
+        resampled.append(np.percentile(times_ms[indices], percentiles, axis=1))
+    tail = (1 - confidence) / 2 * 100
+    lows, highs = np.percentile(np.concatenate(resampled, axis=1), [tail, 100 - tail], axis=1)
+    return {
+        "n_timed": len(times_ms),
+        **{
+            name: f"{estimate:.1f} [{low:.1f}, {high:.1f}]"
+            for name, estimate, low, high in zip(names, estimates, lows, highs)
+        },
+    }
 
-    with open(pred_file, "r") as f:
-        preds = json.load(f)
 
-    n_correct = 0
-    for pred, gt in zip(preds, gts):
-        scores = [entry["score"] for entry in pred[0]]
-        ind = np.argmax(scores)
-        pred_name = pred[0][ind]["label"]
-        if pred_name == gt:
-            n_correct += 1
-    print(n_correct / 1000)
+def _run_name(pred_file: str) -> str:
+    return re.sub(r"(_preds)?(\.done)?\.jsonl?$", "", os.path.basename(pred_file))
 
 
 if __name__ == "__main__":
-    fire.Fire(accuracy)
+    fire.Fire()
@@ -0,0 +1,229 @@
+import concurrent.futures
+import json
+import os
+import threading
+import time
+
+import pytest
+
+from nyckel_utils.evaluation import Provider, evaluate_provider
+from nyckel_utils.journal import UploadJournal
+from nyckel_utils.load import LatencyHistogram
+from nyckel_utils.prediction_cache import PredictionCache
+from nyckel_utils.retry import (
+    CircuitBreaker,
+    CircuitOpenError,
+    RetryableError,
+    RetryBudget,
+    RetryPolicy,
+    ThrottledError,
+)
+from nyckel_utils.sample import Modality, Sample
+
+
+def _policy(max_attempts=5, failure_threshold=5, reset_timeout_sec=30.0):
+    return RetryPolicy(
+        max_attempts=max_attempts,
+        base_delay_sec=0.001,
+        max_delay_sec=0.002,
+        budget=RetryBudget(max_balance=1000),
+        circuit_breaker=CircuitBreaker(failure_threshold=failure_threshold, reset_timeout_sec=reset_timeout_sec),
+    )
+
+
+def _flaky(nbr_failures, error):
+    """Returns a call that raises error nbr_failures times, then returns "ok"."""
+    state = {"nbr_calls": 0}
+
+    def _call():
+        state["nbr_calls"] += 1
+        if state["nbr_calls"] <= nbr_failures:
+            raise error
+        return "ok"
+
+    return _call, state
+
+
+def test_throttling_from_many_threads_does_not_open_the_circuit():
+    policy = _policy()
+    barrier = threading.Barrier(16)
+
+    def _call_throttled_once():
+        call, state = _flaky(1, ThrottledError("429", retry_after_sec=0.001))
+
+        def _all_throttled_at_once():
+            if state["nbr_calls"] == 0:
+                barrier.wait(timeout=5)
+            return call()
+
+        return policy.call(_all_throttled_at_once)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=16) as executor:
+        results = list(executor.map(lambda _: _call_throttled_once(), range(16)))
+    assert results == ["ok"] * 16
+
+
+def test_open_circuit_fails_calls_fast():
+    policy = _policy(max_attempts=10, failure_threshold=3, reset_timeout_sec=30)
+    call, state = _flaky(100, RetryableError("503"))
+    with pytest.raises(CircuitOpenError):
+        policy.call(call)
+    assert state["nbr_calls"] == 3
+
+    t0 = time.monotonic()
+    with pytest.raises(CircuitOpenError) as err:
+        policy.call(call)
+    assert time.monotonic() - t0 < 1
+    assert state["nbr_calls"] == 3
+    assert 0 < err.value.retry_after_sec <= 30
+
+
+def test_interrupted_trial_call_lets_the_next_trial_through():
+    policy = _policy(max_attempts=1, failure_threshold=1, reset_timeout_sec=0.01)
+    with pytest.raises(RetryableError):
+        policy.call(_flaky(100, RetryableError("503"))[0])
+    time.sleep(0.02)
+    with pytest.raises(KeyboardInterrupt):
+        policy.call(_flaky(1, KeyboardInterrupt())[0])
+    assert policy.call(lambda: "ok") == "ok"
+
+
+def test_attempts_run_out_before_a_breaker_with_threshold_max_attempts_opens():
+    policy = _policy(max_attempts=10, failure_threshold=10)
+    call, state = _flaky(100, RetryableError("503"))
+    with pytest.raises(RetryableError):
+        policy.call(call)
+    assert state["nbr_calls"] == 10
+
+
+def test_errors_that_are_not_retryable_are_raised_at_once():
+    policy = _policy()
+    call, state = _flaky(1, ValueError("400"))
+    with pytest.raises(ValueError):
+        policy.call(call)
+    assert state["nbr_calls"] == 1
+
+
+def test_journal_reads_back_done_and_uncertain_samples(tmp_path):
+    path = str(tmp_path / "journal.jsonl")
+    journal = UploadJournal(path)
+    journal.record("f1", "posting_sample", "a")
+    journal.record("f1", "posted_sample", "a", "s1")
+    journal.record("f1", "posted_annotation", "a")
+    journal.record("f1", "posting_sample", "b")
+    journal.record("f2", "posting_sample", "c")
+    journal.close()
+    with open(path, "a") as f:
+        f.write('{"functionId": "f1", "event": "posted_sam')
+
+    state = UploadJournal(path).load("f1")
+    assert state.sample_id_by_external_id == {"a": "s1"}
+    assert state.annotated_external_ids == {"a"}
+    assert state.uncertain_external_ids == {"b"}
+
+
+class _CountingProvider(Provider):
+    name = "counting"
+    model_id = "m1"
+
+    def __init__(self, fail_at=None):
+        self.invoked = []
+        self._fail_at = fail_at
+        self._lock = threading.Lock()
+
+    def invoke(self, sample):
+        if sample.id == self._fail_at:
+            raise RuntimeError("Interrupted")
+        with self._lock:
+            self.invoked.append(sample.id)
+        return {"name": sample.data}
+
+    def label_name(self, prediction):
+        return prediction["name"]
+
+
+def _samples(n):
+    return [Sample(modality=Modality.Text, id=str(i), data="a" if i % 2 else "b", label_name="a") for i in range(n)]
+
+
+def test_evaluation_resumes_after_an_interruption(tmp_path):
+    samples = _samples(20)
+    preds_file, times_file = str(tmp_path / "preds.json"), str(tmp_path / "times.json")
+    with pytest.raises(RuntimeError):
+        evaluate_provider(_CountingProvider(fail_at="12"), samples, preds_file, times_file, sequential=True)
+
+    provider = _CountingProvider()
+    result = evaluate_provider(provider, samples, preds_file, times_file, max_nbr_concurrent_requests=4)
+    assert provider.invoked and set(provider.invoked) == {str(i) for i in range(12, 20)}
+    assert [prediction["name"] for prediction in result.predictions] == [sample.data for sample in samples]
+    assert result.accuracy == 0.5
+    with open(times_file) as f:
+        assert len(json.load(f)) == 20
+
+
+def test_completed_evaluation_is_not_resumed(tmp_path):
+    samples = _samples(5)
+    preds_file, times_file = str(tmp_path / "preds.json"), str(tmp_path / "times.json")
+    evaluate_provider(_CountingProvider(), samples, preds_file, times_file)
+    assert os.path.exists(str(tmp_path / "preds.done.jsonl"))
+
+    provider = _CountingProvider()
+    evaluate_provider(provider, samples, preds_file, times_file, sequential=True)
+    assert provider.invoked == [sample.id for sample in samples]
+
+
+def test_evaluation_takes_cached_predictions_unless_bypassed(tmp_path):
+    samples = _samples(10)
+    cache_file = str(tmp_path / "cache.sqlite")
+    provider = _CountingProvider()
+    evaluate_provider(provider, samples, str(tmp_path / "1.json"), str(tmp_path / "1t.json"), cache_file=cache_file)
+    assert len(provider.invoked) == 10
+
+    provider = _CountingProvider()
+    result = evaluate_provider(
+        provider, samples, str(tmp_path / "2.json"), str(tmp_path / "2t.json"), cache_file=cache_file
+    )
+    assert provider.invoked == []
+    assert result.accuracy == 0.5
+
+    provider = _CountingProvider()
+    evaluate_provider(
+        provider, samples, str(tmp_path / "3.json"), str(tmp_path / "3t.json"), cache_file=cache_file, bypass_cache=True
+    )
+    assert len(provider.invoked) == 10
+
+
+def test_latency_histogram_percentiles_are_within_bucket_precision():
+    histogram = LatencyHistogram()
+    values = [i / 10000 for i in range(1, 10001)]  # 0.1 ms to 1 s.
+    for value in reversed(values):
+        histogram.record(value)
+    assert histogram.count == 10000
+    for percentile in (50, 90, 99, 99.9):
+        expected = values[int(percentile / 100 * len(values)) - 1]
+        assert expected <= histogram.percentile_sec(percentile) <= expected * (1 + 1 / 64) + 1e-6
+    assert histogram.percentile_sec(100) == histogram.max_sec == 1.0
+    assert sum(histogram.buckets().values()) == 10000
+
+
+def test_prediction_cache_hits_expires_and_evicts(tmp_path):
+    path = str(tmp_path / "cache.sqlite")
+    cache = PredictionCache(path, max_entries=2)
+    cache.put("nyckel", "f1", "text a", {"name": "x"}, 0.1)
+    assert cache.get("nyckel", "f1", "text a").prediction == {"name": "x"}
+    assert cache.get("nyckel", "f2", "text a") is None
+    assert cache.get("google", "f1", "text a") is None
+
+    cache.put("nyckel", "f1", "text b", {"name": "y"}, 0.1)
+    time.sleep(0.01)
+    cache.get("nyckel", "f1", "text a")
+    cache.put("nyckel", "f1", "text c", {"name": "z"}, 0.1)
+    assert cache.evict() == 1
+    assert cache.get("nyckel", "f1", "text b") is None
+    assert cache.get("nyckel", "f1", "text a") is not None
+    cache.close()
+
+    cache = PredictionCache(path, max_age_sec=0)
+    assert cache.get("nyckel", "f1", "text a") is None
+    cache.close()
+    assert os.path.exists(path)
@@ -0,0 +1,271 @@
+import asyncio
+import concurrent.futures
+import itertools
+import os
+import time
+from typing import Awaitable, Callable, Dict, List, Optional, Set
+
+import aiohttp
+
+from local_prefilter import LocalDuplicatePrefilter
+from near_duplicate_deduper import (
+    IMAGE_SIZE_FOR_POSTING,
+    NYCKEL_HOST,
+    DuplicateClusterIdentifier,
+    base64encoded_payload,
+    get_duplicate_pairs,
+)
+from preprocessing import PayloadCache, build_payload
+from token_manager import AccessTokenManager
+
+
+class AsyncNyckelSearchBackend:
+    """
+    asyncio counterpart of NyckelSearchBackend.
+
+    All requests go through one aiohttp session whose connector keeps up to max_nbr_concurrent_requests
+    keep-alive connections to the API, and a semaphore bounds the number of requests in flight. Images are
+    decoded and encoded in a process pool through run_in_executor, so the event loop only does I/O. Files are fed
+    in as earlier ones finish, so no more than max_nbr_concurrent_requests images are being read or posted at once.
+    The access token is renewed in the background before it expires, off the event loop.
+    """
+
+    def __init__(
+        self,
+        client_id: str,
+        client_secret: str,
+        max_nbr_concurrent_requests: int = 200,
+        max_nbr_preprocessing_workers: int = None,
+        payload_cache_max_memory_bytes: int = 512 * 2**20,
+        host: str = NYCKEL_HOST,
+    ):
+        """
+        client_id: The Nyckel client ID.
+        client_secret: The Nyckel client secret.
+        max_nbr_concurrent_requests: The maximum number of requests in flight to the Nyckel function.
+        max_nbr_preprocessing_workers: The number of processes that decode and encode images. Defaults to the CPU count.
+        payload_cache_max_memory_bytes: Encoded images above this many bytes are spilled to disk between phases.
+        host: The Nyckel API host.
+        """
+        self._client_id = client_id
+        self._client_secret = client_secret
+        self._max_nbr_concurrent_requests = max_nbr_concurrent_requests
+        self._max_nbr_preprocessing_workers = max_nbr_preprocessing_workers
+        self._payload_cache_max_memory_bytes = payload_cache_max_memory_bytes
+        self._host = host.rstrip("/")
+        self._access_tokens = AccessTokenManager(f"{self._host}/connect/token", client_id, client_secret)
+        self._session: aiohttp.ClientSession
+        self._semaphore: asyncio.Semaphore
+        self._process_pool: concurrent.futures.ProcessPoolExecutor
+        self._payload_cache: PayloadCache
+        self._function_id: str
+        self._sample_id_by_filename: Dict[str, str] = {}
+        self._filename_by_sample_id: Dict[str, str] = {}
+
+    async def open(self):
+        connector = aiohttp.TCPConnector(limit=self._max_nbr_concurrent_requests, keepalive_timeout=60)
+        self._session = aiohttp.ClientSession(connector=connector, raise_for_status=False)
+        self._semaphore = asyncio.Semaphore(self._max_nbr_concurrent_requests)
+        self._process_pool = concurrent.futures.ProcessPoolExecutor(
+            max_workers=self._max_nbr_preprocessing_workers or os.cpu_count()
+        )
+        self._payload_cache = PayloadCache(max_memory_bytes=self._payload_cache_max_memory_bytes)
+        try:
+            await self._initialize_session()
+            await self._create_function()
+        except BaseException:
+            await self._release()
+            raise
+
+    async def close(self):
+        try:
+            await self._delete_function()
+        finally:
+            await self._release()
+
+    async def index_images(self, image_filelist: List[str]) -> Dict[str, str]:
+        """
+        Posts images to the Nyckel function.
+
+        image_filelist: A list of image file paths to post.
+
+        Returns a dictionary mapping sample IDs to file names.
+        """
+        print(f"Posting images to function {self._function_id}...")
+        t0 = time.time()
+        filename_by_sample_id = {}
+        async for img_file, sample_id in self._run_all(self._post_one_image, image_filelist):
+            filename_by_sample_id[sample_id] = img_file
+            self._sample_id_by_filename[img_file] = sample_id
+        self._filename_by_sample_id.update(filename_by_sample_id)
+        print(f"Posted {len(image_filelist)} images in {time.time() - t0} seconds.")
+        return filename_by_sample_id
+
+    async def search_images(self, image_filelist: List[str]) -> Dict[str, Optional[dict]]:
+        """
+        Searches for the closest match to each image, excluding itself.
+
+        image_filelist: A list of image file paths to search. Must have been posted.
+
+        Returns a dictionary mapping file names to near-duplicate search results.
+        """
+        print(f"Searching images in function {self._function_id}...")
+        t0 = time.time()
+        similarity_by_filename = {}
+        async for img_file, result in self._run_all(self._find_closest_match_excluding_self, image_filelist):
+            similarity_by_filename[img_file] = result
+        print(f"Searched {len(image_filelist)} images in {time.time() - t0} seconds.")
+        return similarity_by_filename
+
+    async def _run_all(self, coroutine_function: Callable[[str], Awaitable], image_filelist: List[str]):
+        """
+        Yields (file name, result) pairs as they complete, keeping max_nbr_concurrent_requests files in progress.
+        """
+
+        async def _run_one(img_file):
+            return img_file, await coroutine_function(img_file)
+
+        img_files = iter(image_filelist)
+        window = self._max_nbr_concurrent_requests
+        pending = {asyncio.ensure_future(_run_one(img_file)) for img_file in itertools.islice(img_files, window)}
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    yield task.result()
+                pending |= {asyncio.ensure_future(_run_one(f)) for f in itertools.islice(img_files, len(done))}
+        finally:
+            for task in pending:
+                task.cancel()
+
+    async def _release(self):
+        self._payload_cache.close()
+        self._process_pool.shutdown(wait=False, cancel_futures=True)
+        await self._session.close()
+        self._access_tokens.close()
+
+    async def _initialize_session(self):
+        await asyncio.get_running_loop().run_in_executor(None, self._access_tokens.get)
+
+    async def _authorization(self) -> Dict[str, str]:
+        """
+        Returns the authorization header, only leaving the event loop when the token has to be renewed first.
+        """
+        access_token = self._access_tokens.cached()
+        if access_token is None:
+            access_token = await asyncio.get_running_loop().run_in_executor(None, self._access_tokens.get)
+        return {"authorization": "Bearer " + access_token}
+
+    async def _create_function(self):
+        print("Creating function to use for deduplication ...")
+        async with self._session.post(
+            f"{self._host}/v1/functions/",
+            json={"input": "Image", "output": "Search"},
+            headers=await self._authorization(),
+        ) as response:
+            assert response.status == 200, f"Something went wrong when creating function: {await response.text()}"
+            self._function_id = (await response.json())["id"][9:]
+
+    async def _delete_function(self):
+        async with self._session.delete(
+            f"{self._host}/v1/functions/{self._function_id}", headers=await self._authorization()
+        ) as response:
+            assert response.status == 200, f"Error during cleanup (deleting function {self._function_id})"
+
+    async def _post_one_image(self, img_file_path: str) -> str:
+        loop = asyncio.get_running_loop()
+        async with self._semaphore:
+            payload = await loop.run_in_executor(
+                self._process_pool, build_payload, img_file_path, IMAGE_SIZE_FOR_POSTING
+            )
+            self._payload_cache[img_file_path] = payload
+            async with self._session.post(
+                f"{self._host}/v1/functions/{self._function_id}/samples",
+                json={"data": base64encoded_payload(payload)},
+                headers=await self._authorization(),
+            ) as response:
+                assert response.status in [
+                    200,
+                    409,
+                ], f"Something went wrong when posting {img_file_path=} {await response.text()=} {response.status=}"
+                return (await response.json())["id"]
+
+    async def _find_closest_match_excluding_self(self, img_file_path: str) -> Optional[dict]:
+        async with self._semaphore:
+            async with self._session.post(
+                f"{self._host}/v0.9/functions/{self._function_id}/search?sampleCount=2",
+                json={"data": base64encoded_payload(self._payload_cache[img_file_path])},
+                headers=await self._authorization(),
+            ) as response:
+                assert (
+                    response.status == 200
+                ), f"Something went wrong when searching {img_file_path=} {await response.text()=}"
+                search_samples = (await response.json())["searchSamples"]
+        own_sample_id = self._sample_id_by_filename[img_file_path]
+        own_sample_is_shared = self._filename_by_sample_id[own_sample_id] != img_file_path
+        for search_sample in search_samples:
+            if search_sample["sampleId"] != own_sample_id or own_sample_is_shared:
+                return search_sample
+        return None
+
+
+class AsyncNyckelNearDuplicateDeduper:
+    def __init__(
+        self,
+        client_id: str,
+        client_secret: str,
+        duplication_threshold: float = 0.05,
+        max_nbr_concurrent_requests: int = 200,
+        max_nbr_preprocessing_workers: int = None,
+        payload_cache_max_memory_bytes: int = 512 * 2**20,
+        local_prefilter: LocalDuplicatePrefilter = None,
+        host: str = NYCKEL_HOST,
+    ):
+        """
+        Initializes a new instance of the AsyncNyckelNearDuplicateDeduper class.
+
+        Takes the same arguments as NyckelNearDuplicateDeduper. max_nbr_concurrent_requests bounds the number of
+        requests in flight on one event loop rather than a number of threads, so it can be set much higher.
+        """
+        self._duplication_threshold = duplication_threshold
+        self._local_prefilter = local_prefilter
+        self._search_backend = AsyncNyckelSearchBackend(
+            client_id,
+            client_secret,
+            max_nbr_concurrent_requests=max_nbr_concurrent_requests,
+            max_nbr_preprocessing_workers=max_nbr_preprocessing_workers,
+            payload_cache_max_memory_bytes=payload_cache_max_memory_bytes,
+            host=host,
+        )
+
+    async def dedupe_filelist(self, image_filelist: List[str]) -> List[Set[str]]:
+        """
+        Deduplicates a list of image files using the Nyckel near-duplicate search API.
+
+        image_filelist: A list of image file paths.
+
+        Returns a list of sets, where each set contains the file paths of duplicate images.
+        """
+        local_groups = []
+        if self._local_prefilter:
+            local_groups = await asyncio.get_running_loop().run_in_executor(None, self._local_prefilter, image_filelist)
+            image_filelist = [group[0] for group in local_groups]
+            print(f"Local prefilter kept {len(image_filelist)} representative images to search.")
+        await self._search_backend.open()
+        try:
+            filename_by_sample_id = await self._search_backend.index_images(image_filelist)
+            similarity_by_filename = await self._search_backend.search_images(image_filelist)
+        finally:
+            await self._search_backend.close()
+        duplicate_pairs = get_duplicate_pairs(
+            filename_by_sample_id, similarity_by_filename, self._duplication_threshold
+        )
+        cluster_identifier = DuplicateClusterIdentifier()
+        cluster_identifier.add_pairs((group[0], member) for group in local_groups for member in group[1:])
+        return cluster_identifier(duplicate_pairs)
+
+    def run(self, image_filelist: List[str]) -> List[Set[str]]:
+        """
+        Runs dedupe_filelist to completion on a new event loop, for callers that are not async themselves.
+        """
+        return asyncio.run(self.dedupe_filelist(image_filelist))
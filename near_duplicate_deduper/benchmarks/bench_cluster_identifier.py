@@ -0,0 +1,98 @@
+"""
+Compares the union-find DuplicateClusterIdentifier with the original engine, which scanned every cluster per lookup.
+
+Run from the near_duplicate_deduper folder:
+
+    python -m benchmarks.bench_cluster_identifier --max_exponent 7 --legacy_max_pairs 100000
+"""
+
+import random
+import time
+from typing import Iterator, List, Set, Tuple
+
+import fire
+
+from near_duplicate_deduper import DuplicateClusterIdentifier
+
+
+class LegacyDuplicateClusterIdentifier:
+    """
+    The list-of-sets engine that DuplicateClusterIdentifier used before the union-find rewrite. Kept for comparison.
+    """
+
+    def __init__(self):
+        self.clusters: List[Set[str]] = []
+
+    def __call__(self, duplicate_pairs) -> List[Set[str]]:
+        for member1, member2 in duplicate_pairs:
+            if not self._is_in_any_cluster(member1) and not self._is_in_any_cluster(member2):
+                self.clusters.append(set([member1, member2]))
+            if self._is_in_any_cluster(member1) and self._is_in_any_cluster(member2):
+                self._merge_clusters(self._get_cluster(member1), self._get_cluster(member2))
+            if self._is_in_any_cluster(member1) and not self._is_in_any_cluster(member2):
+                self._get_cluster(member1).add(member2)
+            if self._is_in_any_cluster(member2) and not self._is_in_any_cluster(member1):
+                self._get_cluster(member2).add(member1)
+        self.clusters = [cluster for cluster in self.clusters if len(cluster) > 0]
+        return self.clusters
+
+    def _is_in_any_cluster(self, member):
+        return any(member in cluster for cluster in self.clusters)
+
+    def _get_cluster(self, member):
+        for cluster in self.clusters:
+            if member in cluster:
+                return cluster
+        raise ValueError(f"Cant get cluster for {member} -- not in any cluster")
+
+    def _merge_clusters(self, cluster1, cluster2):
+        if cluster1 is cluster2:
+            return
+        cluster1 |= cluster2
+        cluster2.clear()
+
+
+def generate_pairs(nbr_pairs: int, seed: int = 0) -> Iterator[Tuple[str, str]]:
+    """
+    Generates random duplicate pairs over twice as many files as pairs, which gives many small clusters
+    and a few long chains, similar to what near-duplicate search returns on a real photo folder.
+    """
+    rng = random.Random(seed)
+    nbr_files = 2 * nbr_pairs
+    for _ in range(nbr_pairs):
+        yield f"img_{rng.randrange(nbr_files)}.jpg", f"img_{rng.randrange(nbr_files)}.jpg"
+
+
+def _time_engine(engine, nbr_pairs: int, streaming: bool) -> Tuple[float, int]:
+    t0 = time.perf_counter()
+    if streaming:
+        engine.add_pairs(generate_pairs(nbr_pairs))
+        clusters = engine.clusters
+    else:
+        clusters = engine(list(generate_pairs(nbr_pairs)))
+    return time.perf_counter() - t0, len(clusters)
+
+
+def main(min_exponent: int = 4, max_exponent: int = 7, legacy_max_pairs: int = 100_000):
+    """
+    min_exponent: Smallest run uses 10**min_exponent pairs.
+    max_exponent: Largest run uses 10**max_exponent pairs.
+    legacy_max_pairs: Skip the legacy engine above this many pairs, since it is quadratic.
+    """
+    print(f"{'pairs':>12} {'clusters':>10} {'union-find (s)':>15} {'legacy (s)':>12} {'speedup':>9}")
+    for exponent in range(min_exponent, max_exponent + 1):
+        nbr_pairs = 10**exponent
+        new_runtime, nbr_clusters = _time_engine(DuplicateClusterIdentifier(), nbr_pairs, streaming=True)
+        if nbr_pairs <= legacy_max_pairs:
+            legacy_runtime, legacy_nbr_clusters = _time_engine(
+                LegacyDuplicateClusterIdentifier(), nbr_pairs, streaming=False
+            )
+            assert legacy_nbr_clusters == nbr_clusters, "Engines disagree on the number of clusters"
+            legacy_column, speedup_column = f"{legacy_runtime:12.2f}", f"{legacy_runtime / new_runtime:8.1f}x"
+        else:
+            legacy_column, speedup_column = f"{'skipped':>12}", f"{'-':>9}"
+        print(f"{nbr_pairs:>12} {nbr_clusters:>10} {new_runtime:15.2f} {legacy_column} {speedup_column}")
+
+
+if __name__ == "__main__":
+    fire.Fire(main)
@@ -0,0 +1,59 @@
+"""
+Measures deduper throughput against the local mock Nyckel server, for the thread-pool and asyncio clients, as a
+function of the number of concurrent requests.
+
+Run from the near_duplicate_deduper folder:
+
+    python -m benchmarks.bench_concurrency --nbr_images 2000 --latency_ms 50 --concurrencies 10,20,50,100,200
+"""
+
+import tempfile
+import time
+
+import fire
+
+from async_deduper import AsyncNyckelNearDuplicateDeduper
+from benchmarks.mock_nyckel_server import MockNyckelServerProcess
+from benchmarks.synthetic_corpus import make_synthetic_corpus
+from near_duplicate_deduper import NyckelNearDuplicateDeduper
+
+
+def _images_per_sec(dedupe, image_filelist) -> float:
+    t0 = time.perf_counter()
+    dedupe(image_filelist)
+    return len(image_filelist) / (time.perf_counter() - t0)
+
+
+def main(
+    nbr_images: int = 2000, latency_ms: float = 50.0, concurrencies=(10, 20, 50, 100, 200), modes=("sync", "async")
+):
+    """
+    nbr_images: The number of synthetic images to dedupe per run.
+    latency_ms: The latency of each mock API call.
+    concurrencies: The values of max_nbr_concurrent_requests to run.
+    modes: Which clients to run, "sync" for the thread pool and "async" for asyncio.
+    """
+    # Fire passes a single --concurrencies 50 as an int and a single --modes async as a str.
+    concurrencies = (concurrencies,) if isinstance(concurrencies, int) else concurrencies
+    modes = (modes,) if isinstance(modes, str) else modes
+    with tempfile.TemporaryDirectory() as folder, MockNyckelServerProcess(latency_ms=latency_ms) as host:
+        image_filelist = make_synthetic_corpus(folder, nbr_images)
+        print(f"{'concurrency':>12} " + " ".join(f"{mode + ' img/s':>12}" for mode in modes))
+        for concurrency in concurrencies:
+            throughputs = []
+            for mode in modes:
+                if mode == "sync":
+                    deduper = NyckelNearDuplicateDeduper(
+                        "client-id", "client-secret", max_nbr_concurrent_requests=concurrency, host=host
+                    )
+                    throughputs.append(_images_per_sec(deduper.dedupe_filelist, image_filelist))
+                else:
+                    deduper = AsyncNyckelNearDuplicateDeduper(
+                        "client-id", "client-secret", max_nbr_concurrent_requests=concurrency, host=host
+                    )
+                    throughputs.append(_images_per_sec(deduper.run, image_filelist))
+            print(f"{concurrency:>12} " + " ".join(f"{throughput:12.1f}" for throughput in throughputs))
+
+
+if __name__ == "__main__":
+    fire.Fire(main)
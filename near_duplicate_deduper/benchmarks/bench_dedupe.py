@@ -0,0 +1,238 @@
+"""
+Measures end-to-end dedupe_filelist throughput, latency, client CPU time and peak memory against the local mock
+Nyckel server, over synthetic corpora of several sizes, and appends the results to a JSON lines file.
+
+Each run happens in a fresh process, so CPU time and peak RSS belong to that run alone, and include the
+preprocessing worker processes. Run from the near_duplicate_deduper folder:
+
+    python -m benchmarks.bench_dedupe run --corpus_sizes 1000,10000 --latency_ms 50 --error_rate 0.01 \\
+        --max_requests_per_sec 1000 --output bench_dedupe.jsonl --label my-branch
+
+and compare two result files, for example from two versions of the code:
+
+    python -m benchmarks.bench_dedupe compare baseline.jsonl bench_dedupe.jsonl
+
+Synthetic images are kept in corpus_dir between invocations, since writing a million of them takes a while.
+"""
+
+import glob
+import json
+import multiprocessing
+import os
+import platform
+import queue
+import resource
+import subprocess
+import tempfile
+import time
+from typing import Dict, List
+
+import fire
+
+from benchmarks.mock_nyckel_server import MockNyckelServerProcess
+from benchmarks.synthetic_corpus import make_synthetic_corpus
+from metrics import InMemoryMetrics
+from near_duplicate_deduper import NyckelNearDuplicateDeduper
+
+# Fields of a result that identify its configuration, for matching runs of two versions.
+CONFIG_FIELDS = (
+    "nbr_images",
+    "image_size",
+    "duplicate_fraction",
+    "latency_ms",
+    "latency_jitter_ms",
+    "error_rate",
+    "max_requests_per_sec",
+    "max_nbr_concurrent_requests",
+)
+
+
+def _git_revision() -> str:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def _corpus(corpus_dir: str, nbr_images: int, image_size, duplicate_fraction: float) -> List[str]:
+    """
+    Returns the first nbr_images synthetic images in corpus_dir, writing the corpus if it is too small.
+    """
+    folder = os.path.join(corpus_dir, f"{image_size[0]}x{image_size[1]}_{duplicate_fraction}")
+    image_filelist = sorted(glob.glob(os.path.join(folder, "synthetic_*.jpg")))
+    if len(image_filelist) < nbr_images:
+        print(f"Writing {nbr_images} synthetic images to {folder}...")
+        image_filelist = make_synthetic_corpus(
+            folder, nbr_images, size=tuple(image_size), duplicate_fraction=duplicate_fraction
+        )
+    return image_filelist[:nbr_images]
+
+
+def _dedupe_in_this_process(host: str, image_filelist: List[str], max_nbr_concurrent_requests: int, results):
+    """
+    Runs one dedupe and reports its measurements. Runs in a fresh process per run.
+    """
+    metrics = InMemoryMetrics()
+    deduper = NyckelNearDuplicateDeduper(
+        "client-id",
+        "client-secret",
+        max_nbr_concurrent_requests=max_nbr_concurrent_requests,
+        metrics=metrics,
+        host=host,
+    )
+    usage_before = resource.getrusage(resource.RUSAGE_SELF), resource.getrusage(resource.RUSAGE_CHILDREN)
+    t0 = time.perf_counter()
+    clusters = deduper.dedupe_filelist(image_filelist)
+    wall_seconds = time.perf_counter() - t0
+    usage_after = resource.getrusage(resource.RUSAGE_SELF), resource.getrusage(resource.RUSAGE_CHILDREN)
+
+    cpu_seconds = sum(
+        (after.ru_utime - before.ru_utime) + (after.ru_stime - before.ru_stime)
+        for before, after in zip(usage_before, usage_after)
+    )
+    request_latency = {}
+    for stage in ("post", "search"):
+        histogram = metrics.histogram("request_seconds", stage=stage)
+        request_latency[stage] = {
+            "count": histogram.count,
+            "p50": histogram.quantile(0.5),
+            "p95": histogram.quantile(0.95),
+            "p99": histogram.quantile(0.99),
+            "max": histogram.max,
+        }
+    results.put(
+        {
+            "images_per_sec": len(image_filelist) / wall_seconds,
+            "wall_seconds": wall_seconds,
+            "cpu_seconds": cpu_seconds,
+            # ru_maxrss is in KiB on Linux. Children are the preprocessing workers; this is the largest of them.
+            "peak_rss_mb": usage_after[0].ru_maxrss / 1024,
+            "worker_peak_rss_mb": usage_after[1].ru_maxrss / 1024,
+            "request_latency_sec": request_latency,
+            "retries": metrics.counter("retries", stage="post") + metrics.counter("retries", stage="search"),
+            "throttled": metrics.counter("responses", stage="post", status="429")
+            + metrics.counter("responses", stage="search", status="429"),
+            "nbr_clusters": len(clusters),
+        }
+    )
+
+
+def _wait_for_measurements(process: multiprocessing.Process, results) -> dict:
+    while True:
+        try:
+            return results.get(timeout=1)
+        except queue.Empty:
+            if not process.is_alive():
+                raise RuntimeError(f"Benchmark run failed with exit code {process.exitcode}.")
+
+
+def run(
+    corpus_sizes=(1000, 10000),
+    image_size=(320, 240),
+    duplicate_fraction: float = 0.1,
+    latency_ms: float = 50.0,
+    latency_jitter_ms: float = 20.0,
+    error_rate: float = 0.0,
+    max_requests_per_sec: float = None,
+    max_nbr_concurrent_requests: int = 20,
+    corpus_dir: str = None,
+    output: str = "bench_dedupe.jsonl",
+    label: str = None,
+):
+    """
+    corpus_sizes: The numbers of images to dedupe, one run each.
+    image_size: The (width, height) of the synthetic images.
+    duplicate_fraction: The fraction of synthetic images that are copies of an earlier one.
+    latency_ms: The mean latency of each mock API call.
+    latency_jitter_ms: An additional uniform random latency up to this.
+    error_rate: The fraction of sample and search calls that fail with a 500.
+    max_requests_per_sec: If set, the mock server throttles sample and search calls beyond this rate with a 429.
+    max_nbr_concurrent_requests: Passed on to the deduper.
+    corpus_dir: Where synthetic images are kept between invocations. Defaults to a temporary folder.
+    output: The JSON lines file that results are appended to.
+    label: A free-form name for this version of the code, stored with the results.
+    """
+    # Fire passes a single --corpus_sizes 200 as an int.
+    corpus_sizes = (corpus_sizes,) if isinstance(corpus_sizes, int) else corpus_sizes
+    corpus_dir = corpus_dir or os.path.join(tempfile.gettempdir(), "deduper_bench_corpus")
+    server_kwargs = dict(
+        latency_ms=latency_ms,
+        latency_jitter_ms=latency_jitter_ms,
+        error_rate=error_rate,
+        max_requests_per_sec=max_requests_per_sec,
+    )
+    context = multiprocessing.get_context("spawn")
+    with MockNyckelServerProcess(**server_kwargs) as host:
+        for nbr_images in corpus_sizes:
+            image_filelist = _corpus(corpus_dir, nbr_images, image_size, duplicate_fraction)
+            results = context.Queue()
+            process = context.Process(
+                target=_dedupe_in_this_process, args=(host, image_filelist, max_nbr_concurrent_requests, results)
+            )
+            process.start()
+            measurements = _wait_for_measurements(process, results)
+            process.join()
+            record = {
+                "benchmark": "dedupe",
+                "timestamp": time.time(),
+                "label": label,
+                "git_revision": _git_revision(),
+                "python": platform.python_version(),
+                "cpu_count": os.cpu_count(),
+                "nbr_images": nbr_images,
+                "image_size": list(image_size),
+                "duplicate_fraction": duplicate_fraction,
+                **server_kwargs,
+                "max_nbr_concurrent_requests": max_nbr_concurrent_requests,
+                **measurements,
+            }
+            with open(output, "a") as f:
+                f.write(json.dumps(record) + "\n")
+            print(
+                f"{nbr_images:>9} images: {measurements['images_per_sec']:8.1f} img/s, "
+                f"search p95 {measurements['request_latency_sec']['search']['p95'] * 1000:7.1f} ms, "
+                f"CPU {measurements['cpu_seconds']:7.1f} s, peak RSS {measurements['peak_rss_mb']:7.1f} MB"
+            )
+
+
+def _latest_by_config(path: str) -> Dict[tuple, dict]:
+    latest = {}
+    with open(path) as f:
+        for line in f:
+            record = json.loads(line)
+            latest[tuple(json.dumps(record.get(field)) for field in CONFIG_FIELDS)] = record
+    return latest
+
+
+def compare(baseline: str, candidate: str):
+    """
+    Prints, for every configuration run in both files, the change from baseline to candidate of throughput, search
+    p95 latency, CPU time per image and peak RSS. Later runs of a configuration replace earlier ones.
+
+    baseline: A results file of the reference version.
+    candidate: A results file of the version to check.
+    """
+    baseline_by_config = _latest_by_config(baseline)
+    candidate_by_config = _latest_by_config(candidate)
+    print(f"{'images':>9} {'img/s':>26} {'search p95 ms':>26} {'CPU ms/img':>26} {'peak RSS MB':>26}")
+    for config in sorted(set(baseline_by_config) & set(candidate_by_config), key=lambda config: json.loads(config[0])):
+        old, new = baseline_by_config[config], candidate_by_config[config]
+        changes = [
+            _change(old["images_per_sec"], new["images_per_sec"]),
+            _change(
+                old["request_latency_sec"]["search"]["p95"] * 1000, new["request_latency_sec"]["search"]["p95"] * 1000
+            ),
+            _change(old["cpu_seconds"] / old["nbr_images"] * 1000, new["cpu_seconds"] / new["nbr_images"] * 1000),
+            _change(old["peak_rss_mb"], new["peak_rss_mb"]),
+        ]
+        print(f"{new['nbr_images']:>9} " + " ".join(f"{change:>26}" for change in changes))
+
+
+def _change(old: float, new: float) -> str:
+    return f"{old:.1f} -> {new:.1f} ({(new / old - 1) * 100 if old else 0:+.0f}%)"
+
+
+if __name__ == "__main__":
+    fire.Fire({"run": run, "compare": compare})
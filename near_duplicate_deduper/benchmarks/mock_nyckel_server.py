@@ -0,0 +1,226 @@
+"""
+A local stand-in for the parts of the Nyckel API that the deduper uses, for benchmarks that must not touch the network.
+
+Samples are identified by the hash of their image bytes, sent either as a base64 data URI in JSON or as a
+multipart/form-data "data" field. A search returns the searched image itself first and then other samples in
+insertion order, with a distance that is 0 for identical data and 1 otherwise.
+
+Sample and search calls can be made to fail at random with a 500, and to be throttled with a 429 and a Retry-After
+header beyond a number of calls per second, to exercise the retry and backoff paths of the clients.
+
+Run standalone from the near_duplicate_deduper folder:
+
+    python -m benchmarks.mock_nyckel_server --port 8765 --latency_ms 50 --error_rate 0.01 --max_requests_per_sec 500
+"""
+
+import asyncio
+import base64
+import hashlib
+import multiprocessing
+import random
+import socket
+import time
+
+import fire
+from aiohttp import web
+
+
+class MockNyckelServer:
+    def __init__(
+        self,
+        latency_ms: float = 0.0,
+        latency_jitter_ms: float = 0.0,
+        error_rate: float = 0.0,
+        max_requests_per_sec: float = None,
+        retry_after_sec: float = 1.0,
+    ):
+        """
+        latency_ms: The mean time each API call waits before responding.
+        latency_jitter_ms: Each call waits an additional uniform random time up to this.
+        error_rate: The fraction of sample and search calls that fail with a 500.
+        max_requests_per_sec: If set, sample and search calls beyond this rate, with a burst of one second's worth,
+            are throttled with a 429.
+        retry_after_sec: The Retry-After of throttled calls.
+        """
+        self._latency_ms = latency_ms
+        self._latency_jitter_ms = latency_jitter_ms
+        self._error_rate = error_rate
+        self._max_requests_per_sec = max_requests_per_sec
+        self._retry_after_sec = retry_after_sec
+        self._tokens = max_requests_per_sec or 0.0
+        self._tokens_updated = time.monotonic()
+        self._sample_ids_by_function = {}
+        self._external_ids_by_function = {}
+        self._function_counter = 0
+
+    def app(self) -> web.Application:
+        app = web.Application(client_max_size=64 * 2**20)
+        app.add_routes(
+            [
+                web.post("/connect/token", self.token),
+                web.post("/v1/functions/", self.create_function),
+                web.get("/v1/functions/{function_id}", self.get_function),
+                web.delete("/v1/functions/{function_id}", self.delete_function),
+                web.post("/v1/functions/{function_id}/samples", self.post_sample),
+                web.delete("/v1/functions/{function_id}/samples/{sample_id}", self.delete_sample),
+                web.post("/v0.9/functions/{function_id}/search", self.search),
+            ]
+        )
+        return app
+
+    async def _wait(self):
+        delay_ms = self._latency_ms + random.uniform(0, self._latency_jitter_ms)
+        if delay_ms > 0:
+            await asyncio.sleep(delay_ms / 1000)
+
+    def _failure(self):
+        """
+        Returns the error response to send instead of handling a sample or search call, or None.
+        """
+        if self._max_requests_per_sec:
+            now = time.monotonic()
+            self._tokens = min(
+                self._max_requests_per_sec, self._tokens + (now - self._tokens_updated) * self._max_requests_per_sec
+            )
+            self._tokens_updated = now
+            if self._tokens < 1:
+                return web.json_response(
+                    {"message": "Too many requests"}, status=429, headers={"Retry-After": str(self._retry_after_sec)}
+                )
+            self._tokens -= 1
+        if self._error_rate and random.random() < self._error_rate:
+            return web.json_response({"message": "Injected failure"}, status=500)
+        return None
+
+    @staticmethod
+    async def _image_hash(request: web.Request) -> str:
+        if request.content_type == "multipart/form-data":
+            image_bytes = (await request.post())["data"].file.read()
+        else:
+            image_bytes = base64.b64decode((await request.json())["data"].split(",", 1)[1])
+        return hashlib.sha1(image_bytes).hexdigest()
+
+    @staticmethod
+    async def _external_id(request: web.Request) -> str:
+        if request.content_type == "multipart/form-data":
+            return (await request.post()).get("externalId")
+        return (await request.json()).get("externalId")
+
+    async def token(self, request: web.Request) -> web.Response:
+        await self._wait()
+        return web.json_response({"access_token": "mock-token", "expires_in": 3600, "token_type": "Bearer"})
+
+    async def create_function(self, request: web.Request) -> web.Response:
+        await self._wait()
+        self._function_counter += 1
+        function_id = f"{self._function_counter:016d}"
+        self._sample_ids_by_function[function_id] = {}
+        self._external_ids_by_function[function_id] = {}
+        return web.json_response({"id": f"function_{function_id}"})
+
+    async def get_function(self, request: web.Request) -> web.Response:
+        await self._wait()
+        function_id = request.match_info["function_id"]
+        if function_id not in self._sample_ids_by_function:
+            return web.json_response({"message": "Function not found"}, status=404)
+        return web.json_response({"id": f"function_{function_id}", "input": "Image", "output": "Search"})
+
+    async def delete_function(self, request: web.Request) -> web.Response:
+        await self._wait()
+        self._sample_ids_by_function.pop(request.match_info["function_id"], None)
+        self._external_ids_by_function.pop(request.match_info["function_id"], None)
+        return web.json_response({})
+
+    async def post_sample(self, request: web.Request) -> web.Response:
+        samples = self._sample_ids_by_function[request.match_info["function_id"]]
+        data_hash = await self._image_hash(request)
+        external_id = await self._external_id(request)
+        await self._wait()
+        failure = self._failure()
+        if failure:
+            return failure
+        if data_hash in samples:
+            return web.json_response({"id": samples[data_hash]}, status=409)
+        samples[data_hash] = f"sample_{len(samples):012d}"
+        if external_id is not None:
+            self._external_ids_by_function[request.match_info["function_id"]][samples[data_hash]] = external_id
+        return web.json_response({"id": samples[data_hash]})
+
+    async def delete_sample(self, request: web.Request) -> web.Response:
+        await self._wait()
+        samples = self._sample_ids_by_function[request.match_info["function_id"]]
+        for data_hash, sample_id in list(samples.items()):
+            if sample_id == request.match_info["sample_id"]:
+                del samples[data_hash]
+                return web.json_response({})
+        return web.json_response({"message": "Sample not found"}, status=404)
+
+    async def search(self, request: web.Request) -> web.Response:
+        samples = self._sample_ids_by_function[request.match_info["function_id"]]
+        external_ids = self._external_ids_by_function[request.match_info["function_id"]]
+        sample_count = int(request.query.get("sampleCount", 1))
+        data_hash = await self._image_hash(request)
+        await self._wait()
+        failure = self._failure()
+        if failure:
+            return failure
+        search_samples = []
+        if data_hash in samples:
+            search_samples.append({"sampleId": samples[data_hash], "distance": 0.0})
+        for other_hash, sample_id in samples.items():
+            if len(search_samples) >= sample_count:
+                break
+            if other_hash != data_hash:
+                search_samples.append({"sampleId": sample_id, "distance": 1.0})
+        for search_sample in search_samples:
+            if search_sample["sampleId"] in external_ids:
+                search_sample["externalId"] = external_ids[search_sample["sampleId"]]
+        return web.json_response({"searchSamples": search_samples})
+
+
+def serve(port: int = 8765, **server_kwargs):
+    """
+    Serves the mock API on localhost until interrupted. server_kwargs are passed on to MockNyckelServer.
+    """
+    web.run_app(MockNyckelServer(**server_kwargs).app(), host="127.0.0.1", port=port, print=None, access_log=None)
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+class MockNyckelServerProcess:
+    """
+    Runs the mock server in a child process, so its CPU use does not count against the client being measured.
+
+    Usage:
+        with MockNyckelServerProcess(latency_ms=50) as host:
+            NyckelNearDuplicateDeduper(..., host=host)
+    """
+
+    def __init__(self, **server_kwargs):
+        self._server_kwargs = server_kwargs
+        self._port = free_port()
+        self._process = multiprocessing.Process(target=serve, kwargs={"port": self._port, **server_kwargs}, daemon=True)
+
+    def __enter__(self) -> str:
+        self._process.start()
+        deadline = time.time() + 10
+        while time.time() < deadline:
+            try:
+                socket.create_connection(("127.0.0.1", self._port), timeout=0.1).close()
+                return f"http://127.0.0.1:{self._port}"
+            except OSError:
+                time.sleep(0.05)
+        self._process.terminate()
+        raise RuntimeError("Mock Nyckel server did not start.")
+
+    def __exit__(self, *exc_info):
+        self._process.terminate()
+        self._process.join()
+
+
+if __name__ == "__main__":
+    fire.Fire(serve)
@@ -0,0 +1,49 @@
+"""
+Writes synthetic image folders for the benchmarks.
+"""
+
+import os
+import random
+from typing import List
+
+from PIL import Image, ImageDraw
+
+
+def make_synthetic_corpus(
+    folder: str, nbr_images: int, size=(640, 480), duplicate_fraction: float = 0.0, seed: int = 0
+) -> List[str]:
+    """
+    Writes nbr_images random JPEGs of rectangles and ellipses to folder.
+
+    folder: The folder to write to. Created if missing.
+    nbr_images: The number of images to write.
+    size: The (width, height) of each image.
+    duplicate_fraction: The fraction of images that are byte-identical copies of an earlier image.
+    seed: The random seed.
+
+    Returns the list of written file paths.
+    """
+    os.makedirs(folder, exist_ok=True)
+    rng = random.Random(seed)
+    filelist = []
+    for itt in range(nbr_images):
+        img_file = os.path.join(folder, f"synthetic_{itt:08d}.jpg")
+        if filelist and rng.random() < duplicate_fraction:
+            with open(rng.choice(filelist), "rb") as source, open(img_file, "wb") as target:
+                target.write(source.read())
+        else:
+            _random_image(rng, size).save(img_file, format="JPEG", quality=90)
+        filelist.append(img_file)
+    return filelist
+
+
+def _random_image(rng: random.Random, size) -> Image.Image:
+    img = Image.new("RGB", size, tuple(rng.randrange(256) for _ in range(3)))
+    draw = ImageDraw.Draw(img)
+    width, height = size
+    for _ in range(8):
+        x0, y0 = rng.randrange(width), rng.randrange(height)
+        x1, y1 = x0 + rng.randrange(width // 2), y0 + rng.randrange(height // 2)
+        shape = draw.rectangle if rng.random() < 0.5 else draw.ellipse
+        shape([x0, y0, x1, y1], fill=tuple(rng.randrange(256) for _ in range(3)))
+    return img
@@ -0,0 +1,152 @@
+import threading
+import time
+from email.utils import parsedate_to_datetime
+from typing import Callable, Optional
+
+import requests
+
+
+class AdaptiveConcurrencyLimiter:
+    """
+    Bounds the number of requests in flight with a window that adapts to what the API can take, AIMD style.
+
+    While the window is full, it grows by one for every window's worth of fast, successful requests. It halves on a
+    throttling response (429 or a 5xx), a connection error, or a latency spike, meaning a moving average of recent
+    latencies above latency_tolerance times the baseline latency. The baseline follows the fastest requests, so it
+    tracks the unloaded latency of the API. At most one decrease happens per baseline round-trip, so a burst of
+    failures from the same overload only halves the window once. A Retry-After header pauses all new requests
+    until then.
+
+    Usage:
+        limiter = AdaptiveConcurrencyLimiter(max_limit=64)
+        response = limiter.call(session.post, url, json=...)  # From any number of threads.
+    """
+
+    def __init__(
+        self,
+        initial_limit: int = 8,
+        min_limit: int = 1,
+        max_limit: int = 256,
+        backoff_factor: float = 0.5,
+        latency_tolerance: float = 2.0,
+    ):
+        """
+        initial_limit: The window to start with.
+        min_limit: The smallest the window gets.
+        max_limit: The largest the window gets. Size thread pools that go through the limiter to this.
+        backoff_factor: The factor applied to the window on a decrease.
+        latency_tolerance: How many times the baseline latency counts as a spike.
+        """
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self._limit = float(max(min_limit, min(initial_limit, max_limit)))
+        self._backoff_factor = backoff_factor
+        self._latency_tolerance = latency_tolerance
+        self._baseline_latency: Optional[float] = None
+        self._recent_latency: Optional[float] = None
+        self._in_flight = 0
+        self._paused_until = 0.0
+        self._last_decrease = 0.0
+        self._condition = threading.Condition()
+
+    @property
+    def limit(self) -> int:
+        """
+        The current window.
+        """
+        return int(self._limit)
+
+    def acquire(self):
+        """
+        Waits for a free slot in the window and for any Retry-After pause to end.
+        """
+        with self._condition:
+            while True:
+                pause = self._paused_until - time.monotonic()
+                if pause <= 0 and self._in_flight < int(self._limit):
+                    self._in_flight += 1
+                    return
+                self._condition.wait(timeout=pause if pause > 0 else None)
+
+    def release(self, latency_sec: float, throttled: bool = False, retry_after_sec: float = None):
+        """
+        Frees a slot and adapts the window to the outcome of the request.
+
+        latency_sec: How long the request took.
+        throttled: Whether the request was throttled or failed because the API was overloaded.
+        retry_after_sec: The Retry-After of the response, if any.
+        """
+        with self._condition:
+            window_was_full = self._in_flight >= int(self._limit)
+            self._in_flight -= 1
+            now = time.monotonic()
+            if retry_after_sec:
+                self._paused_until = max(self._paused_until, now + retry_after_sec)
+            if not throttled:
+                if self._baseline_latency is None or latency_sec < self._baseline_latency:
+                    self._baseline_latency = latency_sec
+                else:
+                    self._baseline_latency += 0.01 * (latency_sec - self._baseline_latency)
+                if self._recent_latency is None:
+                    self._recent_latency = latency_sec
+                else:
+                    self._recent_latency += 0.1 * (latency_sec - self._recent_latency)
+            spike = (
+                self._recent_latency is not None
+                and self._recent_latency > self._latency_tolerance * self._baseline_latency
+            )
+            if throttled or spike:
+                if now - self._last_decrease > (self._baseline_latency or 0.0):
+                    self._limit = max(self.min_limit, self._limit * self._backoff_factor)
+                    self._last_decrease = now
+            elif window_was_full:
+                self._limit = min(self.max_limit, self._limit + 1 / self._limit)
+            self._condition.notify_all()
+
+    def call(self, request_fn: Callable[..., requests.Response], *args, **kwargs) -> requests.Response:
+        """
+        Sends a request within the window and adapts the window to its response.
+
+        request_fn: A function that sends the request and returns a requests.Response, such as session.post.
+        args, kwargs: Passed on to request_fn.
+
+        Returns the response. Errors raised by request_fn, such as connection errors, count as throttling and are
+        raised.
+        """
+        self.acquire()
+        t0 = time.monotonic()
+        try:
+            response = request_fn(*args, **kwargs)
+        except Exception:
+            self.release(time.monotonic() - t0, throttled=True)
+            raise
+        self.release(
+            time.monotonic() - t0,
+            throttled=is_overload_status(response.status_code),
+            retry_after_sec=retry_after_seconds(response),
+        )
+        return response
+
+
+def retry_after_seconds(response: requests.Response) -> Optional[float]:
+    """
+    Reads the Retry-After header of a response, given either as seconds or as an HTTP date, as a number of seconds.
+    """
+    value = response.headers.get("Retry-After")
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def is_overload_status(status_code: int) -> bool:
+    """
+    Tells whether a response status means the API is throttling or overloaded, so the request can be retried later.
+    """
+    return status_code == 429 or status_code >= 500
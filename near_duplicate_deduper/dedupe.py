@@ -1,23 +1,124 @@
-import glob
-import os
+import contextlib
+import itertools
 
 import fire
 import time
 
+from dedupe_index import iter_dedupe
+from discovery import discover_images, read_manifest
+from incremental_search_backend import IncrementalNyckelSearchBackend
+from local_prefilter import LocalDuplicatePrefilter
+from local_search_backend import LocalVectorSearchBackend
+from metrics import NULL_METRICS, InMemoryMetrics, profile_run
+from preprocessing import PayloadEncoder
 from near_duplicate_deduper import NyckelNearDuplicateDeduper
+from result_store import DedupeResultStore
 
-COMMON_IMAGE_EXTENSIONS = ["jpg", "png", "jpeg", "JPG", "JPEG", "PNG"]
 
+def main(
+    client_id: str = None,
+    client_secret: str = None,
+    folder: str = None,
+    max_nbr_file_to_dedupe: int = 10,
+    local_prefilter_max_hamming_distance: int = None,
+    duplication_threshold: float = 0.05,
+    nbr_neighbours: int = 1,
+    embeddings_file: str = None,
+    embeddings_index_file: str = None,
+    result_store: str = None,
+    result_store_max_entries: int = 10_000_000,
+    recursive: bool = True,
+    include: list = None,
+    exclude: list = None,
+    sniff: bool = False,
+    manifest: str = None,
+    stream: bool = False,
+    metrics_file: str = None,
+    prometheus_file: str = None,
+    profile_file: str = None,
+    profiler: str = "cprofile",
+    upload_format: str = "JPEG",
+    upload_quality: int = None,
+    passthrough_max_bytes: int = 0,
+    multipart_upload: bool = False,
+):
+    if not embeddings_file and not (client_id and client_secret):
+        raise ValueError("Give the Nyckel client_id and client_secret, or search offline with --embeddings_file.")
+    if stream and (local_prefilter_max_hamming_distance is not None or embeddings_file or result_store):
+        raise ValueError(
+            "--stream searches a temporary Nyckel function as it goes, so it can not be combined with "
+            "--local_prefilter_max_hamming_distance, --embeddings_file or --result_store."
+        )
+    if manifest:
+        image_paths = read_manifest(manifest)
+    elif folder:
+        image_paths = discover_images(
+            folder,
+            recursive=recursive,
+            include=[include] if isinstance(include, str) else include,
+            exclude=[exclude] if isinstance(exclude, str) else exclude,
+            sniff=sniff,
+        )
+    else:
+        raise ValueError("Give the folder to dedupe, or a --manifest of image file paths.")
+    image_paths = itertools.islice(image_paths, max_nbr_file_to_dedupe)
 
-def main(client_id: str, client_secret: str, folder: str, max_nbr_file_to_dedupe: int = 10):
-    image_filelist = []
-    for image_extension in COMMON_IMAGE_EXTENSIONS:
-        image_filelist.extend(glob.glob(os.path.join(folder, f"*.{image_extension}")))
-    image_filelist = image_filelist[:max_nbr_file_to_dedupe]
+    metrics = InMemoryMetrics() if metrics_file or prometheus_file else NULL_METRICS
+    payload_encoder = PayloadEncoder(upload_format, quality=upload_quality, passthrough_max_bytes=passthrough_max_bytes)
+    if stream:
+        with profile_run(profile_file, profiler=profiler) if profile_file else contextlib.nullcontext():
+            stream_dedupe(
+                client_id,
+                client_secret,
+                image_paths,
+                duplication_threshold,
+                nbr_neighbours=nbr_neighbours,
+                payload_encoder=payload_encoder,
+                multipart_upload=multipart_upload,
+                metrics=metrics,
+            )
+        _write_metrics(metrics, metrics_file, prometheus_file, folder or manifest)
+        return
+    image_filelist = list(image_paths)
+
+    local_prefilter = None
+    if local_prefilter_max_hamming_distance is not None:
+        local_prefilter = LocalDuplicatePrefilter(max_hamming_distance=local_prefilter_max_hamming_distance)
+
+    search_backend = None
+    if embeddings_file:
+        search_backend = LocalVectorSearchBackend(
+            embeddings_file=embeddings_file, embeddings_index_file=embeddings_index_file
+        )
+    elif result_store:
+        search_backend = IncrementalNyckelSearchBackend(
+            client_id,
+            client_secret,
+            DedupeResultStore(result_store, max_entries=result_store_max_entries),
+            payload_encoder=payload_encoder,
+            multipart_upload=multipart_upload,
+            metrics=metrics,
+        )
 
     t0 = time.time()
-    duplicate_clusters = NyckelNearDuplicateDeduper(client_id, client_secret).dedupe_filelist(image_filelist)
+    deduper = NyckelNearDuplicateDeduper(
+        client_id,
+        client_secret,
+        duplication_threshold=duplication_threshold,
+        local_prefilter=local_prefilter,
+        search_backend=search_backend,
+        nbr_neighbours=nbr_neighbours,
+        payload_encoder=payload_encoder,
+        multipart_upload=multipart_upload,
+        metrics=metrics,
+    )
+    if profile_file:
+        with profile_run(profile_file, profiler=profiler):
+            duplicate_clusters = deduper.dedupe_filelist(image_filelist)
+    else:
+        duplicate_clusters = deduper.dedupe_filelist(image_filelist)
     runtime = time.time() - t0
+    _write_metrics(metrics, metrics_file, prometheus_file, folder or manifest)
 
     print("----")
     print(f"Deduped {len(image_filelist)} images in {runtime} seconds.")
@@ -26,5 +127,36 @@ def main(client_id: str, client_secret: str, folder: str, max_nbr_file_to_dedupe
         print(f"Cluster1: {cluster}")
 
 
+def _write_metrics(metrics, metrics_file: str, prometheus_file: str, folder: str):
+    if metrics_file:
+        metrics.write_jsonl(metrics_file, folder=folder)
+    if prometheus_file:
+        with open(prometheus_file, "w") as f:
+            f.write(metrics.to_prometheus())
+
+
+def stream_dedupe(client_id: str, client_secret: str, image_paths, duplication_threshold: float, **index_options):
+    """
+    Dedupes in a single pass over the paths as they are discovered, printing each duplicate as soon as it is found.
+    index_options are passed on to iter_dedupe.
+    """
+    t0 = time.time()
+    cluster_by_file = {}
+    for update in iter_dedupe(
+        image_paths, client_id, client_secret, duplication_threshold=duplication_threshold, **index_options
+    ):
+        print(f"Duplicate: {update.img_file} matches {[member for member, _ in update.matches]}")
+        for member in update.cluster:
+            cluster_by_file[member] = update.cluster
+    runtime = time.time() - t0
+
+    duplicate_clusters = list({id(cluster): cluster for cluster in cluster_by_file.values()}.values())
+    print("----")
+    print(f"Streamed dedupe in {runtime} seconds.")
+    print(f"Found {len(duplicate_clusters)} clusters of duplicates")
+    for cluster in duplicate_clusters:
+        print(f"Cluster1: {cluster}")
+
+
 if __name__ == "__main__":
     fire.Fire(main)
@@ -0,0 +1,254 @@
+import concurrent.futures
+import itertools
+import os
+import threading
+from typing import Dict, Iterable, Iterator, List, NamedTuple, Set, Tuple
+
+from metrics import NULL_METRICS, MetricsSink
+from near_duplicate_deduper import IMAGE_SIZE_FOR_POSTING, NYCKEL_HOST, DuplicateClusterIdentifier, NyckelSearchBackend
+from preprocessing import DEFAULT_PAYLOAD_ENCODER, PayloadEncoder, build_payload
+
+
+class DedupeUpdate(NamedTuple):
+    img_file: str
+    matches: List[Tuple[str, float]]  # (file path, distance) tuples sorted by distance.
+    cluster: Set[str]  # The duplicate cluster of img_file after adding it.
+
+
+class DedupeIndex:
+    """
+    Long-lived near-duplicate index over a growing set of images.
+
+    Keeps one Nyckel search function alive for the lifetime of the index, so checking a new image costs one
+    post and one search instead of a full dedupe of the corpus. Duplicate clusters are kept up to date with
+    every insert. Each file path is stored as the externalId of its sample on the server and read back from the
+    search results, so the index only holds the members of duplicate clusters in memory.
+
+    Usage:
+        with DedupeIndex(client_id, client_secret) as index:
+            index.add(existing_files)
+            matches = index.query([uploaded_file])
+    """
+
+    def __init__(
+        self,
+        client_id: str,
+        client_secret: str,
+        duplication_threshold: float = 0.05,
+        nbr_neighbours: int = 5,
+        max_nbr_concurrent_requests: int = 20,
+        max_nbr_preprocessing_workers: int = None,
+        payload_encoder: PayloadEncoder = DEFAULT_PAYLOAD_ENCODER,
+        multipart_upload: bool = False,
+        metrics: MetricsSink = NULL_METRICS,
+        host: str = NYCKEL_HOST,
+    ):
+        """
+        client_id: The Nyckel client ID.
+        client_secret: The Nyckel client secret.
+        duplication_threshold: The threshold above which two images are not considered duplicates.
+        nbr_neighbours: The maximum number of existing members returned as matches per image.
+        max_nbr_concurrent_requests: The maximum number of concurrent requests to the Nyckel function.
+        max_nbr_preprocessing_workers: The number of processes that decode and encode images. Defaults to the CPU count.
+        payload_encoder: How images are encoded for upload.
+        multipart_upload: If set, images are uploaded as multipart/form-data instead of base64 JSON.
+        metrics: Receives the request metrics of the search function.
+        host: The Nyckel API host.
+        """
+        self._duplication_threshold = duplication_threshold
+        self._nbr_neighbours = nbr_neighbours
+        self._max_nbr_concurrent_requests = max_nbr_concurrent_requests
+        self._search_backend = NyckelSearchBackend(
+            client_id,
+            client_secret,
+            max_nbr_concurrent_requests=max_nbr_concurrent_requests,
+            payload_encoder=payload_encoder,
+            multipart_upload=multipart_upload,
+            metrics=metrics,
+            host=host,
+        )
+        self._search_backend.open()
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_nbr_concurrent_requests)
+        self._process_pool = concurrent.futures.ProcessPoolExecutor(
+            max_workers=max_nbr_preprocessing_workers or os.cpu_count()
+        )
+        self._nbr_members = 0
+        self._cluster_identifier = DuplicateClusterIdentifier()
+        self._lock = threading.Lock()
+
+    def __enter__(self) -> "DedupeIndex":
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __len__(self) -> int:
+        return self._nbr_members
+
+    def close(self):
+        """
+        Deletes the search function and stops the worker pools.
+        """
+        self._executor.shutdown()
+        self._process_pool.shutdown()
+        self._search_backend.close()
+
+    def add(self, image_filelist: Iterable[str]) -> Dict[str, List[Tuple[str, float]]]:
+        """
+        Adds images to the index and updates the duplicate clusters.
+
+        Each image is posted before it is searched, so two duplicates in the same call always find each other:
+        whichever of the two is searched last sees the other one posted.
+
+        image_filelist: The file paths of the images to add.
+
+        Returns a dictionary mapping each added file path to its matches among the members of the index,
+        including the other images of this call, as (file path, distance) tuples sorted by distance.
+        """
+        return dict(self._executor.map(self._add_one_image, list(image_filelist)))
+
+    def iter_add(
+        self, image_paths: Iterable[str], max_nbr_queued_images: int = None
+    ) -> Iterator[Tuple[str, List[Tuple[str, float]]]]:
+        """
+        Adds images to the index as they are read from an iterable, yielding their matches as soon as they are known.
+
+        At most max_nbr_queued_images images are read ahead of the results, so the paths can come from a lazy
+        directory walk or a stream and memory stays bounded however many there are.
+
+        image_paths: The file paths of the images to add.
+        max_nbr_queued_images: The maximum number of images in flight. Defaults to twice the number of
+            concurrent requests.
+
+        Yields (file path, matches) tuples in completion order, with matches as in `add`.
+        """
+        max_nbr_queued_images = max_nbr_queued_images or 2 * self._max_nbr_concurrent_requests
+        image_paths = iter(image_paths)
+        pending = set(
+            self._executor.submit(self._add_one_image, path)
+            for path in itertools.islice(image_paths, max_nbr_queued_images)
+        )
+        while pending:
+            done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for path in itertools.islice(image_paths, len(done)):
+                pending.add(self._executor.submit(self._add_one_image, path))
+            for future in done:
+                yield future.result()
+
+    def query(self, image_filelist: Iterable[str]) -> Dict[str, List[Tuple[str, float]]]:
+        """
+        Finds the members of the index that each image duplicates, without adding the images.
+
+        image_filelist: The file paths of the images to look up.
+
+        Returns a dictionary mapping each file path to its matches as (file path, distance) tuples sorted by
+        distance. A file that is itself a member does not match itself.
+        """
+        return dict(self._executor.map(self._query_one_image, list(image_filelist)))
+
+    @property
+    def clusters(self) -> List[Set[str]]:
+        """
+        The duplicate clusters among the members of the index.
+        """
+        with self._lock:
+            return self._cluster_identifier.clusters
+
+    def cluster_of(self, img_file: str) -> Set[str]:
+        """
+        The duplicate cluster of a member, or a singleton if it has no duplicates.
+        """
+        with self._lock:
+            if img_file in self._cluster_identifier:
+                return self._cluster_identifier.cluster_of(img_file)
+        return {img_file}
+
+    def _build_payload(self, img_file_path: str) -> bytes:
+        return self._process_pool.submit(
+            build_payload, img_file_path, IMAGE_SIZE_FOR_POSTING, self._search_backend.payload_encoder
+        ).result()
+
+    def _add_one_image(self, img_file_path: str) -> Tuple[str, List[Tuple[str, float]]]:
+        payload = self._build_payload(img_file_path)
+        # An identical copy shares the sample, and so the external ID, of the first file posted with it, which then
+        # comes back from the search as its match.
+        self._search_backend.post_payload(payload, description=img_file_path, external_id=img_file_path)
+        search_samples = self._search_backend.search_payload(
+            payload, self._nbr_neighbours + 1, description=img_file_path
+        )
+        matches = self._matches(search_samples, exclude_filename=img_file_path)
+        with self._lock:
+            self._nbr_members += 1
+            self._cluster_identifier.add_pairs((img_file_path, member) for member, _ in matches)
+        return img_file_path, matches
+
+    def _query_one_image(self, img_file_path: str) -> Tuple[str, List[Tuple[str, float]]]:
+        search_samples = self._search_backend.search_payload(
+            self._build_payload(img_file_path), self._nbr_neighbours + 1, description=img_file_path
+        )
+        return img_file_path, self._matches(search_samples, exclude_filename=img_file_path)
+
+    def _matches(self, search_samples: List[dict], exclude_filename: str):
+        matches = []
+        for search_sample in search_samples:
+            member = search_sample.get("externalId")
+            if member is None or member == exclude_filename:
+                continue
+            if search_sample["distance"] < self._duplication_threshold:
+                matches.append((member, search_sample["distance"]))
+        return matches[: self._nbr_neighbours]
+
+
+def iter_dedupe(
+    image_paths: Iterable[str],
+    client_id: str,
+    client_secret: str,
+    duplication_threshold: float = 0.05,
+    nbr_neighbours: int = 5,
+    max_nbr_concurrent_requests: int = 20,
+    max_nbr_queued_images: int = None,
+    max_nbr_preprocessing_workers: int = None,
+    payload_encoder: PayloadEncoder = DEFAULT_PAYLOAD_ENCODER,
+    multipart_upload: bool = False,
+    metrics: MetricsSink = NULL_METRICS,
+    host: str = NYCKEL_HOST,
+) -> Iterator[DedupeUpdate]:
+    """
+    Dedupes a stream of images in a single pass, yielding each duplicate as soon as it is found.
+
+    Each image is posted and then searched against everything posted before it, so there is no index phase that has
+    to finish before the first result. Paths are read lazily with at most max_nbr_queued_images in flight. File
+    paths are kept on the server as the samples' externalId, so apart from the images in flight, memory grows only
+    with the members of duplicate clusters, not with the number of images streamed.
+
+    image_paths: The file paths of the images to dedupe. Can be a generator.
+    client_id: The Nyckel client ID.
+    client_secret: The Nyckel client secret.
+    duplication_threshold: The threshold above which two images are not considered duplicates.
+    nbr_neighbours: The maximum number of earlier images returned as matches per image.
+    max_nbr_concurrent_requests: The maximum number of concurrent requests to the Nyckel function.
+    max_nbr_queued_images: The maximum number of images read ahead of the results.
+    max_nbr_preprocessing_workers: The number of processes that decode and encode images. Defaults to the CPU count.
+    payload_encoder: How images are encoded for upload.
+    multipart_upload: If set, images are uploaded as multipart/form-data instead of base64 JSON.
+    metrics: Receives the request metrics of the search function.
+    host: The Nyckel API host.
+
+    Yields a DedupeUpdate for every image that duplicates an earlier one, with the updated cluster it belongs to.
+    The last update for any member of a cluster holds the cluster as it stands at the end.
+    """
+    with DedupeIndex(
+        client_id,
+        client_secret,
+        duplication_threshold=duplication_threshold,
+        nbr_neighbours=nbr_neighbours,
+        max_nbr_concurrent_requests=max_nbr_concurrent_requests,
+        max_nbr_preprocessing_workers=max_nbr_preprocessing_workers,
+        payload_encoder=payload_encoder,
+        multipart_upload=multipart_upload,
+        metrics=metrics,
+        host=host,
+    ) as index:
+        for img_file, matches in index.iter_add(image_paths, max_nbr_queued_images=max_nbr_queued_images):
+            if matches:
+                yield DedupeUpdate(img_file, matches, index.cluster_of(img_file))
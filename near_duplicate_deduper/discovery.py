@@ -0,0 +1,128 @@
+import concurrent.futures
+import fnmatch
+import os
+import sys
+from typing import Iterator, List, Sequence, Tuple
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".webp", ".bmp", ".gif", ".tif", ".tiff")
+
+# Leading bytes of the image formats in IMAGE_EXTENSIONS. WebP is checked separately, since its signature has a gap.
+IMAGE_SIGNATURES = (
+    b"\xff\xd8\xff",
+    b"\x89PNG\r\n\x1a\n",
+    b"BM",
+    b"GIF87a",
+    b"GIF89a",
+    b"II*\x00",
+    b"MM\x00*",
+)
+
+
+def is_image_header(header: bytes) -> bool:
+    """
+    Tells whether the first bytes of a file look like one of the supported image formats.
+    """
+    return header.startswith(IMAGE_SIGNATURES) or (header[:4] == b"RIFF" and header[8:12] == b"WEBP")
+
+
+def discover_images(
+    folder: str,
+    recursive: bool = True,
+    include: Sequence[str] = None,
+    exclude: Sequence[str] = None,
+    sniff: bool = False,
+    max_nbr_workers: int = 16,
+) -> Iterator[str]:
+    """
+    Walks a folder for image files, listing several directories at once, and yields paths as they are found.
+
+    Directories are listed with os.scandir in a thread pool, so on network file systems many listings are in flight
+    at once and the first paths come out long before the walk is done. The order of the paths is not deterministic.
+
+    folder: The folder to walk.
+    recursive: Whether to descend into subfolders. Symlinked folders are not followed.
+    include: If set, only files whose path relative to folder matches one of these glob patterns are yielded.
+    exclude: Files and subfolders whose relative path matches one of these glob patterns are skipped.
+    sniff: If set, files are recognized by their first bytes instead of their extension. This opens every file,
+        but finds images with a missing or wrong extension and skips files that only have an image extension.
+    max_nbr_workers: The number of directories listed at once.
+
+    Yields the file paths of the images.
+    """
+    include = list(include or [])
+    exclude = list(exclude or [])
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_nbr_workers)
+    try:
+        pending = {executor.submit(_scan_directory, folder, folder, include, exclude, sniff)}
+        while pending:
+            done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                image_files, subfolders = future.result()
+                if recursive:
+                    for subfolder in subfolders:
+                        pending.add(executor.submit(_scan_directory, subfolder, folder, include, exclude, sniff))
+                yield from image_files
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+def read_manifest(manifest: str) -> Iterator[str]:
+    """
+    Reads image file paths from a text file with one path per line, or from stdin if manifest is "-".
+    Blank lines are skipped.
+
+    manifest: The manifest file path, or "-".
+
+    Yields the file paths as they are read.
+    """
+    if manifest == "-":
+        yield from _stripped_lines(sys.stdin)
+        return
+    with open(manifest) as lines:
+        yield from _stripped_lines(lines)
+
+
+def _stripped_lines(lines) -> Iterator[str]:
+    for line in lines:
+        line = line.strip()
+        if line:
+            yield line
+
+
+def _matches_any(relative_path: str, patterns: List[str]) -> bool:
+    return any(fnmatch.fnmatch(relative_path, pattern) for pattern in patterns)
+
+
+def _scan_directory(
+    directory: str, root: str, include: List[str], exclude: List[str], sniff: bool
+) -> Tuple[List[str], List[str]]:
+    """
+    Lists one directory. Runs in the discovery thread pool.
+
+    Returns the image files and the subfolders to walk next.
+    """
+    image_files, subfolders = [], []
+    try:
+        entries = sorted(os.scandir(directory), key=lambda entry: entry.name)
+    except OSError as error:
+        print(f"Skipping {directory}: {error}")
+        return image_files, subfolders
+    for entry in entries:
+        relative_path = os.path.relpath(entry.path, root).replace(os.sep, "/")
+        if exclude and _matches_any(relative_path, exclude):
+            continue
+        if entry.is_dir(follow_symlinks=False):
+            subfolders.append(entry.path)
+            continue
+        if not entry.is_file() or (include and not _matches_any(relative_path, include)):
+            continue
+        if sniff:
+            try:
+                with open(entry.path, "rb") as f:
+                    if is_image_header(f.read(12)):
+                        image_files.append(entry.path)
+            except OSError:
+                continue
+        elif os.path.splitext(entry.name)[1].lower() in IMAGE_EXTENSIONS:
+            image_files.append(entry.path)
+    return image_files, subfolders
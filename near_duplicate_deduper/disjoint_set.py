@@ -0,0 +1,146 @@
+from array import array
+from typing import Dict, Hashable, List, Set
+
+
+class DisjointSet:
+    """
+    Union-find over arbitrary hashable members.
+
+    Members are interned to consecutive integer node ids on first sight. Parents and ranks are kept in compact
+    arrays indexed by node id, so a union or find costs a couple of array lookups instead of a scan over clusters.
+    Uses path compression and union by rank, which makes a sequence of operations near-linear in its length.
+    The members of each set are also linked in a circular list, so one set can be listed without a full scan.
+    """
+
+    def __init__(self):
+        self._node_by_member: Dict[Hashable, int] = {}
+        self._members: List[Hashable] = []
+        self._parent = array("q")
+        self._rank = bytearray()
+        self._next = array("q")
+
+    def __len__(self) -> int:
+        return len(self._members)
+
+    def __contains__(self, member: Hashable) -> bool:
+        return member in self._node_by_member
+
+    def add(self, member: Hashable) -> int:
+        """
+        Adds a member as a singleton set, unless it is already known.
+
+        member: The member to add.
+
+        Returns the integer node id of the member.
+        """
+        node = self._node_by_member.get(member)
+        if node is None:
+            node = len(self._members)
+            self._node_by_member[member] = node
+            self._members.append(member)
+            self._parent.append(node)
+            self._rank.append(0)
+            self._next.append(node)
+        return node
+
+    def union(self, member1: Hashable, member2: Hashable) -> int:
+        """
+        Merges the sets of two members, adding the members if they are new.
+
+        member1: The first member.
+        member2: The second member.
+
+        Returns the node id of the root of the merged set.
+        """
+        return self.union_nodes(self.add(member1), self.add(member2))
+
+    def union_nodes(self, node1: int, node2: int) -> int:
+        """
+        Merges the sets of two node ids. The node ids must come from `add`.
+
+        node1: The first node id.
+        node2: The second node id.
+
+        Returns the node id of the root of the merged set.
+        """
+        root1 = self.find_node(node1)
+        root2 = self.find_node(node2)
+        if root1 == root2:
+            return root1
+        rank = self._rank
+        if rank[root1] < rank[root2]:
+            root1, root2 = root2, root1
+        self._parent[root2] = root1
+        self._next[root1], self._next[root2] = self._next[root2], self._next[root1]
+        if rank[root1] == rank[root2]:
+            rank[root1] += 1
+        return root1
+
+    def find(self, member: Hashable) -> Hashable:
+        """
+        Finds the representative member of the set that a member belongs to.
+
+        member: The member to look up. Raises KeyError if it was never added.
+
+        Returns the representative member.
+        """
+        return self._members[self.find_node(self._node_by_member[member])]
+
+    def find_node(self, node: int) -> int:
+        """
+        Finds the root node id of the set that a node id belongs to, compressing the path on the way.
+
+        node: The node id to look up.
+
+        Returns the root node id.
+        """
+        parent = self._parent
+        root = node
+        while parent[root] != root:
+            root = parent[root]
+        while parent[node] != root:
+            parent[node], node = root, parent[node]
+        return root
+
+    def node_of(self, member: Hashable) -> int:
+        """
+        Returns the node id of a member. Raises KeyError if it was never added.
+        """
+        return self._node_by_member[member]
+
+    def member_of(self, node: int) -> Hashable:
+        """
+        Returns the member interned as a node id.
+        """
+        return self._members[node]
+
+    def group_of(self, member: Hashable) -> Set[Hashable]:
+        """
+        Lists the set that a member belongs to, in time proportional to the size of the set.
+
+        member: The member to look up. Raises KeyError if it was never added.
+
+        Returns the set of members.
+        """
+        start = node = self._node_by_member[member]
+        group = set()
+        while True:
+            group.add(self._members[node])
+            node = self._next[node]
+            if node == start:
+                return group
+
+    def groups(self) -> List[Set[Hashable]]:
+        """
+        Lists all sets, ordered by the first time any of their members was added.
+
+        Returns a list of sets of members.
+        """
+        group_by_root: Dict[int, Set[Hashable]] = {}
+        for node, member in enumerate(self._members):
+            root = self.find_node(node)
+            group = group_by_root.get(root)
+            if group is None:
+                group = group_by_root[root] = set()
+            group.add(member)
+        return list(group_by_root.values())
@@ -0,0 +1,86 @@
+from typing import Dict, Iterator, List, Tuple
+
+import numpy as np
+
+
+class DuplicateGraph:
+    """
+    Undirected graph of duplicate edges between images, in compressed sparse row form.
+
+    Members are the file names that take part in at least one edge, numbered in order of first appearance. Each
+    edge is stored once, in the row of its lower-numbered end, so node i's neighbours with a higher number are
+    indices[indptr[i]:indptr[i + 1]]. Edges found from both ends, or by several neighbours of the same image,
+    collapse to a single entry.
+    """
+
+    def __init__(self, members: List[str], indptr: np.ndarray, indices: np.ndarray):
+        """
+        members: The file name of each node.
+        indptr: An array of len(members) + 1 offsets into indices.
+        indices: The higher-numbered end of each edge, sorted within each row.
+        """
+        self.members = members
+        self.indptr = indptr
+        self.indices = indices
+
+    def __len__(self) -> int:
+        return len(self.indices)
+
+    @classmethod
+    def from_neighbours(
+        cls,
+        filename_by_sample_id: Dict[str, str],
+        neighbours_by_filename: Dict[str, List[dict]],
+        duplication_threshold: float,
+    ) -> "DuplicateGraph":
+        """
+        Builds the graph of every search result closer than the duplication threshold.
+
+        filename_by_sample_id: A dictionary mapping sample IDs to file names.
+        neighbours_by_filename: A dictionary mapping file names to their search results, as returned by
+            SearchBackend.search_neighbours.
+        duplication_threshold: The distance at and above which two images are not considered duplicates.
+
+        Returns the graph.
+        """
+        node_by_member: Dict[str, int] = {}
+        sources, targets = [], []
+        for filename, neighbours in neighbours_by_filename.items():
+            for neighbour in neighbours:
+                if neighbour["distance"] >= duplication_threshold:
+                    continue
+                other = filename_by_sample_id[neighbour["sampleId"]]
+                if other == filename:
+                    continue
+                sources.append(node_by_member.setdefault(filename, len(node_by_member)))
+                targets.append(node_by_member.setdefault(other, len(node_by_member)))
+        return cls.from_edges(
+            list(node_by_member), np.array(sources, dtype=np.int64), np.array(targets, dtype=np.int64)
+        )
+
+    @classmethod
+    def from_edges(cls, members: List[str], sources: np.ndarray, targets: np.ndarray) -> "DuplicateGraph":
+        """
+        Builds the graph from edges given as two arrays of node numbers. Self-loops and repeated edges are dropped.
+
+        members: The file name of each node.
+        sources: One end of each edge.
+        targets: The other end of each edge.
+
+        Returns the graph.
+        """
+        nbr_nodes = len(members)
+        low, high = np.minimum(sources, targets), np.maximum(sources, targets)
+        keys = np.unique((low * nbr_nodes + high)[low != high])
+        rows, indices = np.divmod(keys, max(nbr_nodes, 1))
+        indptr = np.zeros(nbr_nodes + 1, dtype=np.int64)
+        np.cumsum(np.bincount(rows, minlength=nbr_nodes), out=indptr[1:])
+        return cls(members, indptr, indices)
+
+    def edges(self) -> Iterator[Tuple[str, str]]:
+        """
+        Yields each edge once, as a pair of file names.
+        """
+        for node, (start, stop) in enumerate(zip(self.indptr[:-1].tolist(), self.indptr[1:].tolist())):
+            for other in self.indices[start:stop].tolist():
+                yield self.members[node], self.members[other]
@@ -0,0 +1,196 @@
+import concurrent.futures
+import time
+from typing import Dict, List, Optional
+
+from local_prefilter import content_hash
+from near_duplicate_deduper import IMAGE_SIZE_FOR_POSTING, NyckelSearchBackend
+from preprocessing import PayloadCache, build_payloads
+from result_store import DedupeResultStore, StoredImage
+from search_backend import SearchBackend
+
+
+class IncrementalNyckelSearchBackend(NyckelSearchBackend):
+    """
+    NyckelSearchBackend that keeps its function between runs and remembers results in a DedupeResultStore,
+    so a rerun over a mostly unchanged folder only posts and searches the new or changed files.
+
+    Images are identified by content hash. On a rerun, an image is searched again only if it was never searched
+    or if its stored nearest neighbour is no longer in the file list. Every search asks for a small neighbourhood
+    rather than only the closest match, and since distances are symmetric, each returned neighbour that is closer
+    than what was stored for it is updated too. That is how new images become the nearest neighbours of old
+    images without searching the old images again. Files with identical content share one sample, and every file
+    but the first of them is matched to the first at distance 0.
+    """
+
+    def __init__(
+        self, client_id: str, client_secret: str, result_store: DedupeResultStore, neighbourhood_size: int = 5, **kwargs
+    ):
+        """
+        client_id: The Nyckel client ID.
+        client_secret: The Nyckel client secret.
+        result_store: Where the function ID and results are kept between runs.
+        neighbourhood_size: The number of closest other samples to request per search.
+        kwargs: Passed on to NyckelSearchBackend.
+        """
+        super().__init__(client_id, client_secret, **kwargs)
+        self._result_store = result_store
+        self._neighbourhood_size = neighbourhood_size
+        self._params: str
+        self._content_hash_by_filename: Dict[str, str] = {}
+        self._files_by_hash: Dict[str, List[str]] = {}
+        self._stored_by_hash: Dict[str, StoredImage] = {}
+
+    def open(self):
+        self._initialize_session()
+        meta_key = f"function_id:{self._host}"
+        function_id = self._result_store.get_meta(meta_key)
+        if function_id and self._function_exists(function_id):
+            self._function_id = function_id
+        else:
+            self._create_function()
+            self._result_store.set_meta(meta_key, self._function_id)
+        width, height = IMAGE_SIZE_FOR_POSTING
+        self._params = f"{self._function_id}:{width}x{height}:{self.payload_encoder.params}"
+        self._payload_cache = PayloadCache(max_memory_bytes=self._payload_cache_max_memory_bytes)
+
+    def close(self):
+        """
+        Keeps the function for the next run, but deletes the samples of images evicted from the result store.
+        """
+        self._payload_cache.close()
+        try:
+            evicted_sample_ids = self._result_store.evict(self._function_id)
+            if evicted_sample_ids:
+                with concurrent.futures.ThreadPoolExecutor(max_workers=self._max_nbr_concurrent_requests) as executor:
+                    list(executor.map(self._delete_sample, evicted_sample_ids))
+                print(f"Deleted {len(evicted_sample_ids)} samples evicted from the result store.")
+        finally:
+            self._access_tokens.close()
+
+    def index_images(self, image_filelist: List[str]) -> Dict[str, str]:
+        """
+        Posts the images whose content was not posted in an earlier run.
+
+        image_filelist: A list of image file paths.
+
+        Returns a dictionary mapping sample IDs to file names, with the first file of each content hash.
+        """
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self._max_nbr_concurrent_requests) as executor:
+            self._content_hash_by_filename = dict(zip(image_filelist, executor.map(content_hash, image_filelist)))
+        self._files_by_hash = {}
+        for img_file, file_hash in self._content_hash_by_filename.items():
+            self._files_by_hash.setdefault(file_hash, []).append(img_file)
+        self._stored_by_hash = self._result_store.lookup(self._files_by_hash, self._params)
+
+        file_by_new_hash = {
+            file_hash: files[0]
+            for file_hash, files in self._files_by_hash.items()
+            if file_hash not in self._stored_by_hash
+        }
+        nbr_posted_before = sum(
+            len(files) for file_hash, files in self._files_by_hash.items() if file_hash in self._stored_by_hash
+        )
+        print(f"{nbr_posted_before} images were already posted in earlier runs.")
+        if file_by_new_hash:
+            filename_by_new_sample_id = self._post_images(list(file_by_new_hash.values()))
+            sample_id_by_new_hash = {
+                self._content_hash_by_filename[img_file]: sample_id
+                for sample_id, img_file in filename_by_new_sample_id.items()
+            }
+            self._result_store.put_samples(sample_id_by_new_hash, self._params)
+            for file_hash, sample_id in sample_id_by_new_hash.items():
+                self._stored_by_hash[file_hash] = StoredImage(file_hash, sample_id, None, None)
+
+        return {self._stored_by_hash[file_hash].sample_id: files[0] for file_hash, files in self._files_by_hash.items()}
+
+    def search_images(self, image_filelist: List[str]) -> Dict[str, Optional[dict]]:
+        """
+        Searches the images that have no valid stored nearest neighbour, and updates the neighbourhoods around them.
+
+        image_filelist: A list of image file paths. Must have been indexed.
+
+        Returns a dictionary mapping file names to the search result of the closest match, for all images. A file
+        with the same content as an earlier file in the list is matched to that file's sample at distance 0.
+        """
+        present_hashes = set(self._content_hash_by_filename[img_file] for img_file in image_filelist)
+        file_by_hash_to_search = {}
+        for img_file in image_filelist:
+            stored = self._stored_by_hash[self._content_hash_by_filename[img_file]]
+            if stored.neighbour_hash not in present_hashes:
+                file_by_hash_to_search.setdefault(stored.content_hash, img_file)
+                self._stored_by_hash[stored.content_hash] = stored._replace(neighbour_hash=None, distance=None)
+        print(f"Searching {len(file_by_hash_to_search)} images whose neighbourhood changed...")
+
+        t0 = time.time()
+        files_to_search = list(file_by_hash_to_search.values())
+        for img_file, payload in build_payloads(
+            [img_file for img_file in files_to_search if img_file not in self._payload_cache],
+            IMAGE_SIZE_FOR_POSTING,
+            max_workers=self._max_nbr_preprocessing_workers,
+            encoder=self.payload_encoder,
+            metrics=self._metrics,
+        ):
+            self._payload_cache[img_file] = payload
+        hash_by_sample_id = {
+            stored.sample_id: file_hash
+            for file_hash, stored in self._stored_by_hash.items()
+            if file_hash in present_hashes
+        }
+        changed_hashes = set(file_by_hash_to_search)
+        with concurrent.futures.ThreadPoolExecutor(
+            max_workers=max(1, min(len(files_to_search), self._max_nbr_concurrent_requests))
+        ) as executor:
+            filename_by_futures = {
+                executor.submit(self._search_one_image, img_file, self._neighbourhood_size + 1): img_file
+                for img_file in files_to_search
+            }
+            for future in concurrent.futures.as_completed(filename_by_futures):
+                file_hash = self._content_hash_by_filename[filename_by_futures[future]]
+                for search_sample in future.result():
+                    neighbour_hash = hash_by_sample_id.get(search_sample["sampleId"])
+                    if neighbour_hash is None or neighbour_hash == file_hash:
+                        continue
+                    changed_hashes |= self._keep_if_closer(file_hash, neighbour_hash, search_sample["distance"])
+                    changed_hashes |= self._keep_if_closer(neighbour_hash, file_hash, search_sample["distance"])
+        self._result_store.put_neighbours(
+            [
+                (file_hash, self._stored_by_hash[file_hash].neighbour_hash, self._stored_by_hash[file_hash].distance)
+                for file_hash in changed_hashes
+            ],
+            self._params,
+        )
+        print(f"Searched {len(files_to_search)} images in {time.time() - t0} seconds.")
+
+        similarity_by_filename = {}
+        for img_file in image_filelist:
+            stored = self._stored_by_hash[self._content_hash_by_filename[img_file]]
+            if self._files_by_hash[stored.content_hash][0] != img_file:
+                similarity_by_filename[img_file] = {"sampleId": stored.sample_id, "distance": 0.0}
+            elif stored.neighbour_hash is None:
+                similarity_by_filename[img_file] = None
+            else:
+                neighbour_sample_id = self._stored_by_hash[stored.neighbour_hash].sample_id
+                similarity_by_filename[img_file] = {"sampleId": neighbour_sample_id, "distance": stored.distance}
+        return similarity_by_filename
+
+    def search_neighbours(self, image_filelist: List[str], nbr_neighbours: int) -> Dict[str, List[dict]]:
+        """
+        Returns only the stored nearest neighbour of each image, since that is all the result store keeps.
+        """
+        return SearchBackend.search_neighbours(self, image_filelist, nbr_neighbours)
+
+    def _keep_if_closer(self, file_hash: str, neighbour_hash: str, distance: float) -> set:
+        stored = self._stored_by_hash[file_hash]
+        if stored.distance is not None and stored.distance <= distance:
+            return set()
+        self._stored_by_hash[file_hash] = stored._replace(neighbour_hash=neighbour_hash, distance=distance)
+        return {file_hash}
+
+    def _function_exists(self, function_id: str) -> bool:
+        return self._request("GET", f"{self._host}/v1/functions/{function_id}", stage="get_function").status_code == 200
+
+    def _delete_sample(self, sample_id: str):
+        response = self._request(
+            "DELETE", f"{self._host}/v1/functions/{self._function_id}/samples/{sample_id}", stage="delete_sample"
+        )
+        assert response.status_code in [200, 404], f"Something went wrong when deleting sample {sample_id}"
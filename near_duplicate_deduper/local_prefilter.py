@@ -0,0 +1,209 @@
+import concurrent.futures
+import hashlib
+import os
+from functools import partial
+from typing import Dict, Iterable, Iterator, List, Tuple
+
+import numpy as np
+from PIL import Image
+
+from disjoint_set import DisjointSet
+
+DHASH_SIZE = 8
+PHASH_SIZE = 8
+PHASH_THUMBNAIL_SIZE = 32
+
+
+def content_hash(img_file_path: str, chunk_size: int = 2**20) -> str:
+    """
+    Computes the SHA-256 of the raw file bytes.
+    """
+    sha = hashlib.sha256()
+    with open(img_file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def grayscale_thumbnail(img_file_path: str, size: Tuple[int, int]) -> np.ndarray:
+    """
+    Decodes an image to a small grayscale thumbnail, which is all the perceptual hashes need.
+    JPEG sources are decoded at the smallest draft resolution that still covers the thumbnail.
+
+    img_file_path: The file path of the image.
+    size: The (width, height) of the thumbnail.
+
+    Returns a (height, width) uint8 array.
+    """
+    img = Image.open(img_file_path)
+    img.draft("L", size)
+    img = img.convert("L").resize(size, Image.BOX)
+    return np.asarray(img, dtype=np.uint8)
+
+
+def _hash_one_image(img_file_path: str, thumbnail_size: Tuple[int, int]) -> Tuple[str, np.ndarray]:
+    return content_hash(img_file_path), grayscale_thumbnail(img_file_path, thumbnail_size)
+
+
+def _pack_bits(bits: np.ndarray) -> np.ndarray:
+    """
+    Packs an (N, 64) boolean array into N unsigned 64-bit integers.
+    """
+    return np.packbits(bits, axis=1).view(">u8").ravel().astype(np.uint64)
+
+
+def dhash(thumbnails: np.ndarray) -> np.ndarray:
+    """
+    Computes 64-bit difference hashes for a stack of grayscale thumbnails.
+
+    thumbnails: An (N, DHASH_SIZE, DHASH_SIZE + 1) uint8 array.
+
+    Returns an (N,) uint64 array.
+    """
+    thumbnails = thumbnails.astype(np.int16)
+    return _pack_bits((thumbnails[:, :, 1:] > thumbnails[:, :, :-1]).reshape(thumbnails.shape[0], -1))
+
+
+def _dct_matrix(size: int) -> np.ndarray:
+    k = np.arange(size)[:, None]
+    x = np.arange(size)[None, :]
+    matrix = np.cos(np.pi * (2 * x + 1) * k / (2 * size)) * np.sqrt(2 / size)
+    matrix[0] /= np.sqrt(2)
+    return matrix
+
+
+def phash(thumbnails: np.ndarray) -> np.ndarray:
+    """
+    Computes 64-bit DCT perceptual hashes for a stack of grayscale thumbnails.
+
+    thumbnails: An (N, PHASH_THUMBNAIL_SIZE, PHASH_THUMBNAIL_SIZE) uint8 array.
+
+    Returns an (N,) uint64 array.
+    """
+    n = thumbnails.shape[0]
+    dct = _dct_matrix(thumbnails.shape[1])
+    coefficients = dct @ thumbnails.astype(np.float64) @ dct.T
+    low_frequencies = coefficients[:, :PHASH_SIZE, :PHASH_SIZE].reshape(n, -1)
+    medians = np.median(low_frequencies[:, 1:], axis=1, keepdims=True)
+    return _pack_bits(low_frequencies > medians)
+
+
+def hamming_distance(hash1: int, hash2: int) -> int:
+    return bin(hash1 ^ hash2).count("1")
+
+
+class BKTree:
+    """
+    Burkhard-Keller tree over 64-bit hashes with hamming distance, for finding all hashes within a radius
+    without comparing against every indexed hash.
+    """
+
+    def __init__(self):
+        self._root: list = None
+
+    def add(self, hash_value: int, item):
+        """
+        Indexes an item under its hash.
+        """
+        node = [hash_value, item, {}]
+        if self._root is None:
+            self._root = node
+            return
+        current = self._root
+        while True:
+            distance = hamming_distance(hash_value, current[0])
+            child = current[2].get(distance)
+            if child is None:
+                current[2][distance] = node
+                return
+            current = child
+
+    def search(self, hash_value: int, max_distance: int) -> Iterator[Tuple[int, object]]:
+        """
+        Finds all indexed items whose hash is within max_distance of hash_value.
+
+        Yields (distance, item) tuples in no particular order.
+        """
+        if self._root is None:
+            return
+        candidates = [self._root]
+        while candidates:
+            node_hash, item, children = candidates.pop()
+            distance = hamming_distance(hash_value, node_hash)
+            if distance <= max_distance:
+                yield distance, item
+            for child_distance in range(max(0, distance - max_distance), distance + max_distance + 1):
+                child = children.get(child_distance)
+                if child is not None:
+                    candidates.append(child)
+
+
+class LocalDuplicatePrefilter:
+    """
+    Groups exact and near-exact duplicates locally, so only one representative per group needs to go to the API.
+
+    Exact copies are grouped by the SHA-256 of their bytes. Trivial re-encodes and resizes are grouped by a
+    perceptual hash within a small hamming radius, looked up in a BK-tree.
+    """
+
+    def __init__(self, max_hamming_distance: int = 4, hash_method: str = "dhash", max_nbr_workers: int = None):
+        """
+        max_hamming_distance: Images whose perceptual hashes differ in at most this many of 64 bits are grouped.
+        hash_method: "dhash" or "phash".
+        max_nbr_workers: The number of processes that decode and hash images. Defaults to the CPU count.
+        """
+        assert hash_method in ["dhash", "phash"], f"Unknown hash method {hash_method}"
+        self._max_hamming_distance = max_hamming_distance
+        if hash_method == "dhash":
+            self._hash_function, self._thumbnail_size = dhash, (DHASH_SIZE + 1, DHASH_SIZE)
+        else:
+            self._hash_function, self._thumbnail_size = phash, (PHASH_THUMBNAIL_SIZE, PHASH_THUMBNAIL_SIZE)
+        self._max_nbr_workers = max_nbr_workers
+
+    def __call__(self, image_filelist: Iterable[str]) -> List[List[str]]:
+        """
+        Groups a list of image files into local duplicate groups.
+
+        image_filelist: A list of image file paths.
+
+        Returns a list of groups covering every file, each a list of file paths whose first entry is the
+        representative. Groups are in the order of their representative in image_filelist.
+        """
+        image_filelist = list(image_filelist)
+        if not image_filelist:
+            return []
+        content_hashes, thumbnails = self._hash_images(image_filelist)
+        perceptual_hashes = self._hash_function(thumbnails)
+
+        disjoint_set = DisjointSet()
+        first_file_by_content_hash: Dict[str, str] = {}
+        tree = BKTree()
+        for img_file, file_hash, perceptual_hash in zip(image_filelist, content_hashes, perceptual_hashes.tolist()):
+            disjoint_set.add(img_file)
+            if file_hash in first_file_by_content_hash:
+                disjoint_set.union(first_file_by_content_hash[file_hash], img_file)
+                continue
+            first_file_by_content_hash[file_hash] = img_file
+            for _, match in tree.search(perceptual_hash, self._max_hamming_distance):
+                disjoint_set.union(match, img_file)
+            tree.add(perceptual_hash, img_file)
+
+        return self._ordered_groups(disjoint_set, image_filelist)
+
+    def _hash_images(self, image_filelist: List[str]) -> Tuple[List[str], np.ndarray]:
+        max_workers = min(self._max_nbr_workers or os.cpu_count() or 1, len(image_filelist))
+        chunksize = max(1, min(256, len(image_filelist) // (4 * max_workers)))
+        with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers) as executor:
+            results = list(
+                executor.map(
+                    partial(_hash_one_image, thumbnail_size=self._thumbnail_size), image_filelist, chunksize=chunksize
+                )
+            )
+        return [file_hash for file_hash, _ in results], np.stack([thumbnail for _, thumbnail in results])
+
+    @staticmethod
+    def _ordered_groups(disjoint_set: DisjointSet, image_filelist: List[str]) -> List[List[str]]:
+        members_by_root: Dict[int, List[str]] = {}
+        for img_file in dict.fromkeys(image_filelist):
+            members_by_root.setdefault(disjoint_set.find_node(disjoint_set.node_of(img_file)), []).append(img_file)
+        return list(members_by_root.values())
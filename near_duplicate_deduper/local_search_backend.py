@@ -0,0 +1,199 @@
+import os
+import shutil
+import tempfile
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+
+from search_backend import SearchBackend
+
+
+class LocalVectorSearchBackend(SearchBackend):
+    """
+    Searches image embeddings locally, with no network.
+
+    Embeddings are kept as rows of a contiguous float32 matrix and searched exhaustively by cosine distance.
+    Queries and index rows are processed in blocks, so each step is one matrix multiplication followed by an
+    argpartition, and memory stays bounded by the block sizes. Matrices larger than max_in_memory_bytes are
+    memory-mapped from disk instead of loaded.
+
+    Embeddings come either from a callable that maps a file path to a 1-D vector, or from a precomputed .npy
+    matrix together with a text file that lists the image path of each row.
+    """
+
+    def __init__(
+        self,
+        embed: Callable[[str], np.ndarray] = None,
+        embeddings_file: str = None,
+        embeddings_index_file: str = None,
+        query_block_size: int = 1024,
+        index_block_size: int = 16384,
+        max_in_memory_bytes: int = 2**30,
+        memmap_dir: str = None,
+    ):
+        """
+        embed: A callable that returns the embedding of an image file.
+        embeddings_file: A .npy file with one embedding per row. Used instead of embed.
+        embeddings_index_file: A text file with the image file path of each row of embeddings_file, one per line.
+        query_block_size: The number of queries searched together.
+        index_block_size: The number of index rows compared against each query block at once.
+        max_in_memory_bytes: Embedding matrices larger than this are memory-mapped.
+        memmap_dir: The parent folder for memory-mapped matrices built from embed. Defaults to the system
+            temporary folder.
+        """
+        assert (embed is None) != (embeddings_file is None), "Pass exactly one of embed and embeddings_file."
+        assert embeddings_file is None or embeddings_index_file, "embeddings_file needs an embeddings_index_file."
+        self._embed = embed
+        self._embeddings_file = embeddings_file
+        self._embeddings_index_file = embeddings_index_file
+        self._query_block_size = query_block_size
+        self._index_block_size = index_block_size
+        self._max_in_memory_bytes = max_in_memory_bytes
+        self._memmap_parent_dir = memmap_dir
+        self._memmap_dir: str = None
+        self._embeddings: np.ndarray = None
+        self._inverse_norms: np.ndarray = None
+        self._row_by_filename: Dict[str, int] = {}
+
+    def close(self):
+        self._embeddings = None
+        self._inverse_norms = None
+        self._row_by_filename = {}
+        if self._memmap_dir:
+            shutil.rmtree(self._memmap_dir, ignore_errors=True)
+            self._memmap_dir = None
+
+    def index_images(self, image_filelist: List[str]) -> Dict[str, str]:
+        t0 = time.time()
+        if self._embed is not None:
+            self._embeddings = self._embed_images(image_filelist)
+        else:
+            self._embeddings = self._load_embeddings(image_filelist)
+        self._row_by_filename = {img_file: row for row, img_file in enumerate(image_filelist)}
+        self._inverse_norms = self._compute_inverse_norms(self._embeddings)
+        print(f"Indexed {len(image_filelist)} embeddings in {time.time() - t0} seconds.")
+        return {str(row): img_file for img_file, row in self._row_by_filename.items()}
+
+    def search_images(self, image_filelist: List[str]) -> Dict[str, Optional[dict]]:
+        neighbours_by_filename = self.search_neighbours(image_filelist, 1)
+        return {
+            img_file: neighbours[0] if neighbours else None for img_file, neighbours in neighbours_by_filename.items()
+        }
+
+    def search_neighbours(self, image_filelist: List[str], nbr_neighbours: int) -> Dict[str, List[dict]]:
+        t0 = time.time()
+        query_rows = np.array([self._row_by_filename[img_file] for img_file in image_filelist], dtype=np.int64)
+        distances, rows = self.top_k(query_rows, k=nbr_neighbours)
+        neighbours_by_filename = {}
+        for img_file, image_distances, image_rows in zip(image_filelist, distances.tolist(), rows.tolist()):
+            neighbours_by_filename[img_file] = [
+                {"sampleId": str(row), "distance": distance}
+                for distance, row in zip(image_distances, image_rows)
+                if row >= 0
+            ]
+        print(f"Searched {len(image_filelist)} embeddings in {time.time() - t0} seconds.")
+        return neighbours_by_filename
+
+    def top_k(self, query_rows: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Finds the k closest index rows to each query row by cosine distance, excluding the query row itself.
+
+        query_rows: A 1-D array of index rows to search for.
+        k: The number of neighbours to return.
+
+        Returns (distances, rows), two (len(query_rows), k) arrays sorted by increasing distance. Missing
+        neighbours, when the index holds fewer than k other rows, have row -1 and distance inf.
+        """
+        nbr_queries, nbr_rows = len(query_rows), self._embeddings.shape[0]
+        all_distances = np.full((nbr_queries, k), np.inf, dtype=np.float32)
+        all_rows = np.full((nbr_queries, k), -1, dtype=np.int64)
+        for query_start in range(0, nbr_queries, self._query_block_size):
+            query_block = query_rows[query_start : query_start + self._query_block_size]
+            queries = (
+                np.asarray(self._embeddings[query_block], dtype=np.float32) * self._inverse_norms[query_block, None]
+            )
+            best_similarities = np.full((len(query_block), k), -np.inf, dtype=np.float32)
+            best_rows = np.full((len(query_block), k), -1, dtype=np.int64)
+            for index_start in range(0, nbr_rows, self._index_block_size):
+                index_stop = min(index_start + self._index_block_size, nbr_rows)
+                index_block = np.asarray(self._embeddings[index_start:index_stop], dtype=np.float32)
+                similarities = queries @ index_block.T
+                similarities *= self._inverse_norms[None, index_start:index_stop]
+                self_queries = np.nonzero((query_block >= index_start) & (query_block < index_stop))[0]
+                similarities[self_queries, query_block[self_queries] - index_start] = -np.inf
+                best_similarities, best_rows = self._merge_top_k(
+                    best_similarities, best_rows, similarities, index_start, k
+                )
+            order = np.argsort(-best_similarities, axis=1, kind="stable")
+            best_similarities = np.take_along_axis(best_similarities, order, axis=1)
+            best_rows = np.take_along_axis(best_rows, order, axis=1)
+            found = np.isfinite(best_similarities)
+            block_slice = slice(query_start, query_start + len(query_block))
+            all_distances[block_slice] = np.where(found, 1 - best_similarities, np.inf)
+            all_rows[block_slice] = np.where(found, best_rows, -1)
+        return all_distances, all_rows
+
+    @staticmethod
+    def _merge_top_k(
+        best_similarities: np.ndarray, best_rows: np.ndarray, similarities: np.ndarray, row_offset: int, k: int
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        block_k = min(k, similarities.shape[1])
+        if block_k < similarities.shape[1]:
+            block_top = np.argpartition(-similarities, block_k - 1, axis=1)[:, :block_k]
+        else:
+            block_top = np.broadcast_to(np.arange(similarities.shape[1]), similarities.shape)
+        candidate_similarities = np.concatenate(
+            [best_similarities, np.take_along_axis(similarities, block_top, axis=1)], axis=1
+        )
+        candidate_rows = np.concatenate([best_rows, block_top + row_offset], axis=1)
+        keep = np.argpartition(-candidate_similarities, k - 1, axis=1)[:, :k]
+        best_similarities = np.take_along_axis(candidate_similarities, keep, axis=1)
+        best_rows = np.take_along_axis(candidate_rows, keep, axis=1)
+        return best_similarities, best_rows
+
+    @staticmethod
+    def _compute_inverse_norms(embeddings: np.ndarray, block_size: int = 65536) -> np.ndarray:
+        inverse_norms = np.empty(embeddings.shape[0], dtype=np.float32)
+        for start in range(0, embeddings.shape[0], block_size):
+            block = np.asarray(embeddings[start : start + block_size], dtype=np.float32)
+            norms = np.linalg.norm(block, axis=1)
+            inverse_norms[start : start + block_size] = np.divide(1, norms, out=np.zeros_like(norms), where=norms > 0)
+        return inverse_norms
+
+    def _allocate(self, shape: Tuple[int, int]) -> np.ndarray:
+        if shape[0] * shape[1] * 4 <= self._max_in_memory_bytes:
+            return np.empty(shape, dtype=np.float32)
+        if not self._memmap_dir:
+            self._memmap_dir = tempfile.mkdtemp(prefix="nyckel_embeddings_", dir=self._memmap_parent_dir)
+        return np.lib.format.open_memmap(
+            os.path.join(self._memmap_dir, "embeddings.npy"), mode="w+", dtype=np.float32, shape=shape
+        )
+
+    def _embed_images(self, image_filelist: List[str]) -> np.ndarray:
+        embeddings = None
+        for row, img_file in enumerate(image_filelist):
+            embedding = np.asarray(self._embed(img_file), dtype=np.float32).ravel()
+            if embeddings is None:
+                embeddings = self._allocate((len(image_filelist), embedding.shape[0]))
+            embeddings[row] = embedding
+        return embeddings if embeddings is not None else np.empty((0, 0), dtype=np.float32)
+
+    def _load_embeddings(self, image_filelist: List[str]) -> np.ndarray:
+        with open(self._embeddings_index_file, "r") as f:
+            row_by_filename = {line.rstrip("\n"): row for row, line in enumerate(f) if line.strip()}
+        mmap_mode = "r" if os.path.getsize(self._embeddings_file) > self._max_in_memory_bytes else None
+        embeddings = np.load(self._embeddings_file, mmap_mode=mmap_mode)
+        assert embeddings.ndim == 2 and embeddings.shape[0] == len(row_by_filename), (
+            f"{self._embeddings_file} has shape {embeddings.shape} but {self._embeddings_index_file} lists "
+            f"{len(row_by_filename)} files."
+        )
+        missing = [img_file for img_file in image_filelist if img_file not in row_by_filename]
+        assert not missing, f"No precomputed embedding for {len(missing)} files, e.g. {missing[0]}"
+        rows = np.array([row_by_filename[img_file] for img_file in image_filelist], dtype=np.int64)
+        if np.array_equal(rows, np.arange(embeddings.shape[0])) and embeddings.dtype == np.float32:
+            return embeddings
+        selected = self._allocate((len(rows), embeddings.shape[1]))
+        for start in range(0, len(rows), self._index_block_size):
+            selected[start : start + self._index_block_size] = embeddings[rows[start : start + self._index_block_size]]
+        return selected
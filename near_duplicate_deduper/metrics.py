@@ -0,0 +1,257 @@
+import bisect
+import contextlib
+import cProfile
+import json
+import math
+import threading
+import time
+from typing import Dict, Iterator, List, Tuple
+
+# Upper bounds of the histogram buckets: 1, 2 and 5 times each power of ten from 1e-4 to 1e9. Fine enough for
+# latencies in seconds and sizes in bytes alike.
+HISTOGRAM_BUCKETS = [m * 10.0**e for e in range(-4, 10) for m in (1, 2, 5)]
+
+
+class MetricsSink:
+    """
+    Receives measurements from the deduper. This base class drops them all, so instrumented code costs a method
+    call when metrics are not wanted.
+
+    Names are snake_case with a unit suffix, and labels are keyword arguments with string values, such as
+    stage="search".
+    """
+
+    def observe(self, name: str, value: float, **labels: str):
+        """
+        Records one sample of a distribution, such as a request latency.
+        """
+
+    def increment(self, name: str, value: float = 1, **labels: str):
+        """
+        Adds to a counter, such as the number of bytes uploaded.
+        """
+
+    def set_gauge(self, name: str, value: float, **labels: str):
+        """
+        Records the current value of a level, such as the number of requests in flight.
+        """
+
+    @contextlib.contextmanager
+    def timer(self, name: str, **labels: str) -> Iterator[None]:
+        """
+        Observes the wall-clock seconds spent in a with block.
+        """
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - t0, **labels)
+
+
+NULL_METRICS = MetricsSink()
+
+MetricKey = Tuple[str, Tuple[Tuple[str, str], ...]]
+
+
+class Histogram:
+    """
+    Bucketed distribution. Quantiles are interpolated within buckets, so they are exact to the bucket resolution.
+    """
+
+    def __init__(self):
+        self.bucket_counts = [0] * (len(HISTOGRAM_BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.min = math.inf
+        self.max = -math.inf
+
+    def add(self, value: float):
+        self.bucket_counts[bisect.bisect_left(HISTOGRAM_BUCKETS, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+
+    def quantile(self, q: float) -> float:
+        """
+        Estimates the q-quantile, for q between 0 and 1.
+        """
+        if not self.count:
+            return math.nan
+        rank = q * self.count
+        cumulative = 0
+        for bucket, bucket_count in enumerate(self.bucket_counts):
+            if bucket_count and cumulative + bucket_count >= rank:
+                lower = max(self.min, HISTOGRAM_BUCKETS[bucket - 1] if bucket else self.min)
+                upper = min(self.max, HISTOGRAM_BUCKETS[bucket] if bucket < len(HISTOGRAM_BUCKETS) else self.max)
+                return lower + (upper - lower) * (rank - cumulative) / bucket_count
+            cumulative += bucket_count
+        return self.max
+
+
+class InMemoryMetrics(MetricsSink):
+    """
+    Thread-safe sink that aggregates measurements in memory, for export as JSON lines or in the Prometheus text
+    format. Gauges keep both their last and their highest value.
+    """
+
+    def __init__(self):
+        self._histograms: Dict[MetricKey, Histogram] = {}
+        self._counters: Dict[MetricKey, float] = {}
+        self._gauges: Dict[MetricKey, float] = {}
+        self._gauge_maxima: Dict[MetricKey, float] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, name: str, value: float, **labels: str):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram()
+            histogram.add(value)
+
+    def increment(self, name: str, value: float = 1, **labels: str):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def set_gauge(self, name: str, value: float, **labels: str):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._gauges[key] = value
+            self._gauge_maxima[key] = max(self._gauge_maxima.get(key, value), value)
+
+    def histogram(self, name: str, **labels: str) -> Histogram:
+        """
+        Returns the histogram of a metric, empty if nothing was observed.
+        """
+        with self._lock:
+            return self._histograms.get((name, tuple(sorted(labels.items()))), Histogram())
+
+    def counter(self, name: str, **labels: str) -> float:
+        with self._lock:
+            return self._counters.get((name, tuple(sorted(labels.items()))), 0)
+
+    def to_records(self) -> List[dict]:
+        """
+        Lists every metric as a dictionary with its name, labels, type and values. Histograms are summarized by
+        count, sum, min, max, p50, p95 and p99.
+        """
+        records = []
+        with self._lock:
+            for (name, labels), histogram in sorted(self._histograms.items()):
+                records.append(
+                    {
+                        "name": name,
+                        "labels": dict(labels),
+                        "type": "histogram",
+                        "count": histogram.count,
+                        "sum": histogram.sum,
+                        "min": histogram.min,
+                        "max": histogram.max,
+                        "p50": histogram.quantile(0.5),
+                        "p95": histogram.quantile(0.95),
+                        "p99": histogram.quantile(0.99),
+                    }
+                )
+            for (name, labels), value in sorted(self._counters.items()):
+                records.append({"name": name, "labels": dict(labels), "type": "counter", "value": value})
+            for key, value in sorted(self._gauges.items()):
+                name, labels = key
+                records.append(
+                    {
+                        "name": name,
+                        "labels": dict(labels),
+                        "type": "gauge",
+                        "value": value,
+                        "max": self._gauge_maxima[key],
+                    }
+                )
+        return records
+
+    def write_jsonl(self, path: str, **run_labels: str):
+        """
+        Appends one JSON line per metric to a file, each stamped with the time and run_labels, so snapshots of
+        several runs can be collected in one file.
+        """
+        timestamp = time.time()
+        with open(path, "a") as f:
+            for record in self.to_records():
+                f.write(json.dumps({"timestamp": timestamp, **run_labels, **record}) + "\n")
+
+    def to_prometheus(self, prefix: str = "deduper_") -> str:
+        """
+        Renders the metrics in the Prometheus text exposition format, for a textfile collector or a push gateway.
+        """
+        lines = []
+        with self._lock:
+            histograms = sorted(self._histograms.items())
+            counters = sorted(self._counters.items())
+            gauges = sorted(self._gauges.items())
+        declared = set()
+
+        def _declare(name, metric_type):
+            if name not in declared:
+                lines.append(f"# TYPE {name} {metric_type}")
+                declared.add(name)
+
+        for (name, labels), histogram in histograms:
+            name = prefix + name
+            _declare(name, "histogram")
+            cumulative = 0
+            for upper, bucket_count in zip(HISTOGRAM_BUCKETS + [math.inf], histogram.bucket_counts):
+                cumulative += bucket_count
+                if bucket_count or upper == math.inf:
+                    le = "+Inf" if upper == math.inf else repr(upper)
+                    lines.append(f"{name}_bucket{_prometheus_labels(labels + (('le', le),))} {cumulative}")
+            lines.append(f"{name}_sum{_prometheus_labels(labels)} {histogram.sum}")
+            lines.append(f"{name}_count{_prometheus_labels(labels)} {histogram.count}")
+        for (name, labels), value in counters:
+            name = prefix + name + "_total"
+            _declare(name, "counter")
+            lines.append(f"{name}{_prometheus_labels(labels)} {value}")
+        for (name, labels), value in gauges:
+            name = prefix + name
+            _declare(name, "gauge")
+            lines.append(f"{name}{_prometheus_labels(labels)} {value}")
+        return "\n".join(lines) + "\n"
+
+
+def _prometheus_labels(labels: Tuple[Tuple[str, str], ...]) -> str:
+    if not labels:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, value in labels)
+    return "{" + ",".join(f'{key}="{value}"' for (key, _), value in zip(labels, escaped)) + "}"
+
+
+@contextlib.contextmanager
+def profile_run(path: str, profiler: str = "cprofile") -> Iterator[None]:
+    """
+    Profiles the with block and writes the result to path.
+
+    path: Where to write the profile. A pstats file for cProfile, an HTML page for pyinstrument.
+    profiler: "cprofile", or "pyinstrument", which must then be installed.
+    """
+    if profiler == "cprofile":
+        profile = cProfile.Profile()
+        profile.enable()
+        try:
+            yield
+        finally:
+            profile.disable()
+            profile.dump_stats(path)
+            print(f"Wrote cProfile stats to {path}. View them with: python -m pstats {path}")
+    elif profiler == "pyinstrument":
+        from pyinstrument import Profiler
+
+        profile = Profiler()
+        profile.start()
+        try:
+            yield
+        finally:
+            profile.stop()
+            with open(path, "w") as f:
+                f.write(profile.output_html())
+            print(f"Wrote pyinstrument profile to {path}.")
+    else:
+        raise ValueError(f"Unknown profiler: {profiler}")
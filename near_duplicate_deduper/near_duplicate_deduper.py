@@ -1,12 +1,30 @@
 import base64
 import concurrent.futures
+import threading
 import time
-from io import BytesIO
-from typing import List, Set, Tuple
+from typing import Dict, Iterable, List, Optional, Set, Tuple
 
+import numpy as np
 import requests
 from PIL import Image
 
+from concurrency import AdaptiveConcurrencyLimiter, is_overload_status
+from disjoint_set import DisjointSet
+from duplicate_graph import DuplicateGraph
+from local_prefilter import LocalDuplicatePrefilter
+from metrics import NULL_METRICS, MetricsSink
+from preprocessing import (
+    DEFAULT_PAYLOAD_ENCODER,
+    PayloadCache,
+    PayloadEncoder,
+    build_payloads,
+    encode_image,
+    payload_mime_type,
+)
+from search_backend import SearchBackend
+from token_manager import AccessTokenManager
+
+NYCKEL_HOST = "https://www.nyckel.com"
 IMAGE_SIZE_FOR_POSTING = [224, 224]
 
 
@@ -14,70 +32,111 @@ def base64encoded_image(img: Image, format="JPEG"):
     """
     Converts a PIL Image to a base64-encoded string.
     """
-    buffered = BytesIO()
-    if not img.mode == "RGB":
-        img = img.convert("RGB")
-    img.save(buffered, format=format)
-    encoded_string = base64.b64encode(buffered.getvalue()).decode("utf-8")
-    return "data:image/jpg;base64," + encoded_string
+    return base64encoded_payload(encode_image(img, format=format))
 
 
-class NyckelNearDuplicateDeduper:
+def base64encoded_payload(payload: bytes):
+    """
+    Converts already encoded image bytes to a base64-encoded data URI, labelled with the MIME type of the bytes.
+    """
+    encoded_string = base64.b64encode(payload).decode("ascii")
+    return f"data:{payload_mime_type(payload)};base64," + encoded_string
+
+
+class NyckelSearchBackend(SearchBackend):
+    """
+    Searches with a temporary Nyckel Image Search function, which is created on open and deleted on close.
+    """
+
     def __init__(
         self,
         client_id: str,
         client_secret: str,
-        duplication_threshold: float = 0.05,
         max_nbr_concurrent_requests: int = 20,
+        max_nbr_preprocessing_workers: int = None,
+        payload_cache_max_memory_bytes: int = 512 * 2**20,
+        payload_encoder: PayloadEncoder = DEFAULT_PAYLOAD_ENCODER,
+        multipart_upload: bool = False,
+        concurrency_limiter: AdaptiveConcurrencyLimiter = None,
+        max_nbr_attempts: int = 5,
+        metrics: MetricsSink = NULL_METRICS,
+        host: str = NYCKEL_HOST,
     ):
         """
-        Initializes a new instance of the NyckelNearDuplicateDeduper class.
-
         client_id: The Nyckel client ID.
         client_secret: The Nyckel client secret.
-        duplication_threshold: The threshold above which two images are not considered duplicates.
-        max_nbr_concurrent_requests: The maximum number of concurrent requests to the Nyckel function.
+        max_nbr_concurrent_requests: The maximum number of concurrent requests to the Nyckel function. Requests go
+            through an adaptive concurrency limiter, so fewer may be in flight while the API is throttling.
+        max_nbr_preprocessing_workers: The number of processes that decode and encode images. Defaults to the CPU count.
+        payload_cache_max_memory_bytes: Encoded images above this many bytes are spilled to disk between phases.
+        payload_encoder: How images are encoded for upload.
+        multipart_upload: If set, images are sent as raw bytes in a multipart/form-data body instead of as a
+            base64 data URI in a JSON body, which is a third smaller. Only for API hosts that accept it.
+        concurrency_limiter: The limiter to share with other clients of the same account. Defaults to a new one
+            that grows up to max_nbr_concurrent_requests.
+        max_nbr_attempts: The number of times a throttled request is sent before giving up.
+        metrics: Receives request latencies, retries, bytes uploaded, requests in flight and queue depths per
+            stage, and the preprocessing timings.
+        host: The Nyckel API host.
         """
         self._client_id: str = client_id
         self._client_secret: str = client_secret
-        self._duplication_threshold = duplication_threshold
         self._max_nbr_concurrent_requests = max_nbr_concurrent_requests
+        self._max_nbr_preprocessing_workers = max_nbr_preprocessing_workers
+        self._payload_cache_max_memory_bytes = payload_cache_max_memory_bytes
+        self.payload_encoder = payload_encoder
+        self._multipart_upload = multipart_upload
+        self._concurrency_limiter = concurrency_limiter or AdaptiveConcurrencyLimiter(
+            initial_limit=min(8, max_nbr_concurrent_requests), max_limit=max_nbr_concurrent_requests
+        )
+        self._max_nbr_attempts = max_nbr_attempts
+        self._metrics = metrics
+        self._in_flight_by_stage: Dict[str, int] = {}
+        self._in_flight_lock = threading.Lock()
+        self._payload_cache: PayloadCache
         self._function_id: str
+        self._access_tokens: AccessTokenManager
+        self._sample_id_by_filename: Dict[str, str] = {}
+        self._filename_by_sample_id: Dict[str, str] = {}
+        self._host = host.rstrip("/")
         self._session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_maxsize=max_nbr_concurrent_requests)
+        self._session.mount("https://", adapter)
+        self._session.mount("http://", adapter)
 
-    def dedupe_filelist(self, image_filelist: List[str]) -> List[Set[str]]:
-        """
-        Deduplicates a list of image files using the Nyckel near-duplicate search API.
-
-        image_filelist: A list of image file paths.
-
-        Returns a list of sets, where each set contains the file paths of duplicate images.
-        """
+    def open(self):
         self._initialize_session()
         self._create_function()
-        sample_ids_by_filename = self._post_images(image_filelist)
-        similarity_by_filename = self._search_images(image_filelist)
-        duplicate_pairs = self._get_duplicate_pairs(sample_ids_by_filename, similarity_by_filename)
-        duplicate_clusters = DuplicateClusterIdentifier()(duplicate_pairs)
-        self._delete_function()
-        return duplicate_clusters
+        self._payload_cache = PayloadCache(max_memory_bytes=self._payload_cache_max_memory_bytes)
+
+    def close(self):
+        self._payload_cache.close()
+        try:
+            self._delete_function()
+        finally:
+            self._access_tokens.close()
+
+    def index_images(self, image_filelist: List[str]) -> Dict[str, str]:
+        return self._post_images(image_filelist)
+
+    def search_images(self, image_filelist: List[str]) -> Dict[str, Optional[dict]]:
+        neighbours_by_filename = self._search_images(image_filelist, 1)
+        return {
+            img_file: neighbours[0] if neighbours else None for img_file, neighbours in neighbours_by_filename.items()
+        }
+
+    def search_neighbours(self, image_filelist: List[str], nbr_neighbours: int) -> Dict[str, List[dict]]:
+        return self._search_images(image_filelist, nbr_neighbours)
 
     def _initialize_session(self):
         """
-        Gets an access token from Nyckel using the client ID and secret.
+        Gets an access token from Nyckel using the client ID and secret. The token is renewed in the background
+        before it expires, and on demand if the API rejects it.
         """
-        token_url = "https://www.nyckel.com/connect/token"
-
-        data = {
-            "client_id": self._client_id,
-            "client_secret": self._client_secret,
-            "grant_type": "client_credentials",
-        }
-
-        response = requests.post(token_url, data=data)
-        assert response.status_code == 200, f"Something went wrong when getting access token: {response.text}"
-        access_token = response.json()["access_token"]
-        self._session.headers.update({"authorization": "Bearer " + access_token})
+        self._access_tokens = AccessTokenManager(
+            f"{self._host}/connect/token", self._client_id, self._client_secret, session=self._session
+        )
+        self._access_tokens.get()
 
     def _create_function(self):
         """
@@ -88,8 +147,8 @@ class NyckelNearDuplicateDeduper:
         def _strip_prefix(prefixed_function_id):
             return prefixed_function_id[9:]
 
-        response = self._session.post(
-            "https://www.nyckel.com/v1/functions/", json={"input": "Image", "output": "Search"}
+        response = self._request(
+            "POST", f"{self._host}/v1/functions/", stage="create_function", json={"input": "Image", "output": "Search"}
         )
 
         assert response.status_code == 200, f"Something went wrong when creating function: {response.text}"
@@ -100,6 +159,9 @@ class NyckelNearDuplicateDeduper:
         """
         Posts images to the Nyckel function.
 
+        Each image is decoded, resized and encoded once, in a process pool, and kept in the payload cache for the
+        search phase. Posting starts as soon as the first payloads are ready.
+
         image_filelist: A list of image file paths to post.
 
         Returns a dictionary mapping sample IDs to file names.
@@ -110,24 +172,36 @@ class NyckelNearDuplicateDeduper:
         with concurrent.futures.ThreadPoolExecutor(
             max_workers=min(len(image_filelist), self._max_nbr_concurrent_requests)
         ) as executor:
-            filename_by_futures = {
-                executor.submit(self._post_one_image, img_file): img_file for img_file in image_filelist
-            }
-            for future in concurrent.futures.as_completed(filename_by_futures):
+            filename_by_futures = {}
+            for img_file, payload in build_payloads(
+                image_filelist,
+                IMAGE_SIZE_FOR_POSTING,
+                max_workers=self._max_nbr_preprocessing_workers,
+                encoder=self.payload_encoder,
+                metrics=self._metrics,
+            ):
+                self._payload_cache[img_file] = payload
+                filename_by_futures[executor.submit(self._post_one_image, img_file)] = img_file
+                self._metrics.set_gauge("queue_depth", len(filename_by_futures), stage="post")
+            for nbr_completed, future in enumerate(concurrent.futures.as_completed(filename_by_futures), start=1):
+                self._metrics.set_gauge("queue_depth", len(filename_by_futures) - nbr_completed, stage="post")
                 img_file = filename_by_futures[future]
                 filename_by_sample_id[future.result()] = img_file
+                self._sample_id_by_filename[img_file] = future.result()
+        self._filename_by_sample_id.update(filename_by_sample_id)
 
         runtime = time.time() - t0
         print(f"Posted {len(image_filelist)} images in {runtime} seconds.")
         return filename_by_sample_id
 
-    def _search_images(self, image_filelist: List[str]):
+    def _search_images(self, image_filelist: List[str], nbr_neighbours: int):
         """
         Searches for near-duplicate images using the Nyckel function.
 
-        image_filelist: A list of image file paths to search.
+        image_filelist: A list of image file paths to search. Must have been posted.
+        nbr_neighbours: The maximum number of matches per image.
 
-        Returns a dictionary mapping file names to near-duplicate search results.
+        Returns a dictionary mapping file names to lists of near-duplicate search results, closest first.
         """
         print(f"Searching images in function {self._function_id}...")
         t0 = time.time()
@@ -136,10 +210,11 @@ class NyckelNearDuplicateDeduper:
             max_workers=min(len(image_filelist), self._max_nbr_concurrent_requests)
         ) as executor:
             filename_by_futures = {
-                executor.submit(self._find_closest_match_excluding_self, img_file): img_file
+                executor.submit(self._find_closest_matches_excluding_self, img_file, nbr_neighbours): img_file
                 for img_file in image_filelist
             }
-            for future in concurrent.futures.as_completed(filename_by_futures):
+            for nbr_completed, future in enumerate(concurrent.futures.as_completed(filename_by_futures), start=1):
+                self._metrics.set_gauge("queue_depth", len(filename_by_futures) - nbr_completed, stage="search")
                 img_file = filename_by_futures[future]
                 similarity_by_filename[img_file] = future.result()
 
@@ -147,28 +222,11 @@ class NyckelNearDuplicateDeduper:
         print(f"Searched {len(image_filelist)} images in {runtime} seconds.")
         return similarity_by_filename
 
-    def _get_duplicate_pairs(self, filename_by_sample_id, similarity_by_filename):
-        """
-        Gets a list of duplicate pairs from the near-duplicate search results.
-
-        filename_by_sample_id: A dictionary mapping sample IDs to file names.
-        similarity_by_filename: A dictionary mapping file names to near-duplicate search results.
-
-        Returns a list of duplicate pairs, where each pair is a set containing the file names of two duplicate images.
-        """
-        duplicate_pairs: List[Set[str, str]] = []
-        for filename in similarity_by_filename:
-            if similarity_by_filename[filename]["distance"] < self._duplication_threshold:
-                duplicate_pairs.append(
-                    set([filename, filename_by_sample_id[similarity_by_filename[filename]["sampleId"]]])
-                )
-        return duplicate_pairs
-
     def _delete_function(self):
         """
         Deletes the Nyckel function after use.
         """
-        response = self._session.delete(f"https://www.nyckel.com/v1/functions/{self._function_id}")
+        response = self._request("DELETE", f"{self._host}/v1/functions/{self._function_id}", stage="delete_function")
         assert response.status_code == 200, "Error during cleanup (deleting function f{self._functionid})"
 
     def _post_one_image(self, img_file_path: str):
@@ -179,134 +237,304 @@ class NyckelNearDuplicateDeduper:
 
         Returns the sample ID of the posted image.
         """
-        img = Image.open(img_file_path)
-        img = img.resize(IMAGE_SIZE_FOR_POSTING)
-        response = self._session.post(
-            f"https://www.nyckel.com/v1/functions/{self._function_id}/samples",
-            json={"data": base64encoded_image(img)},
+        return self.post_payload(self._payload_cache[img_file_path], description=img_file_path)
+
+    def post_payload(self, payload: bytes, description: str = "", external_id: str = None) -> str:
+        """
+        Posts an encoded image to the Nyckel function.
+
+        payload: The encoded image bytes.
+        description: What to call the image in error messages.
+        external_id: If set, stored with the sample and returned with it in search results. An identical image
+            posted later keeps the external ID of the first.
+
+        Returns the sample ID of the posted image, or of the existing sample if an identical image was posted before.
+        """
+        response = self._request(
+            "POST",
+            f"{self._host}/v1/functions/{self._function_id}/samples",
+            stage="post",
+            **self._request_body(payload, stage="post", fields={"externalId": external_id} if external_id else None),
         )
         assert response.status_code in [
             200,
             409,
-        ], f"Something went wrong when posting {img_file_path=} {response.text=} {response.status_code=}"
+        ], f"Something went wrong when posting {description=} {response.text=} {response.status_code=}"
         return response.json()["id"]
 
-    def _find_closest_match_excluding_self(self, img_file_path: str):
+    def _find_closest_matches_excluding_self(self, img_file_path: str, nbr_neighbours: int) -> List[dict]:
         """
-        Finds the closest match to an image, excluding itself, using the Nyckel function.
+        Finds the closest matches to an image, excluding itself, using the Nyckel function.
 
-        img_file_path: The file path of the image to search.
+        The image itself is recognized by its sample ID rather than by its position in the results, since ties
+        can put another sample first. When an identical image posted under another file name shares the sample
+        ID, that sample is kept as a match at its reported distance.
 
-        Returns the near-duplicate search result of the closest match to the image, excluding itself.
+        img_file_path: The file path of the image to search. Must have been posted.
+        nbr_neighbours: The maximum number of matches to return.
+
+        Returns a list of near-duplicate search results, closest first.
         """
-        img = Image.open(img_file_path)
-        img = img.resize(IMAGE_SIZE_FOR_POSTING)
-        response = self._session.post(
-            f"https://www.nyckel.com/v0.9/functions/{self._function_id}/search?sampleCount=2",
-            json={"data": base64encoded_image(img)},
-        )
-        assert response.status_code == 200, f"Something went wrong when searching {img_file_path=} {response.text=}"
-        return response.json()["searchSamples"][1]
+        own_sample_id = self._sample_id_by_filename[img_file_path]
+        own_sample_is_shared = self._filename_by_sample_id[own_sample_id] != img_file_path
+        matches = []
+        for search_sample in self._search_one_image(img_file_path, sample_count=nbr_neighbours + 1):
+            if search_sample["sampleId"] != own_sample_id or own_sample_is_shared:
+                matches.append(search_sample)
+        return matches[:nbr_neighbours]
 
+    def _search_one_image(self, img_file_path: str, sample_count: int) -> List[dict]:
+        """
+        Searches the Nyckel function for the closest samples to an image.
 
-class DuplicateClusterIdentifier:
-    def __init__(self):
-        self.clusters: List[Set[str]] = []
+        img_file_path: The file path of the image to search. Its payload must be in the payload cache.
+        sample_count: The number of closest samples to return.
 
-    def __call__(self, duplicate_pairs: List[Tuple[str, str]]) -> List[Set[str]]:
+        Returns a list of search results, closest first.
         """
-        Identifies clusters of near-duplicate images from a list of duplicate pairs.
-
-        duplicate_pairs: A list of duplicate pairs, where each pair is a tuple containing the file names of two duplicate images.
+        return self.search_payload(self._payload_cache[img_file_path], sample_count, description=img_file_path)
 
-        Returns a list of duplicate clusters, where each cluster is a set containing the file names of near-duplicate images.
+    def search_payload(self, payload: bytes, sample_count: int, description: str = "") -> List[dict]:
         """
-        for member1, member2 in duplicate_pairs:
-            if not self._is_in_any_cluster(member1) and not self._is_in_any_cluster(member2):
-                "Not seen these entries before. Create a new cluster"
-                self._create_new_cluster(member1, member2)
+        Searches the Nyckel function for the closest samples to an encoded image.
 
-            if self._is_in_any_cluster(member1) and self._is_in_any_cluster(member2):
-                "Both are in clusters. Merge them. Merge will ignore if the clusters are the same"
-                self._merge_clusters(self._get_cluster(member1), self._get_cluster(member2))
+        payload: The encoded image bytes.
+        sample_count: The number of closest samples to return.
+        description: What to call the image in error messages.
 
-            if self._is_in_any_cluster(member1) and not self._is_in_any_cluster(member2):
-                "Member1 is in a cluster, but not member2, Add member2 to member1's cluster"
-                self._add_to_cluster(member2, self._get_cluster(member1))
+        Returns a list of search results, closest first.
+        """
+        response = self._request(
+            "POST",
+            f"{self._host}/v0.9/functions/{self._function_id}/search?sampleCount={sample_count}",
+            stage="search",
+            **self._request_body(payload, stage="search"),
+        )
+        assert response.status_code == 200, f"Something went wrong when searching {description=} {response.text=}"
+        return response.json()["searchSamples"]
+
+    def _request_body(self, payload: bytes, stage: str, fields: dict = None) -> dict:
+        """
+        Builds the requests keyword arguments that carry an encoded image and any other fields, as multipart or
+        base64 JSON.
+        """
+        fields = fields or {}
+        if self._multipart_upload:
+            self._metrics.increment("uploaded_bytes", len(payload), stage=stage)
+            return {"files": {"data": ("image", payload, payload_mime_type(payload))}, "data": fields}
+        t0 = time.perf_counter()
+        data = base64encoded_payload(payload)
+        self._metrics.observe("base64_encode_seconds", time.perf_counter() - t0, stage=stage)
+        self._metrics.increment("uploaded_bytes", len(data), stage=stage)
+        return {"json": {"data": data, **fields}}
+
+    def _request(self, method: str, url: str, stage: str, **kwargs) -> requests.Response:
+        """
+        Sends a request through the concurrency limiter. Throttled and overloaded responses are sent again, after
+        the Retry-After pause if the API gave one or an exponential backoff otherwise, up to max_nbr_attempts times.
+        A request rejected with 401 is sent once more with a renewed access token.
+
+        method: The HTTP method.
+        url: The URL.
+        stage: What the request is for, such as "post" or "search", as the label of its metrics.
+        kwargs: Passed on to requests.
+
+        Returns the last response.
+        """
+        renewed_token = False
+        for attempt in range(self._max_nbr_attempts):
+            if attempt:
+                self._metrics.increment("retries", stage=stage)
+            access_token = self._access_tokens.get()
+            headers = {"authorization": "Bearer " + access_token}
+            self._adjust_in_flight(stage, 1)
+            t0 = time.perf_counter()
+            try:
+                response = self._concurrency_limiter.call(self._session.request, method, url, headers=headers, **kwargs)
+            finally:
+                self._adjust_in_flight(stage, -1)
+            self._metrics.observe("request_seconds", time.perf_counter() - t0, stage=stage)
+            self._metrics.increment("responses", stage=stage, status=str(response.status_code))
+            self._metrics.set_gauge("concurrency_limit", self._concurrency_limiter.limit)
+            if response.status_code == 401 and not renewed_token and attempt < self._max_nbr_attempts - 1:
+                self._access_tokens.invalidate(access_token)
+                renewed_token = True
+                continue
+            if not is_overload_status(response.status_code) or attempt == self._max_nbr_attempts - 1:
+                return response
+            if "Retry-After" not in response.headers:
+                time.sleep(0.1 * 2**attempt)
+        return response
+
+    def _adjust_in_flight(self, stage: str, delta: int):
+        with self._in_flight_lock:
+            in_flight = self._in_flight_by_stage[stage] = self._in_flight_by_stage.get(stage, 0) + delta
+        self._metrics.set_gauge("in_flight_requests", in_flight, stage=stage)
 
-            if self._is_in_any_cluster(member2) and not self._is_in_any_cluster(member1):
-                "Member2 is in a cluster, but not member1, Add member1 to member2's cluster"
-                self._add_to_cluster(member1, self._get_cluster(member2))
 
-        self._remove_empty_clusters()
+class NyckelNearDuplicateDeduper:
+    def __init__(
+        self,
+        client_id: str = None,
+        client_secret: str = None,
+        duplication_threshold: float = 0.05,
+        max_nbr_concurrent_requests: int = 20,
+        max_nbr_preprocessing_workers: int = None,
+        payload_cache_max_memory_bytes: int = 512 * 2**20,
+        payload_encoder: PayloadEncoder = DEFAULT_PAYLOAD_ENCODER,
+        multipart_upload: bool = False,
+        local_prefilter: LocalDuplicatePrefilter = None,
+        search_backend: SearchBackend = None,
+        nbr_neighbours: int = 1,
+        metrics: MetricsSink = NULL_METRICS,
+        host: str = NYCKEL_HOST,
+    ):
+        """
+        Initializes a new instance of the NyckelNearDuplicateDeduper class.
 
-        return self.clusters
+        client_id: The Nyckel client ID.
+        client_secret: The Nyckel client secret.
+        duplication_threshold: The threshold above which two images are not considered duplicates.
+        max_nbr_concurrent_requests: The maximum number of concurrent requests to the Nyckel function.
+        max_nbr_preprocessing_workers: The number of processes that decode and encode images. Defaults to the CPU count.
+        payload_cache_max_memory_bytes: Encoded images above this many bytes are spilled to disk between phases.
+        payload_encoder: How images are encoded for upload.
+        multipart_upload: If set, images are uploaded as multipart/form-data instead of base64 JSON.
+        local_prefilter: If set, exact and near-exact copies are grouped locally and only one image per group is sent
+            to Nyckel.
+        search_backend: The backend that runs the near-duplicate search. Defaults to a NyckelSearchBackend built from
+            the arguments above, in which case client_id and client_secret are required.
+        nbr_neighbours: The number of closest matches searched per image. Every match under duplication_threshold
+            becomes an edge, so with more than 1, groups of similar images, such as burst shots, no longer depend
+            on each image's single closest match chaining them together.
+        metrics: Receives the seconds spent in each stage of a run, and is passed on to the default search backend.
+        host: The Nyckel API host.
+        """
+        if search_backend is None:
+            assert client_id and client_secret, "Need client_id and client_secret to search with Nyckel."
+            search_backend = NyckelSearchBackend(
+                client_id,
+                client_secret,
+                max_nbr_concurrent_requests=max_nbr_concurrent_requests,
+                max_nbr_preprocessing_workers=max_nbr_preprocessing_workers,
+                payload_cache_max_memory_bytes=payload_cache_max_memory_bytes,
+                payload_encoder=payload_encoder,
+                multipart_upload=multipart_upload,
+                metrics=metrics,
+                host=host,
+            )
+        self._duplication_threshold = duplication_threshold
+        self._local_prefilter = local_prefilter
+        self._search_backend = search_backend
+        self._nbr_neighbours = nbr_neighbours
+        self._metrics = metrics
 
-    def _is_in_any_cluster(self, member: str):
+    def dedupe_filelist(self, image_filelist: List[str]) -> List[Set[str]]:
         """
-        Checks if an image is in any cluster.
+        Deduplicates a list of image files using the Nyckel near-duplicate search API.
 
-        member: The file name of the image to check.
+        image_filelist: A list of image file paths.
 
-        Returns True if the image is in any cluster, False otherwise.
+        Returns a list of sets, where each set contains the file paths of duplicate images.
         """
-        for cluster in self.clusters:
-            if member in cluster:
-                return True
-        return False
+        local_groups = []
+        if self._local_prefilter:
+            with self._metrics.timer("stage_seconds", stage="prefilter"):
+                local_groups = self._local_prefilter(image_filelist)
+            image_filelist = [group[0] for group in local_groups]
+            print(f"Local prefilter kept {len(image_filelist)} representative images to search.")
+        self._search_backend.open()
+        try:
+            with self._metrics.timer("stage_seconds", stage="index"):
+                filename_by_sample_id = self._search_backend.index_images(image_filelist)
+            with self._metrics.timer("stage_seconds", stage="search"):
+                neighbours_by_filename = self._search_backend.search_neighbours(image_filelist, self._nbr_neighbours)
+        finally:
+            self._search_backend.close()
+        with self._metrics.timer("stage_seconds", stage="cluster"):
+            duplicate_graph = DuplicateGraph.from_neighbours(
+                filename_by_sample_id, neighbours_by_filename, self._duplication_threshold
+            )
+            print(f"Found {len(duplicate_graph)} duplicate edges.")
+            cluster_identifier = DuplicateClusterIdentifier()
+            cluster_identifier.add_pairs((group[0], member) for group in local_groups for member in group[1:])
+            cluster_identifier.add_graph(duplicate_graph)
+            return cluster_identifier.clusters
+
+
+def get_duplicate_pairs(filename_by_sample_id, similarity_by_filename, duplication_threshold: float):
+    """
+    Gets a list of duplicate pairs from the near-duplicate search results.
+
+    filename_by_sample_id: A dictionary mapping sample IDs to file names.
+    similarity_by_filename: A dictionary mapping file names to near-duplicate search results.
+    duplication_threshold: The distance at and above which two images are not considered duplicates.
+
+    Returns a list of duplicate pairs, where each pair is a set containing the file names of two duplicate images.
+    """
+    duplicate_pairs: List[Set[str]] = []
+    for filename in similarity_by_filename:
+        if similarity_by_filename[filename] is None:
+            continue
+        if similarity_by_filename[filename]["distance"] < duplication_threshold:
+            duplicate_pairs.append(set([filename, filename_by_sample_id[similarity_by_filename[filename]["sampleId"]]]))
+    return duplicate_pairs
+
 
-    def _get_cluster(self, member: str):
+class DuplicateClusterIdentifier:
+    def __init__(self):
+        self._disjoint_set = DisjointSet()
+
+    def __call__(self, duplicate_pairs: Iterable[Tuple[str, str]]) -> List[Set[str]]:
         """
-        Gets the cluster of an image.
+        Identifies clusters of near-duplicate images from a list of duplicate pairs.
 
-        member: The file name of the image to get the cluster of.
+        duplicate_pairs: A list of duplicate pairs, where each pair is a tuple containing the file names of two duplicate images.
 
-        Returns the cluster that the image is in.
+        Returns a list of duplicate clusters, where each cluster is a set containing the file names of near-duplicate images.
         """
-        for cluster in self.clusters:
-            if member in cluster:
-                return cluster
-        raise ValueError("Cant get cluster for {member} -- not in any cluster")
+        self.add_pairs(duplicate_pairs)
+        return self.clusters
 
-    def _create_new_cluster(self, member1, member2):
+    def add_pairs(self, duplicate_pairs: Iterable[Tuple[str, str]]):
         """
-        Creates a new cluster for two near-duplicate images.
+        Adds duplicate pairs to the clusters found so far. Pairs are consumed one at a time, so this can be fed
+        from a generator without materializing all pairs.
 
-        member1: The file name of the first image.
-        member2: The file name of the second image.
+        duplicate_pairs: An iterable of duplicate pairs, each containing the file names of two duplicate images.
         """
-        self.clusters.append(set([member1, member2]))
+        union = self._disjoint_set.union
+        for member1, member2 in duplicate_pairs:
+            union(member1, member2)
 
-    def _merge_clusters(self, cluster1, cluster2):
+    def add_graph(self, duplicate_graph: DuplicateGraph):
         """
-        Merges two clusters.
+        Adds every edge of a duplicate graph to the clusters found so far, walking its sparse rows directly.
 
-        cluster1: The first cluster.
-        cluster2: The second cluster.
+        duplicate_graph: The graph of duplicate edges.
         """
-        if cluster1 == cluster2:
-            return
-        cluster2_members = list(cluster2)
-        for member in cluster2_members:
-            cluster1.add(member)
-            cluster2.remove(member)
+        nodes = [self._disjoint_set.add(member) for member in duplicate_graph.members]
+        rows = np.repeat(np.arange(len(nodes)), np.diff(duplicate_graph.indptr))
+        union_nodes = self._disjoint_set.union_nodes
+        for row, other in zip(rows.tolist(), duplicate_graph.indices.tolist()):
+            union_nodes(nodes[row], nodes[other])
+
+    def __contains__(self, member: str) -> bool:
+        return member in self._disjoint_set
 
-    def _add_to_cluster(self, member, cluster):
+    def cluster_of(self, member: str) -> Set[str]:
         """
-        Adds an image to a cluster.
+        Gets the cluster that a file name belongs to, without listing every cluster.
 
-        member: The file name of the image to add.
-        cluster: The cluster to add the image to.
+        member: The file name. Raises KeyError if it is not in any pair added so far.
+
+        Returns the set of file names in the cluster.
         """
-        cluster.add(member)
+        return self._disjoint_set.group_of(member)
 
-    def _remove_empty_clusters(self):
+    @property
+    def clusters(self) -> List[Set[str]]:
         """
-        Removes empty clusters from the list of clusters.
+        The duplicate clusters found so far, where each cluster is a set of file names of near-duplicate images.
         """
-        clusters_tmp = []
-
-        for cluster in self.clusters:
-            if len(cluster) > 0:
-                clusters_tmp.append(cluster)
-        self.clusters = clusters_tmp
+        return self._disjoint_set.groups()
@@ -0,0 +1,256 @@
+import concurrent.futures
+import itertools
+import os
+import shutil
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from functools import partial
+from io import BytesIO
+from typing import Dict, Iterable, Iterator, Sequence, Tuple
+
+from PIL import Image
+
+from metrics import NULL_METRICS, MetricsSink
+
+# Sources whose shorter side is at least this many times the target size are decoded at reduced resolution.
+DRAFT_MIN_SCALE_FACTOR = 2
+
+MIME_TYPE_BY_FORMAT = {"JPEG": "image/jpeg", "PNG": "image/png", "WEBP": "image/webp"}
+
+# Each thread, in practice each preprocessing worker, encodes into one buffer that keeps its capacity between images.
+_thread_local = threading.local()
+
+
+def load_image(img_file_path: str, size: Sequence[int]) -> Image.Image:
+    """
+    Opens an image and resizes it to the posting size.
+
+    For JPEG sources that are much larger than the target size, the decoder is asked for a reduced-resolution
+    draft first, so most of the DCT work for pixels that would be thrown away by the resize is skipped.
+
+    img_file_path: The file path of the image to load.
+    size: The (width, height) to resize to.
+
+    Returns an RGB PIL Image of the requested size.
+    """
+    img = Image.open(img_file_path)
+    if img.format == "JPEG" and min(img.size) >= DRAFT_MIN_SCALE_FACTOR * max(size):
+        img.draft("RGB", tuple(size))
+    if not img.mode == "RGB":
+        img = img.convert("RGB")
+    return img.resize(tuple(size))
+
+
+def encode_image(img: Image.Image, format: str = "JPEG", **save_kwargs) -> bytes:
+    """
+    Encodes a PIL Image to bytes in the given format. save_kwargs, such as quality, are passed on to PIL.
+    """
+    buffered = getattr(_thread_local, "buffer", None)
+    if buffered is None:
+        buffered = _thread_local.buffer = BytesIO()
+    buffered.seek(0)
+    if not img.mode == "RGB":
+        img = img.convert("RGB")
+    img.save(buffered, format=format, **save_kwargs)
+    with buffered.getbuffer() as view:
+        return bytes(view[: buffered.tell()])
+
+
+def payload_mime_type(payload: bytes) -> str:
+    """
+    Tells the MIME type of encoded image bytes from their first bytes. Defaults to JPEG.
+    """
+    if payload.startswith(b"\x89PNG"):
+        return "image/png"
+    if payload[:4] == b"RIFF" and payload[8:12] == b"WEBP":
+        return "image/webp"
+    return "image/jpeg"
+
+
+class PayloadEncoder:
+    """
+    How images are encoded for upload: the format, the quality, and whether small JPEGs are sent as they are.
+
+    WebP at the same quality is usually well under half the size of PIL's default JPEG, at a higher encoding cost.
+    With passthrough_max_bytes set, a JPEG source that already fits within the posting size and is at most that many
+    bytes is uploaded unchanged, skipping decode and encode; it keeps its own dimensions rather than being stretched to
+    the posting size.
+    """
+
+    def __init__(self, format: str = "JPEG", quality: int = None, passthrough_max_bytes: int = 0):
+        """
+        format: "JPEG", "WEBP" or "PNG".
+        quality: The encoder quality from 1 to 100. Defaults to PIL's default for the format. Ignored for PNG.
+        passthrough_max_bytes: The largest JPEG source that is uploaded unchanged. 0 disables pass-through.
+        """
+        self.format = format.upper()
+        assert self.format in MIME_TYPE_BY_FORMAT, f"Unsupported upload format {format}"
+        self.quality = quality
+        self.passthrough_max_bytes = passthrough_max_bytes
+
+    @property
+    def params(self) -> str:
+        """
+        Identifies the encoding, for caches of what was uploaded.
+        """
+        return f"{self.format}:q{self.quality or 'default'}:passthrough{self.passthrough_max_bytes}"
+
+    def encode(self, img: Image.Image) -> bytes:
+        if self.quality is None or self.format == "PNG":
+            return encode_image(img, format=self.format)
+        return encode_image(img, format=self.format, quality=self.quality)
+
+    def passthrough(self, img_file_path: str, size: Sequence[int]) -> bool:
+        """
+        Tells whether an image file can be uploaded as it is.
+        """
+        if not self.passthrough_max_bytes or os.path.getsize(img_file_path) > self.passthrough_max_bytes:
+            return False
+        with Image.open(img_file_path) as img:
+            return img.format == "JPEG" and img.mode in ("RGB", "L") and img.width <= size[0] and img.height <= size[1]
+
+
+DEFAULT_PAYLOAD_ENCODER = PayloadEncoder()
+
+
+def build_payload(img_file_path: str, size: Sequence[int], encoder: PayloadEncoder = DEFAULT_PAYLOAD_ENCODER) -> bytes:
+    """
+    Decodes, resizes and encodes one image. Runs in the preprocessing worker processes.
+
+    img_file_path: The file path of the image.
+    size: The (width, height) to resize to.
+    encoder: How to encode the image.
+
+    Returns the encoded image bytes.
+    """
+    return _build_payload_with_timings(img_file_path, size, encoder)[0]
+
+
+def _build_payload_with_timings(
+    img_file_path: str, size: Sequence[int], encoder: PayloadEncoder
+) -> Tuple[bytes, float, float]:
+    """
+    Like build_payload, but also returns the seconds spent loading and resizing, and encoding.
+    """
+    t0 = time.perf_counter()
+    if encoder.passthrough(img_file_path, size):
+        with open(img_file_path, "rb") as f:
+            return f.read(), time.perf_counter() - t0, 0.0
+    img = load_image(img_file_path, size)
+    t1 = time.perf_counter()
+    payload = encoder.encode(img)
+    return payload, t1 - t0, time.perf_counter() - t1
+
+
+def build_payloads(
+    image_filelist: Iterable[str],
+    size: Sequence[int],
+    max_workers: int = None,
+    encoder: PayloadEncoder = DEFAULT_PAYLOAD_ENCODER,
+    metrics: MetricsSink = NULL_METRICS,
+) -> Iterator[Tuple[str, bytes]]:
+    """
+    Builds payloads for a list of images in a process pool, so decoding and encoding does not hold the GIL
+    in the process that does the network I/O.
+
+    image_filelist: The file paths of the images.
+    size: The (width, height) to resize to.
+    max_workers: The number of worker processes. Defaults to the number of CPUs.
+    encoder: How to encode the images.
+    metrics: Receives the time each worker spent loading and resizing, and encoding, and the payload sizes.
+
+    Yields (file path, encoded bytes) tuples in the order of image_filelist, as soon as each one is ready.
+    """
+    image_filelist = list(image_filelist)
+    if not image_filelist:
+        return
+    max_workers = min(max_workers or os.cpu_count() or 1, len(image_filelist))
+    chunksize = max(1, min(64, len(image_filelist) // (4 * max_workers)))
+    with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers) as executor:
+        results = executor.map(
+            partial(_build_payload_with_timings, size=size, encoder=encoder), image_filelist, chunksize=chunksize
+        )
+        for img_file, (payload, load_seconds, encode_seconds) in zip(image_filelist, results):
+            metrics.observe("image_load_seconds", load_seconds)
+            metrics.observe("image_encode_seconds", encode_seconds)
+            metrics.observe("payload_bytes", len(payload))
+            yield img_file, payload
+
+
+class PayloadCache:
+    """
+    Thread-safe cache of encoded image bytes keyed by file path.
+
+    Keeps the most recently added entries in memory up to max_memory_bytes. Older entries are spilled to
+    files in a temporary folder and read back from disk on access, so the cache never holds more than the
+    bound in memory regardless of how many images are deduped.
+    """
+
+    def __init__(self, max_memory_bytes: int = 512 * 2**20, spill_dir: str = None):
+        """
+        max_memory_bytes: The maximum number of payload bytes to keep in memory.
+        spill_dir: The parent folder for spilled payloads. Defaults to the system temporary folder.
+        """
+        self._max_memory_bytes = max_memory_bytes
+        self._spill_parent_dir = spill_dir
+        self._spill_dir: str = None
+        self._in_memory: "OrderedDict[str, bytes]" = OrderedDict()
+        self._in_memory_bytes = 0
+        self._spill_path_by_key: Dict[str, str] = {}
+        self._spill_counter = itertools.count()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._in_memory) + len(self._spill_path_by_key)
+
+    def __contains__(self, key: str) -> bool:
+        with self._lock:
+            return key in self._in_memory or key in self._spill_path_by_key
+
+    def __setitem__(self, key: str, payload: bytes):
+        with self._lock:
+            self._discard(key)
+            self._in_memory[key] = payload
+            self._in_memory_bytes += len(payload)
+            while self._in_memory_bytes > self._max_memory_bytes and len(self._in_memory) > 1:
+                self._spill_oldest()
+
+    def __getitem__(self, key: str) -> bytes:
+        with self._lock:
+            if key in self._in_memory:
+                return self._in_memory[key]
+            spill_path = self._spill_path_by_key[key]
+        with open(spill_path, "rb") as f:
+            return f.read()
+
+    def close(self):
+        """
+        Drops all entries and removes the spill folder.
+        """
+        with self._lock:
+            self._in_memory.clear()
+            self._in_memory_bytes = 0
+            self._spill_path_by_key.clear()
+            if self._spill_dir:
+                shutil.rmtree(self._spill_dir, ignore_errors=True)
+                self._spill_dir = None
+
+    def _discard(self, key: str):
+        if key in self._in_memory:
+            self._in_memory_bytes -= len(self._in_memory.pop(key))
+        spill_path = self._spill_path_by_key.pop(key, None)
+        if spill_path:
+            os.remove(spill_path)
+
+    def _spill_oldest(self):
+        key, payload = self._in_memory.popitem(last=False)
+        self._in_memory_bytes -= len(payload)
+        if not self._spill_dir:
+            self._spill_dir = tempfile.mkdtemp(prefix="nyckel_payloads_", dir=self._spill_parent_dir)
+        spill_path = os.path.join(self._spill_dir, f"{next(self._spill_counter)}.bin")
+        with open(spill_path, "wb") as f:
+            f.write(payload)
+        self._spill_path_by_key[key] = spill_path
@@ -0,0 +1,144 @@
+import sqlite3
+import time
+from typing import Dict, Iterable, List, NamedTuple, Optional
+
+
+class StoredImage(NamedTuple):
+    content_hash: str
+    sample_id: str
+    neighbour_hash: Optional[str]  # Content hash of the closest other image, None until searched.
+    distance: Optional[float]  # Distance to the closest other image, None until searched.
+
+
+class DedupeResultStore:
+    """
+    On-disk record of what previous dedupe runs posted and found, so a rerun only does work for new or changed files.
+
+    Entries live in a SQLite file and are keyed by the SHA-256 of the image file and a params string that
+    identifies the search function and preprocessing, so renamed or moved files are still hits and a change of
+    preprocessing is a miss. Each entry holds the sample ID of the posted image and the content hash and distance
+    of its nearest neighbour. Beyond max_entries, the least recently used entries of the function being closed are
+    evicted.
+    """
+
+    def __init__(self, path: str, max_entries: int = 10_000_000):
+        """
+        path: The SQLite file. Created if missing.
+        max_entries: The maximum number of images to remember.
+        """
+        self._max_entries = max_entries
+        self._connection = sqlite3.connect(path)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._connection.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL);
+            CREATE TABLE IF NOT EXISTS images (
+                content_hash TEXT NOT NULL,
+                params TEXT NOT NULL,
+                sample_id TEXT NOT NULL,
+                neighbour_hash TEXT,
+                distance REAL,
+                last_used REAL NOT NULL,
+                PRIMARY KEY (content_hash, params)
+            );
+            CREATE INDEX IF NOT EXISTS images_by_last_used ON images (last_used);
+            """
+        )
+        self._connection.commit()
+
+    def close(self):
+        self._connection.close()
+
+    def get_meta(self, key: str) -> Optional[str]:
+        row = self._connection.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def set_meta(self, key: str, value: str):
+        with self._connection:
+            self._connection.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, value))
+
+    def lookup(self, content_hashes: Iterable[str], params: str) -> Dict[str, StoredImage]:
+        """
+        Looks up images by content hash and marks them as used.
+
+        content_hashes: The content hashes to look up.
+        params: The params string the images were posted with.
+
+        Returns a dictionary mapping content hashes to stored images, for the hashes that are stored.
+        """
+        content_hashes = list(dict.fromkeys(content_hashes))
+        stored_by_hash = {}
+        now = time.time()
+        with self._connection:
+            for start in range(0, len(content_hashes), 500):
+                batch = content_hashes[start : start + 500]
+                placeholders = ",".join("?" * len(batch))
+                rows = self._connection.execute(
+                    "SELECT content_hash, sample_id, neighbour_hash, distance FROM images "
+                    f"WHERE params = ? AND content_hash IN ({placeholders})",
+                    (params, *batch),
+                ).fetchall()
+                for row in rows:
+                    stored_by_hash[row[0]] = StoredImage(*row)
+                self._connection.execute(
+                    f"UPDATE images SET last_used = ? WHERE params = ? AND content_hash IN ({placeholders})",
+                    (now, params, *batch),
+                )
+        return stored_by_hash
+
+    def put_samples(self, sample_id_by_hash: Dict[str, str], params: str):
+        """
+        Records posted images. Any previous neighbour result for these images is dropped.
+        """
+        now = time.time()
+        with self._connection:
+            self._connection.executemany(
+                "INSERT OR REPLACE INTO images (content_hash, params, sample_id, neighbour_hash, distance, last_used) "
+                "VALUES (?, ?, ?, NULL, NULL, ?)",
+                [(content_hash, params, sample_id, now) for content_hash, sample_id in sample_id_by_hash.items()],
+            )
+
+    def put_neighbours(self, neighbours: Iterable[tuple], params: str):
+        """
+        Records nearest-neighbour results.
+
+        neighbours: (content_hash, neighbour_hash, distance) tuples.
+        params: The params string the images were posted with.
+        """
+        with self._connection:
+            self._connection.executemany(
+                "UPDATE images SET neighbour_hash = ?, distance = ? WHERE content_hash = ? AND params = ?",
+                [
+                    (neighbour_hash, distance, content_hash, params)
+                    for content_hash, neighbour_hash, distance in neighbours
+                ],
+            )
+
+    def clear(self, params: str):
+        """
+        Forgets every image posted with params.
+        """
+        with self._connection:
+            self._connection.execute("DELETE FROM images WHERE params = ?", (params,))
+
+    def evict(self, function_id: str) -> List[str]:
+        """
+        Removes the least recently used images beyond max_entries, among those posted to one search function.
+
+        function_id: The search function whose images may be removed, as the start of their params string. Images
+            of other functions are left for the runs that use them, since their samples can not be deleted here.
+
+        Returns the sample IDs of the removed images, so their samples can be deleted from the search function.
+        """
+        (count,) = self._connection.execute("SELECT COUNT(*) FROM images").fetchone()
+        if count <= self._max_entries:
+            return []
+        prefix = f"{function_id}:"
+        with self._connection:
+            rows = self._connection.execute(
+                "SELECT rowid, sample_id FROM images WHERE substr(params, 1, ?) = ? ORDER BY last_used LIMIT ?",
+                (len(prefix), prefix, count - self._max_entries),
+            ).fetchall()
+            self._connection.executemany("DELETE FROM images WHERE rowid = ?", [(rowid,) for rowid, _ in rows])
+        return [sample_id for _, sample_id in rows]
@@ -0,0 +1,60 @@
+import abc
+from typing import Dict, List, Optional
+
+
+class SearchBackend(abc.ABC):
+    """
+    Interface for the nearest-neighbour search that NyckelNearDuplicateDeduper runs over a list of images.
+
+    A backend indexes every image first and then searches every image against the index. Search results are
+    dictionaries with a "sampleId" of the matched image, as returned by index_images, and a "distance".
+    Backends that can return more than the closest match per image override search_neighbours.
+    """
+
+    def open(self):
+        """
+        Prepares the backend before images are indexed. Does nothing by default.
+        """
+
+    def close(self):
+        """
+        Releases whatever the backend holds once the deduper is done with it. Does nothing by default.
+        """
+
+    @abc.abstractmethod
+    def index_images(self, image_filelist: List[str]) -> Dict[str, str]:
+        """
+        Adds images to the search index.
+
+        image_filelist: A list of image file paths to index.
+
+        Returns a dictionary mapping sample IDs to file names.
+        """
+
+    @abc.abstractmethod
+    def search_images(self, image_filelist: List[str]) -> Dict[str, Optional[dict]]:
+        """
+        Searches for the closest indexed image to each image, excluding the image itself.
+
+        image_filelist: A list of image file paths to search. Must have been indexed.
+
+        Returns a dictionary mapping file names to the search result of the closest match, or None if the index
+        holds no other image.
+        """
+
+    def search_neighbours(self, image_filelist: List[str], nbr_neighbours: int) -> Dict[str, List[dict]]:
+        """
+        Searches for the closest indexed images to each image, excluding the image itself.
+
+        The default returns only the closest match from search_images, whatever nbr_neighbours is.
+
+        image_filelist: A list of image file paths to search. Must have been indexed.
+        nbr_neighbours: The maximum number of matches per image.
+
+        Returns a dictionary mapping file names to lists of search results, closest first.
+        """
+        similarity_by_filename = self.search_images(image_filelist)
+        return {
+            img_file: [] if similarity is None else [similarity]
+            for img_file, similarity in similarity_by_filename.items()
+        }
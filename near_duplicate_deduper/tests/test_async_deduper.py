@@ -0,0 +1,15 @@
+from async_deduper import AsyncNyckelNearDuplicateDeduper
+from benchmarks.mock_nyckel_server import MockNyckelServerProcess
+from benchmarks.synthetic_corpus import make_synthetic_corpus
+from near_duplicate_deduper import NyckelNearDuplicateDeduper
+
+
+def test_sync_and_async_agree_against_mock_server(tmp_path):
+    image_filelist = make_synthetic_corpus(str(tmp_path), 24, size=(64, 48), duplicate_fraction=0.3)
+    with MockNyckelServerProcess(latency_ms=5) as host:
+        sync_clusters = NyckelNearDuplicateDeduper("id", "secret", host=host).dedupe_filelist(image_filelist)
+        async_clusters = AsyncNyckelNearDuplicateDeduper(
+            "id", "secret", max_nbr_concurrent_requests=4, max_nbr_preprocessing_workers=1, host=host
+        ).run(image_filelist)
+    assert sync_clusters
+    assert sorted(map(sorted, sync_clusters)) == sorted(map(sorted, async_clusters))
@@ -0,0 +1,51 @@
+import time
+
+import requests
+
+from concurrency import AdaptiveConcurrencyLimiter, retry_after_seconds
+
+
+def _response(status_code, headers=None):
+    response = requests.Response()
+    response.status_code = status_code
+    response.headers.update(headers or {})
+    return response
+
+
+def test_window_grows_while_full_and_halves_once_per_burst():
+    limiter = AdaptiveConcurrencyLimiter(initial_limit=2, max_limit=4)
+    for _ in range(20):
+        nbr_in_flight = limiter.limit
+        for _ in range(nbr_in_flight):
+            limiter.acquire()
+        for _ in range(nbr_in_flight):
+            limiter.release(0.01)
+    assert limiter.limit == 4
+
+    for _ in range(4):
+        limiter.acquire()
+    for _ in range(4):
+        limiter.release(0.0, throttled=True)
+    assert limiter.limit == 2
+
+
+def test_window_does_not_grow_when_not_full():
+    limiter = AdaptiveConcurrencyLimiter(initial_limit=2, max_limit=4)
+    for _ in range(20):
+        limiter.acquire()
+        limiter.release(0.01)
+    assert limiter.limit == 2
+
+
+def test_retry_after_pauses_new_requests():
+    limiter = AdaptiveConcurrencyLimiter()
+    assert limiter.call(lambda: _response(429, {"Retry-After": "0.2"})).status_code == 429
+    t0 = time.monotonic()
+    limiter.acquire()
+    assert time.monotonic() - t0 >= 0.15
+
+
+def test_retry_after_seconds():
+    assert retry_after_seconds(_response(429, {"Retry-After": "3"})) == 3.0
+    assert retry_after_seconds(_response(429, {"Retry-After": "Wed, 21 Oct 2015 07:28:00 GMT"})) == 0.0
+    assert retry_after_seconds(_response(429)) is None
@@ -0,0 +1,81 @@
+import shutil
+
+from benchmarks.mock_nyckel_server import MockNyckelServerProcess
+from benchmarks.synthetic_corpus import make_synthetic_corpus
+from dedupe_index import DedupeIndex, iter_dedupe
+from metrics import InMemoryMetrics
+
+
+def test_add_and_query(tmp_path):
+    image_filelist = make_synthetic_corpus(str(tmp_path), 4, size=(64, 48))
+    copy = str(tmp_path / "copy.jpg")
+    shutil.copy(image_filelist[0], copy)
+    with MockNyckelServerProcess() as host:
+        with DedupeIndex("id", "secret", max_nbr_preprocessing_workers=1, host=host) as index:
+            assert index.add(image_filelist[:3]) == {img_file: [] for img_file in image_filelist[:3]}
+            assert index.query([copy, image_filelist[3]]) == {copy: [(image_filelist[0], 0.0)], image_filelist[3]: []}
+            assert len(index) == 3
+
+            assert index.add([copy]) == {copy: [(image_filelist[0], 0.0)]}
+            assert index.clusters == [set([image_filelist[0], copy])]
+            assert len(index) == 4
+
+            second_copy = str(tmp_path / "second_copy.jpg")
+            shutil.copy(image_filelist[0], second_copy)
+            assert index.add([second_copy]) == {second_copy: [(image_filelist[0], 0.0)]}
+            assert len(index) == 5
+
+
+def test_iter_dedupe(tmp_path):
+    image_filelist = make_synthetic_corpus(str(tmp_path), 4, size=(64, 48))
+    copies = [str(tmp_path / "copy_a.jpg"), str(tmp_path / "copy_b.jpg")]
+    for copy in copies:
+        shutil.copy(image_filelist[1], copy)
+
+    def lazy_paths():
+        yield from image_filelist
+        yield from copies
+
+    with MockNyckelServerProcess() as host:
+        updates = list(
+            iter_dedupe(
+                lazy_paths(), "id", "secret", max_nbr_queued_images=2, max_nbr_preprocessing_workers=1, host=host
+            )
+        )
+    assert sorted(update.img_file for update in updates) == copies
+    assert updates[-1].cluster == set([image_filelist[1], *copies])
+
+
+def test_iter_dedupe_passes_on_index_options(tmp_path):
+    image_filelist = make_synthetic_corpus(str(tmp_path), 2, size=(64, 48))
+    copies = [str(tmp_path / "copy_a.jpg"), str(tmp_path / "copy_b.jpg")]
+    for copy in copies:
+        shutil.copy(image_filelist[0], copy)
+    metrics = InMemoryMetrics()
+    with MockNyckelServerProcess() as host:
+        updates = list(
+            iter_dedupe(
+                image_filelist + copies,
+                "id",
+                "secret",
+                nbr_neighbours=1,
+                max_nbr_concurrent_requests=1,
+                max_nbr_preprocessing_workers=1,
+                multipart_upload=True,
+                metrics=metrics,
+                host=host,
+            )
+        )
+    assert [len(update.matches) for update in updates] == [1, 1]
+    assert updates[-1].cluster == set([image_filelist[0], *copies])
+    assert metrics.to_records()
+
+
+def test_multipart_upload(tmp_path):
+    image_filelist = make_synthetic_corpus(str(tmp_path), 3, size=(64, 48))
+    copy = str(tmp_path / "copy.jpg")
+    shutil.copy(image_filelist[2], copy)
+    with MockNyckelServerProcess() as host:
+        with DedupeIndex("id", "secret", max_nbr_preprocessing_workers=1, multipart_upload=True, host=host) as index:
+            index.add(image_filelist)
+            assert index.query([copy]) == {copy: [(image_filelist[2], 0.0)]}
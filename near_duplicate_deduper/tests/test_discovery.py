@@ -0,0 +1,39 @@
+import io
+import os
+
+from PIL import Image
+
+from discovery import discover_images, read_manifest
+
+
+def _write_image(path, format="JPEG"):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    Image.new("RGB", (8, 8), (10, 200, 10)).save(path, format=format)
+    return str(path)
+
+
+def test_discover_recursively_with_globs(tmp_path):
+    top = _write_image(tmp_path / "top.JPG")
+    nested = _write_image(tmp_path / "a" / "b" / "nested.png", format="PNG")
+    thumbnail = _write_image(tmp_path / "a" / "thumbs" / "thumbnail.jpg")
+    (tmp_path / "a" / "notes.txt").write_text("not an image")
+
+    assert sorted(discover_images(str(tmp_path))) == sorted([top, nested, thumbnail])
+    assert sorted(discover_images(str(tmp_path), exclude=["*/thumbs"])) == sorted([top, nested])
+    assert list(discover_images(str(tmp_path), recursive=False)) == [top]
+    assert list(discover_images(str(tmp_path), include=["a/*"], exclude=["*/thumbs"])) == [nested]
+
+
+def test_discover_by_sniffing(tmp_path):
+    no_extension = _write_image(tmp_path / "no_extension")
+    (tmp_path / "fake.jpg").write_text("not an image")
+
+    assert list(discover_images(str(tmp_path))) == [str(tmp_path / "fake.jpg")]
+    assert list(discover_images(str(tmp_path), sniff=True)) == [no_extension]
+
+
+def test_read_manifest(tmp_path, monkeypatch):
+    (tmp_path / "manifest.txt").write_text("a.jpg\n\n  b.jpg \n")
+    assert list(read_manifest(str(tmp_path / "manifest.txt"))) == ["a.jpg", "b.jpg"]
+    monkeypatch.setattr("sys.stdin", io.StringIO("c.jpg\n"))
+    assert list(read_manifest("-")) == ["c.jpg"]
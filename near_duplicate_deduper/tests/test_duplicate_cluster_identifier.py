@@ -1,3 +1,4 @@
+from duplicate_graph import DuplicateGraph
 from near_duplicate_deduper import DuplicateClusterIdentifier
 
 
@@ -38,3 +39,48 @@ def test_three_linked():
     print(clusters)
     assert len(clusters) == 1
     assert clusters[0] == set(["a", "b", "c", "d"])
+
+
+def test_add_pairs_streaming():
+    deduper = DuplicateClusterIdentifier()
+
+    deduper.add_pairs(pair for pair in [("a", "c"), ("d", "b")])
+    assert len(deduper.clusters) == 2
+    deduper.add_pairs(iter([("c", "d")]))
+    assert deduper.clusters == [set(["a", "b", "c", "d"])]
+
+
+def test_long_chain():
+    deduper = DuplicateClusterIdentifier()
+
+    clusters = deduper([(str(i), str(i + 1)) for i in range(1000)])
+    assert len(clusters) == 1
+    assert len(clusters[0]) == 1001
+
+
+def test_cluster_of():
+    deduper = DuplicateClusterIdentifier()
+
+    deduper.add_pairs([("a", "c"), ("d", "b"), ("e", "f")])
+    assert deduper.cluster_of("a") == set(["a", "c"])
+    deduper.add_pairs([("c", "d")])
+    assert deduper.cluster_of("b") == set(["a", "b", "c", "d"])
+    assert deduper.cluster_of("f") == set(["e", "f"])
+
+
+def test_duplicate_graph_drops_repeated_edges():
+    filename_by_sample_id = {"1": "a", "2": "b", "3": "c", "4": "d"}
+    neighbours_by_filename = {
+        "a": [{"sampleId": "2", "distance": 0.01}, {"sampleId": "1", "distance": 0.0}],
+        "b": [{"sampleId": "1", "distance": 0.01}, {"sampleId": "3", "distance": 0.02}],
+        "c": [{"sampleId": "2", "distance": 0.02}, {"sampleId": "4", "distance": 0.5}],
+        "d": [],
+    }
+    graph = DuplicateGraph.from_neighbours(filename_by_sample_id, neighbours_by_filename, duplication_threshold=0.05)
+    assert sorted(graph.edges()) == [("a", "b"), ("b", "c")]
+    assert graph.indptr.tolist() == [0, 1, 2, 2]
+
+    deduper = DuplicateClusterIdentifier()
+    deduper.add_pairs([("d", "e")])
+    deduper.add_graph(graph)
+    assert sorted(map(sorted, deduper.clusters)) == [["a", "b", "c"], ["d", "e"]]
@@ -0,0 +1,81 @@
+import shutil
+
+from benchmarks.mock_nyckel_server import MockNyckelServerProcess
+from benchmarks.synthetic_corpus import make_synthetic_corpus
+from incremental_search_backend import IncrementalNyckelSearchBackend
+from near_duplicate_deduper import NyckelNearDuplicateDeduper
+from result_store import DedupeResultStore
+
+
+class CountingBackend(IncrementalNyckelSearchBackend):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.posted = []
+        self.searched = []
+
+    def _post_one_image(self, img_file_path):
+        self.posted.append(img_file_path)
+        return super()._post_one_image(img_file_path)
+
+    def _search_one_image(self, img_file_path, sample_count):
+        self.searched.append(img_file_path)
+        return super()._search_one_image(img_file_path, sample_count)
+
+
+def _dedupe(result_store, host, image_filelist):
+    backend = CountingBackend("id", "secret", result_store, max_nbr_preprocessing_workers=1, host=host)
+    backend.clusters = NyckelNearDuplicateDeduper(search_backend=backend).dedupe_filelist(image_filelist)
+    return backend
+
+
+def test_rerun_only_posts_and_searches_changes(tmp_path):
+    image_filelist = make_synthetic_corpus(str(tmp_path / "images"), 8, size=(64, 48))
+    result_store = DedupeResultStore(str(tmp_path / "results.sqlite"))
+    with MockNyckelServerProcess() as host:
+        first = _dedupe(result_store, host, image_filelist[:6])
+        assert sorted(first.posted) == sorted(image_filelist[:6])
+        assert sorted(first.searched) == sorted(image_filelist[:6])
+
+        second = _dedupe(result_store, host, image_filelist[:6])
+        assert second.posted == []
+        assert second.searched == []
+
+        changed_filelist = image_filelist[:5] + image_filelist[6:]
+        third = _dedupe(result_store, host, changed_filelist)
+        assert sorted(third.posted) == sorted(image_filelist[6:])
+        assert set(third.searched) >= set(image_filelist[6:])
+        assert len(third.searched) < len(changed_filelist)
+
+
+def test_identical_copies_are_duplicates(tmp_path):
+    image_filelist = make_synthetic_corpus(str(tmp_path / "images"), 4, size=(64, 48))
+    copy = str(tmp_path / "copy.jpg")
+    shutil.copy(image_filelist[1], copy)
+    result_store = DedupeResultStore(str(tmp_path / "results.sqlite"))
+    with MockNyckelServerProcess() as host:
+        first = _dedupe(result_store, host, image_filelist + [copy])
+        assert sorted(first.posted) == sorted(image_filelist)
+        assert first.clusters == [set([image_filelist[1], copy])]
+
+        second = _dedupe(result_store, host, [copy] + image_filelist)
+        assert second.posted == []
+        assert second.clusters == [set([image_filelist[1], copy])]
+
+
+def test_evicts_least_recently_used(tmp_path):
+    result_store = DedupeResultStore(str(tmp_path / "results.sqlite"), max_entries=2)
+    result_store.put_samples({"a": "sample_a", "b": "sample_b"}, "function_1:params")
+    result_store.put_samples({"c": "sample_c"}, "function_1:params")
+    result_store.lookup(["a"], "function_1:params")
+    assert result_store.evict("function_1") == ["sample_b"]
+    assert set(result_store.lookup(["a", "b", "c"], "function_1:params")) == {"a", "c"}
+
+
+def test_evicts_only_from_the_given_function(tmp_path):
+    result_store = DedupeResultStore(str(tmp_path / "results.sqlite"), max_entries=2)
+    result_store.put_samples({"a": "sample_a"}, "function_1:params")
+    result_store.put_samples({"b": "sample_b"}, "function_10:params")
+    result_store.put_samples({"c": "sample_c", "d": "sample_d"}, "function_2:params")
+    assert sorted(result_store.evict("function_2")) == ["sample_c", "sample_d"]
+    assert set(result_store.lookup(["a"], "function_1:params")) == {"a"}
+    assert set(result_store.lookup(["b"], "function_10:params")) == {"b"}
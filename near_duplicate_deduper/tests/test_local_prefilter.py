@@ -0,0 +1,48 @@
+import numpy as np
+from PIL import Image, ImageDraw
+
+from local_prefilter import BKTree, LocalDuplicatePrefilter, dhash, hamming_distance, phash
+
+
+def _write_pattern(path, size, offset=0, format="JPEG", quality=90):
+    img = Image.new("RGB", size, (20, 20, 20))
+    draw = ImageDraw.Draw(img)
+    w, h = size
+    draw.rectangle([w // 8 + offset, h // 8, w // 2 + offset, h // 2], fill=(240, 240, 240))
+    draw.ellipse([w // 2, h // 2, 7 * w // 8, 7 * h // 8], fill=(120, 20, 200))
+    img.save(path, format=format, quality=quality)
+    return str(path)
+
+
+def test_bk_tree_search():
+    tree = BKTree()
+    for value in [0b0000, 0b0001, 0b0011, 0b1111, (1 << 40) | (1 << 41)]:
+        tree.add(value, value)
+    assert sorted(item for _, item in tree.search(0, 1)) == [0b0000, 0b0001]
+    assert sorted(item for _, item in tree.search(0b0111, 1)) == [0b0011, 0b1111]
+    assert list(BKTree().search(0, 64)) == []
+
+
+def test_hashes_are_64_bit():
+    thumbnails = np.random.default_rng(0).integers(0, 255, size=(3, 32, 32), dtype=np.uint8)
+    assert phash(thumbnails).dtype == np.uint64
+    assert dhash(thumbnails[:, :8, :9]).shape == (3,)
+    assert hamming_distance(int(phash(thumbnails[:1])[0]), int(phash(thumbnails[:1])[0])) == 0
+
+
+def test_groups_exact_and_near_exact_copies(tmp_path):
+    original = _write_pattern(tmp_path / "original.jpg", (640, 480))
+    copy = tmp_path / "copy.jpg"
+    copy.write_bytes((tmp_path / "original.jpg").read_bytes())
+    resized = _write_pattern(tmp_path / "resized.png", (320, 240), format="PNG")
+    different = _write_pattern(tmp_path / "different.jpg", (480, 640), offset=200)
+
+    for hash_method in ["dhash", "phash"]:
+        groups = LocalDuplicatePrefilter(hash_method=hash_method, max_nbr_workers=1)(
+            [original, str(copy), different, resized]
+        )
+        assert groups == [[original, str(copy), resized], [different]]
+
+
+def test_empty():
+    assert LocalDuplicatePrefilter()([]) == []
@@ -0,0 +1,86 @@
+import numpy as np
+
+from local_search_backend import LocalVectorSearchBackend
+from near_duplicate_deduper import NyckelNearDuplicateDeduper
+
+
+def _random_embeddings(nbr_rows=50, dim=16, seed=0):
+    return np.random.default_rng(seed).normal(size=(nbr_rows, dim)).astype(np.float32)
+
+
+def _brute_force_top_k(embeddings, k):
+    normalized = embeddings / np.linalg.norm(embeddings, axis=1, keepdims=True)
+    distances = 1 - normalized @ normalized.T
+    np.fill_diagonal(distances, np.inf)
+    return np.argsort(distances, axis=1, kind="stable")[:, :k]
+
+
+def test_top_k_matches_brute_force_across_blocks():
+    embeddings = _random_embeddings()
+    filelist = [f"{i}.jpg" for i in range(len(embeddings))]
+    backend = LocalVectorSearchBackend(
+        embed=lambda img_file: embeddings[int(img_file.split(".")[0])], query_block_size=7, index_block_size=11
+    )
+    backend.index_images(filelist)
+    distances, rows = backend.top_k(np.arange(len(filelist)), k=3)
+    assert np.array_equal(rows, _brute_force_top_k(embeddings, 3))
+    assert np.all(np.diff(distances, axis=1) >= 0)
+
+
+def test_search_without_other_images():
+    backend = LocalVectorSearchBackend(embed=lambda img_file: np.ones(4))
+    backend.index_images(["a.jpg"])
+    assert backend.search_images(["a.jpg"]) == {"a.jpg": None}
+
+
+def test_precomputed_memory_mapped_embeddings(tmp_path):
+    embeddings = _random_embeddings(nbr_rows=20)
+    filelist = [f"{i}.jpg" for i in range(len(embeddings))]
+    np.save(tmp_path / "embeddings.npy", embeddings)
+    (tmp_path / "embeddings.txt").write_text("\n".join(filelist))
+    backend = LocalVectorSearchBackend(
+        embeddings_file=str(tmp_path / "embeddings.npy"),
+        embeddings_index_file=str(tmp_path / "embeddings.txt"),
+        max_in_memory_bytes=0,
+        index_block_size=8,
+    )
+    subset = filelist[::-1][:15]
+    filename_by_sample_id = backend.index_images(subset)
+    similarity_by_filename = backend.search_images(subset)
+    expected = _brute_force_top_k(embeddings[[int(img_file.split(".")[0]) for img_file in subset]], 1)[:, 0]
+    for img_file, expected_row in zip(subset, expected):
+        assert filename_by_sample_id[similarity_by_filename[img_file]["sampleId"]] == subset[expected_row]
+    backend.close()
+
+
+def test_dedupe_with_local_backend():
+    embedding_by_filename = {
+        "a.jpg": [1.0, 0.0, 0.0],
+        "a_copy.jpg": [0.99, 0.01, 0.0],
+        "b.jpg": [0.0, 1.0, 0.0],
+        "c.jpg": [0.0, 0.0, 1.0],
+        "c_copy.jpg": [0.0, 0.02, 1.0],
+    }
+    deduper = NyckelNearDuplicateDeduper(
+        search_backend=LocalVectorSearchBackend(embed=embedding_by_filename.__getitem__)
+    )
+    clusters = deduper.dedupe_filelist(list(embedding_by_filename))
+    assert sorted(map(sorted, clusters)) == [["a.jpg", "a_copy.jpg"], ["c.jpg", "c_copy.jpg"]]
+
+
+def test_dedupe_burst_with_nearest_neighbours():
+    angles = {"burst_0.jpg": 0, "burst_1.jpg": 2, "burst_2.jpg": 10, "burst_3.jpg": 12}
+    embedding_by_filename = {
+        img_file: [np.cos(np.radians(angle)), np.sin(np.radians(angle))] for img_file, angle in angles.items()
+    }
+
+    def dedupe(nbr_neighbours):
+        deduper = NyckelNearDuplicateDeduper(
+            duplication_threshold=0.02,
+            search_backend=LocalVectorSearchBackend(embed=embedding_by_filename.__getitem__),
+            nbr_neighbours=nbr_neighbours,
+        )
+        return sorted(map(sorted, deduper.dedupe_filelist(list(embedding_by_filename))))
+
+    assert dedupe(1) == [["burst_0.jpg", "burst_1.jpg"], ["burst_2.jpg", "burst_3.jpg"]]
+    assert dedupe(3) == [sorted(angles)]
@@ -0,0 +1,55 @@
+import json
+
+from benchmarks.mock_nyckel_server import MockNyckelServerProcess
+from benchmarks.synthetic_corpus import make_synthetic_corpus
+from metrics import InMemoryMetrics
+from near_duplicate_deduper import NyckelNearDuplicateDeduper
+
+
+def test_histogram_quantiles():
+    metrics = InMemoryMetrics()
+    for value in range(1, 101):
+        metrics.observe("request_seconds", value / 1000, stage="search")
+    histogram = metrics.histogram("request_seconds", stage="search")
+    assert histogram.count == 100
+    assert 0.04 <= histogram.quantile(0.5) <= 0.06
+    assert 0.09 <= histogram.quantile(0.99) <= 0.1
+    assert metrics.histogram("request_seconds", stage="post").count == 0
+
+
+def test_exporters(tmp_path):
+    metrics = InMemoryMetrics()
+    metrics.observe("request_seconds", 0.1, stage="post")
+    metrics.increment("uploaded_bytes", 1000, stage="post")
+    metrics.set_gauge("in_flight_requests", 3, stage="post")
+    metrics.set_gauge("in_flight_requests", 1, stage="post")
+
+    metrics.write_jsonl(str(tmp_path / "metrics.jsonl"), run="a")
+    records = [json.loads(line) for line in (tmp_path / "metrics.jsonl").read_text().splitlines()]
+    assert [(record["name"], record["run"]) for record in records] == [
+        ("request_seconds", "a"),
+        ("uploaded_bytes", "a"),
+        ("in_flight_requests", "a"),
+    ]
+    assert records[2]["value"] == 1 and records[2]["max"] == 3
+
+    text = metrics.to_prometheus()
+    assert "# TYPE deduper_request_seconds histogram" in text
+    assert 'deduper_request_seconds_bucket{stage="post",le="+Inf"} 1' in text
+    assert 'deduper_uploaded_bytes_total{stage="post"} 1000' in text
+    assert 'deduper_in_flight_requests{stage="post"} 1' in text
+
+
+def test_deduper_records_stages(tmp_path):
+    image_filelist = make_synthetic_corpus(str(tmp_path), 6, size=(64, 48))
+    metrics = InMemoryMetrics()
+    with MockNyckelServerProcess() as host:
+        NyckelNearDuplicateDeduper(
+            "id", "secret", max_nbr_preprocessing_workers=1, metrics=metrics, host=host
+        ).dedupe_filelist(image_filelist)
+    assert metrics.histogram("request_seconds", stage="post").count == 6
+    assert metrics.histogram("request_seconds", stage="search").count == 6
+    assert metrics.histogram("image_load_seconds").count == 6
+    assert metrics.counter("uploaded_bytes", stage="post") > 0
+    assert metrics.counter("responses", stage="search", status="200") == 6
+    assert metrics.histogram("stage_seconds", stage="index").count == 1
@@ -0,0 +1,67 @@
+from io import BytesIO
+
+from PIL import Image
+
+from benchmarks.synthetic_corpus import make_synthetic_corpus
+from preprocessing import PayloadCache, PayloadEncoder, build_payload, build_payloads, load_image, payload_mime_type
+
+
+def _write_image(path, size, color=(200, 10, 10)):
+    Image.new("RGB", size, color).save(path, format="JPEG")
+    return str(path)
+
+
+def test_payload_cache_spills_to_disk():
+    cache = PayloadCache(max_memory_bytes=10)
+    cache["a"] = b"0123456789"
+    cache["b"] = b"abcdefghij"
+    cache["c"] = b"ABCDEFGHIJ"
+    assert len(cache) == 3
+    assert cache["a"] == b"0123456789"
+    assert cache["b"] == b"abcdefghij"
+    assert cache["c"] == b"ABCDEFGHIJ"
+    cache.close()
+    assert len(cache) == 0
+    assert "a" not in cache
+
+
+def test_payload_cache_overwrite():
+    cache = PayloadCache(max_memory_bytes=4)
+    cache["a"] = b"1234"
+    cache["b"] = b"5678"
+    cache["a"] = b"abcd"
+    assert cache["a"] == b"abcd"
+    assert cache["b"] == b"5678"
+    cache.close()
+
+
+def test_load_image_large_jpeg(tmp_path):
+    img = load_image(_write_image(tmp_path / "large.jpg", (2000, 1500)), [224, 224])
+    assert img.size == (224, 224)
+    assert img.mode == "RGB"
+
+
+def test_build_payloads_keeps_order(tmp_path):
+    filelist = [_write_image(tmp_path / f"{i}.jpg", (300 + i, 300)) for i in range(5)]
+    payloads = list(build_payloads(filelist, [224, 224], max_workers=2))
+    assert [img_file for img_file, _ in payloads] == filelist
+    assert all(payload[:2] == b"\xff\xd8" for _, payload in payloads)
+
+
+def test_payload_encoder_formats(tmp_path):
+    img = load_image(make_synthetic_corpus(str(tmp_path), 1, size=(320, 240))[0], [224, 224])
+    jpeg = PayloadEncoder().encode(img)
+    webp = PayloadEncoder("webp", quality=60).encode(img)
+    png = PayloadEncoder("PNG").encode(img)
+    assert [payload_mime_type(payload) for payload in (jpeg, webp, png)] == ["image/jpeg", "image/webp", "image/png"]
+    assert len(webp) < len(jpeg)
+    assert Image.open(BytesIO(PayloadEncoder().encode(Image.new("RGB", (8, 8))))).size == (8, 8)
+
+
+def test_payload_encoder_passthrough(tmp_path):
+    small = _write_image(tmp_path / "small.jpg", (100, 80))
+    large = _write_image(tmp_path / "large.jpg", (300, 80))
+    encoder = PayloadEncoder("WEBP", passthrough_max_bytes=100_000)
+    with open(small, "rb") as f:
+        assert build_payload(small, [224, 224], encoder) == f.read()
+    assert payload_mime_type(build_payload(large, [224, 224], encoder)) == "image/webp"
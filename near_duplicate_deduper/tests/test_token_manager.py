@@ -0,0 +1,56 @@
+import concurrent.futures
+import json
+import threading
+import time
+
+import requests
+
+from token_manager import AccessTokenManager
+
+
+class _TokenEndpoint:
+    """
+    Stands in for a session whose post returns numbered tokens, slowly, so concurrent renewals would overlap.
+    """
+
+    def __init__(self, expires_in=3600, delay_sec=0.05):
+        self.nbr_posts = 0
+        self._expires_in = expires_in
+        self._delay_sec = delay_sec
+        self._lock = threading.Lock()
+
+    def post(self, url, data, timeout):
+        with self._lock:
+            self.nbr_posts += 1
+            token = f"token-{self.nbr_posts}"
+        time.sleep(self._delay_sec)
+        response = requests.Response()
+        response.status_code = 200
+        response._content = json.dumps({"access_token": token, "expires_in": self._expires_in}).encode()
+        return response
+
+
+def test_concurrent_renewals_are_coalesced():
+    endpoint = _TokenEndpoint()
+    tokens = AccessTokenManager("token-url", "id", "secret", session=endpoint)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=16) as executor:
+        assert set(executor.map(lambda _: tokens.get(), range(64))) == {"token-1"}
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=16) as executor:
+        list(executor.map(lambda _: tokens.invalidate("token-1"), range(16)))
+        assert set(executor.map(lambda _: tokens.get(), range(64))) == {"token-2"}
+    tokens.invalidate("token-1")
+    assert tokens.get() == "token-2"
+    assert endpoint.nbr_posts == 2
+    tokens.close()
+
+
+def test_token_is_renewed_in_the_background_before_expiry():
+    endpoint = _TokenEndpoint(expires_in=0.4, delay_sec=0.0)
+    tokens = AccessTokenManager("token-url", "id", "secret", session=endpoint, refresh_margin_sec=0.3)
+    assert tokens.get() == "token-1"
+    time.sleep(0.3)
+    assert tokens.cached() == "token-2"
+    tokens.close()
+    time.sleep(0.3)
+    assert endpoint.nbr_posts == 2
@@ -0,0 +1,144 @@
+import math
+import threading
+import time
+from typing import Optional
+
+import requests
+
+
+class AccessTokenManager:
+    """
+    Gets and renews an OAuth client-credentials access token for any number of threads.
+
+    Renewals are single-flight: while one thread requests a new token, the others wait for that request instead of
+    sending their own. Once a token is known, a background timer renews it refresh_margin_sec before the expires_in
+    the server gave, so requests keep going with the old token and rarely wait for a renewal at all. A request that
+    is answered with 401 passes the token it was sent with to invalidate, and the next get renews it once, however
+    many requests saw the 401.
+
+    Usage:
+        tokens = AccessTokenManager(f"{host}/connect/token", client_id, client_secret, session=session)
+        token = tokens.get()
+        response = session.post(url, headers={"authorization": "Bearer " + token}, ...)
+        if response.status_code == 401:
+            tokens.invalidate(token)
+    """
+
+    def __init__(
+        self,
+        token_url: str,
+        client_id: str,
+        client_secret: str,
+        session=None,
+        refresh_margin_sec: float = 60.0,
+        timeout_sec: float = 60.0,
+    ):
+        """
+        token_url: The OAuth token endpoint.
+        client_id: The client ID.
+        client_secret: The client secret.
+        session: The requests.Session, or anything with the same post method, to request tokens with. Defaults to a
+            new requests.Session.
+        refresh_margin_sec: How long before expiry a token is renewed in the background. Tokens that live less than
+            twice this are renewed halfway through their life.
+        timeout_sec: How long to wait for the token endpoint.
+        """
+        self._token_url = token_url
+        self._client_id = client_id
+        self._client_secret = client_secret
+        self._session = session or requests.Session()
+        self._refresh_margin_sec = refresh_margin_sec
+        self._timeout_sec = timeout_sec
+        self._token: Optional[str] = None
+        self._expires_at = 0.0
+        self._refreshing = False
+        self._closed = False
+        self._timer: Optional[threading.Timer] = None
+        self._condition = threading.Condition()
+
+    def get(self) -> str:
+        """
+        Returns a valid access token, waiting for a renewal if there is none.
+        """
+        with self._condition:
+            while not self._is_valid():
+                if not self._refreshing:
+                    self._refreshing = True
+                    break
+                self._condition.wait()
+            else:
+                return self._token
+        return self._refresh()
+
+    def cached(self) -> Optional[str]:
+        """
+        Returns the access token if it is still valid, or None if get would have to wait for a renewal.
+        """
+        with self._condition:
+            return self._token if self._is_valid() else None
+
+    def invalidate(self, token: str):
+        """
+        Marks a token that the server rejected as expired, so the next get renews it. Does nothing if the token was
+        renewed since.
+        """
+        with self._condition:
+            if token == self._token:
+                self._expires_at = 0.0
+
+    def close(self):
+        """
+        Stops renewing the token in the background.
+        """
+        with self._condition:
+            self._closed = True
+            if self._timer:
+                self._timer.cancel()
+
+    def _is_valid(self) -> bool:
+        return self._token is not None and time.monotonic() < self._expires_at
+
+    def _refresh(self) -> str:
+        """
+        Requests a new token. Only called by the one thread that set _refreshing.
+        """
+        try:
+            data = {
+                "client_id": self._client_id,
+                "client_secret": self._client_secret,
+                "grant_type": "client_credentials",
+            }
+            response = self._session.post(self._token_url, data=data, timeout=self._timeout_sec)
+            if response.status_code != 200 or "access_token" not in response.json():
+                raise RuntimeError(f"Getting access token failed with {response.status_code}: {response.text}")
+            body = response.json()
+        except BaseException:
+            with self._condition:
+                self._refreshing = False
+                self._condition.notify_all()
+            raise
+        # Without expires_in, the token is kept until the server rejects it.
+        expires_in = float(body["expires_in"]) if body.get("expires_in") else math.inf
+        with self._condition:
+            self._token = body["access_token"]
+            self._expires_at = time.monotonic() + expires_in
+            self._refreshing = False
+            self._condition.notify_all()
+            if self._timer:
+                self._timer.cancel()
+            if not self._closed and expires_in < math.inf:
+                delay = max(expires_in - self._refresh_margin_sec, expires_in / 2)
+                self._timer = threading.Timer(delay, self._refresh_in_background)
+                self._timer.daemon = True
+                self._timer.start()
+            return self._token
+
+    def _refresh_in_background(self):
+        with self._condition:
+            if self._refreshing or self._closed:
+                return
+            self._refreshing = True
+        try:
+            self._refresh()
+        except Exception as err:
+            print(f"Renewing the access token in the background failed; renewing on demand instead. Err: {err}")